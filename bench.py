@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Benchmark the stages of mk_stats.py and pprint_stats.py on a synthetic corpus.
+
+A deterministic collection of synthetic EML docs is generated from the command line
+parameters and a seed, so that runs with the same parameters are comparable. The
+collection is then processed as mk_stats.py and pprint_stats.py would process it, and
+each stage is timed separately:
+
+    walk            find the EML docs below the root
+    parse           parse each EML doc to a DOM
+    xpath           apply the XPaths to each DOM
+    aggregate       add the matched elements to the aggregates
+    stream          stream the EML docs through the simple path matcher (--stream)
+    write_pickle    write the aggregates in the pickle format
+    write_compact   write the aggregates in the compact format
+    read_pickle     read the aggregates in the pickle format
+    read_compact    read the aggregates in the compact format
+    pprint          filter and format the aggregates, as done by pprint_stats.py
+
+The results are written as JSON. With --compare, the results are compared with those of
+a previous run, and the exit code is 1 if any stage got slower by more than
+--threshold.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import lxml.etree
+
+import lib
+import mk_all_stats
+import mk_stats
+import pprint_stats
+import stats_file
+
+DEFAULT_DOC_COUNT = 1000
+DEFAULT_TABLE_COUNT = 3
+DEFAULT_ATTRIBUTE_COUNT = 20
+DEFAULT_CARDINALITY = 500
+DEFAULT_DOC_KB = 8
+DEFAULT_SEED = 1
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+
+# Name of the file holding the parameters with which a corpus was generated.
+CORPUS_PARAMS_FILE_NAME = 'bench-corpus.json'
+
+SCOPE_TUP = ('knb-lter-and', 'knb-lter-arc', 'knb-lter-ntl', 'edi', 'knb-lter-sbc')
+STORAGE_TYPE_TUP = ('float', 'integer', 'string', 'dateTime', 'boolean')
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        'result',
+        help='Path to JSON file to which to write the results',
+    )
+    parser.add_argument(
+        '--corpus',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Directory in which to generate the synthetic EML docs. The docs are
+        reused if the directory holds a corpus generated with the same parameters. By
+        default, a temporary directory is used""",
+    )
+    parser.add_argument(
+        '--docs',
+        metavar='N',
+        type=int,
+        default=DEFAULT_DOC_COUNT,
+        help='Number of EML docs to generate',
+    )
+    parser.add_argument(
+        '--tables',
+        metavar='N',
+        type=int,
+        default=DEFAULT_TABLE_COUNT,
+        help='Max number of dataTable elements in each EML doc',
+    )
+    parser.add_argument(
+        '--attributes',
+        metavar='N',
+        type=int,
+        default=DEFAULT_ATTRIBUTE_COUNT,
+        help='Max number of attribute elements in each dataTable',
+    )
+    parser.add_argument(
+        '--cardinality',
+        metavar='N',
+        type=int,
+        default=DEFAULT_CARDINALITY,
+        help='Number of distinct text values to draw element text from',
+    )
+    parser.add_argument(
+        '--doc-kb',
+        metavar='KB',
+        type=int,
+        default=DEFAULT_DOC_KB,
+        help='Min size of each EML doc. Docs are padded with abstract paragraphs',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=DEFAULT_SEED,
+        help='Seed for the random number generator used for creating the EML docs',
+    )
+    parser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=DEFAULT_REPEAT,
+        help='Number of times to run each stage. The fastest run is reported',
+    )
+    parser.add_argument(
+        '--compare',
+        metavar='path',
+        type=pathlib.Path,
+        help='Path to JSON results of a previous run to compare with',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="""With --compare, report stages that are slower than in the previous run
+        by more than this fraction""",
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    param_dict = {
+        'docs': args.docs,
+        'tables': args.tables,
+        'attributes': args.attributes,
+        'cardinality': args.cardinality,
+        'doc_kb': args.doc_kb,
+        'seed': args.seed,
+    }
+
+    if args.corpus is None:
+        with tempfile.TemporaryDirectory() as tmp_dir_path:
+            result_dict = bench(pathlib.Path(tmp_dir_path), param_dict, args.repeat)
+    else:
+        result_dict = bench(args.corpus, param_dict, args.repeat)
+
+    pathlib.Path(args.result).write_text(json.dumps(result_dict, indent=2))
+    log.info(f'Wrote results to {args.result}')
+
+    log_result(result_dict)
+
+    if args.compare:
+        prev_dict = json.loads(args.compare.read_text())
+        if compare(prev_dict, result_dict, args.threshold):
+            return 1
+
+    return 0
+
+
+def bench(corpus_path, param_dict, repeat):
+    """Generate or reuse the corpus in {corpus_path}, and time each stage on it.
+    Returns a dict of results that can be serialized to JSON."""
+    corpus_path.mkdir(parents=True, exist_ok=True)
+    eml_root_path = corpus_path / 'eml'
+    params_path = corpus_path / CORPUS_PARAMS_FILE_NAME
+    if params_path.exists() and json.loads(params_path.read_text()) == param_dict:
+        log.info(f'Using existing corpus: {eml_root_path.as_posix()}')
+    else:
+        log.info(f'Generating corpus: {eml_root_path.as_posix()}')
+        gen_corpus(eml_root_path, **param_dict)
+        params_path.write_text(json.dumps(param_dict))
+
+    stage_dict = {}
+    timer = StageTimer(stage_dict, repeat)
+    xpath_list = [xpath_str for _, xpath_str in mk_all_stats.STAT_TUP]
+
+    path_list = timer.run('walk', lambda: list(lib.eml_path_gen(eml_root_path)))
+    byte_count = sum(p.stat().st_size for p in path_list)
+
+    tree_list = timer.run('parse', lambda: [lib.get_eml_tree(p) for p in path_list])
+
+    xpath_obj_list = [lib.compile_xpath(xpath_str) for xpath_str in xpath_list]
+    doc_el_list = timer.run(
+        'xpath',
+        lambda: [[lib.xpath(t, x) for x in xpath_obj_list] for t in tree_list],
+    )
+    del tree_list
+
+    def aggregate():
+        dst_list = [{} for _ in xpath_list]
+        for el_list_list in doc_el_list:
+            for el_list, dst_el_dict in zip(el_list_list, dst_list):
+                mk_stats.proc_el_list(el_list, dst_el_dict)
+        return dst_list
+
+    result_list = timer.run('aggregate', aggregate)
+    del doc_el_list
+
+    timer.run(
+        'stream', lambda: mk_stats.proc_path_list(path_list, xpath_list, stream=True)
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        stats_path = pathlib.Path(tmp_dir_path) / 'stats.pickle'
+        for format_str in ('pickle', 'compact'):
+            timer.run(
+                f'write_{format_str}',
+                lambda: write_all(stats_path, result_list, format_str),
+            )
+            timer.run(
+                f'read_{format_str}',
+                lambda: read_all(stats_path, len(result_list), format_str),
+            )
+        timer.run('pprint', lambda: pprint_all(stats_path, len(result_list)))
+
+    for name_str in ('walk', 'parse', 'xpath', 'aggregate', 'stream'):
+        seconds = stage_dict[name_str]['seconds']
+        stage_dict[name_str]['docs_per_s'] = len(path_list) / seconds
+        stage_dict[name_str]['mb_per_s'] = byte_count / 1024**2 / seconds
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'env': {
+            'python': platform.python_version(),
+            'lxml': lxml.etree.__version__,
+            'platform': platform.platform(),
+        },
+        'params': dict(param_dict, repeat=repeat),
+        'corpus': {'doc_count': len(path_list), 'byte_count': byte_count},
+        'stages': stage_dict,
+    }
+
+
+class StageTimer:
+    """Run stages a number of times, and record the time of the fastest run"""
+
+    def __init__(self, stage_dict, repeat):
+        self.stage_dict = stage_dict
+        self.repeat = max(repeat, 1)
+
+    def run(self, name_str, func):
+        """Return the result of the last run of {func}"""
+        seconds_list = []
+        for _ in range(self.repeat):
+            start_ts = time.perf_counter()
+            result = func()
+            seconds_list.append(time.perf_counter() - start_ts)
+        self.stage_dict[name_str] = {
+            'seconds': min(seconds_list),
+            'mean_seconds': sum(seconds_list) / len(seconds_list),
+        }
+        log.debug(f'{name_str}: {min(seconds_list):.3f}s')
+        return result
+
+
+def write_all(stats_path, result_list, format_str):
+    for i, result_dict in enumerate(result_list):
+        mk_stats.write_stats(
+            stats_path.with_name(f'stats-{i}'),
+            dict(result_dict),
+            {'bench': True},
+            format_str,
+        )
+
+
+def read_all(stats_path, stats_count, format_str):
+    for i in range(stats_count):
+        stats_dict, _ = stats_file.read_stats(
+            mk_stats.get_stats_path(stats_path.with_name(f'stats-{i}'), format_str)
+        )
+        # Touch all values, so that lazily decoded formats are measured in full.
+        for tag_dict in stats_dict.values():
+            for _ in tag_dict['unique_count'].items():
+                pass
+        if isinstance(stats_dict, stats_file.CompactStats):
+            stats_dict.close()
+
+
+def pprint_all(stats_path, stats_count):
+    """Format the pickled aggregates as pprint_stats.py does with default filters. The
+    output is discarded."""
+    print_args = argparse.Namespace(
+        values=pprint_stats.DEFAULT_MIN_VALUES,
+        occurences=pprint_stats.DEFAULT_MIN_OCCURENCES,
+        length=pprint_stats.DEFAULT_MAX_LENGTH,
+        top=pprint_stats.DEFAULT_TOP_VALUES,
+    )
+
+    # pprint_stats writes its output with debug level logging.
+    print_log = pprint_stats.log
+    saved_tup = print_log.level, print_log.propagate, print_log.handlers
+    print_log.setLevel(logging.DEBUG)
+    print_log.propagate = False
+    print_log.handlers = [logging.NullHandler()]
+    try:
+        for i in range(stats_count):
+            stats_dict, _ = stats_file.read_stats(
+                mk_stats.get_stats_path(stats_path.with_name(f'stats-{i}'))
+            )
+            pprint_stats.print_stats(stats_dict, list(stats_dict), print_args)
+    finally:
+        print_log.level, print_log.propagate, print_log.handlers = saved_tup
+
+
+def gen_corpus(eml_root_path, docs, tables, attributes, cardinality, doc_kb, seed):
+    """Write {docs} synthetic EML docs below {eml_root_path}. The docs depend only on
+    the parameters, so the same parameters always create the same docs."""
+    rnd = random.Random(seed)
+    value_list = [f'value-{i}' for i in range(max(cardinality, 1))]
+
+    for doc_idx in range(docs):
+        scope_str = rnd.choice(SCOPE_TUP)
+        rev_int = rnd.randint(1, 20)
+        doc_path = (
+            pathlib.Path(eml_root_path)
+            / scope_str
+            / str(doc_idx)
+            / str(rev_int)
+            / lib.EML_FILE_PREFIX
+        )
+        doc_path.parent.mkdir(parents=True, exist_ok=True)
+        doc_path.write_bytes(
+            gen_eml(
+                rnd,
+                f'{scope_str}.{doc_idx}.{rev_int}',
+                tables,
+                attributes,
+                value_list,
+                doc_kb,
+            )
+        )
+
+
+def gen_eml(rnd, package_id, tables, attributes, value_list, doc_kb):
+    nsmap = {'eml': 'https://eml.ecoinformatics.org/eml-2.2.0'}
+    root_el = lxml.etree.Element(
+        lxml.etree.QName(nsmap['eml'], 'eml'), nsmap=nsmap, packageId=package_id
+    )
+    dataset_el = lxml.etree.SubElement(root_el, 'dataset')
+    lxml.etree.SubElement(dataset_el, 'title').text = rnd.choice(value_list)
+    abstract_el = lxml.etree.SubElement(dataset_el, 'abstract')
+
+    for table_idx in range(rnd.randint(0, tables)):
+        dt_el = lxml.etree.SubElement(dataset_el, 'dataTable')
+        lxml.etree.SubElement(dt_el, 'entityName').text = f'table-{table_idx}'
+        attribute_list_el = lxml.etree.SubElement(dt_el, 'attributeList')
+        for attribute_idx in range(rnd.randint(1, max(attributes, 1))):
+            attribute_el = lxml.etree.SubElement(attribute_list_el, 'attribute')
+            lxml.etree.SubElement(
+                attribute_el, 'attributeName'
+            ).text = f'attribute-{attribute_idx}'
+            lxml.etree.SubElement(
+                attribute_el, 'attributeDefinition'
+            ).text = rnd.choice(value_list)
+            lxml.etree.SubElement(attribute_el, 'storageType').text = rnd.choice(
+                STORAGE_TYPE_TUP
+            )
+            scale_el = lxml.etree.SubElement(attribute_el, 'measurementScale')
+            nominal_el = lxml.etree.SubElement(scale_el, 'nominal')
+            lxml.etree.SubElement(nominal_el, 'code').text = rnd.choice(value_list)
+
+    eml_bytes = lxml.etree.tostring(root_el, xml_declaration=True, encoding='UTF-8')
+    while len(eml_bytes) < doc_kb * 1024:
+        para_el = lxml.etree.SubElement(abstract_el, 'para')
+        para_el.text = ' '.join(rnd.choice(value_list) for _ in range(50))
+        eml_bytes = lxml.etree.tostring(
+            root_el, xml_declaration=True, encoding='UTF-8'
+        )
+    return eml_bytes
+
+
+def log_result(result_dict):
+    log.info(
+        f'EML docs: {result_dict["corpus"]["doc_count"]} '
+        f'({result_dict["corpus"]["byte_count"] / 1024**2:.1f} MB)'
+    )
+    for name_str, stage_dict in result_dict['stages'].items():
+        rate_str = ''
+        if 'docs_per_s' in stage_dict:
+            rate_str = (
+                f'{stage_dict["docs_per_s"]:10.1f} docs/s '
+                f'{stage_dict["mb_per_s"]:8.2f} MB/s'
+            )
+        log.info(f'{name_str:<14} {stage_dict["seconds"]:9.4f}s {rate_str}')
+
+
+def compare(prev_dict, result_dict, threshold):
+    """Log the change in time for each stage since the previous run. Return True if any
+    stage is slower by more than {threshold}."""
+    if prev_dict['params'] != result_dict['params']:
+        log.warning('Previous run used other parameters. Times may not be comparable')
+    is_regression = False
+    for name_str, stage_dict in result_dict['stages'].items():
+        prev_stage_dict = prev_dict['stages'].get(name_str)
+        if prev_stage_dict is None:
+            continue
+        ratio = stage_dict['seconds'] / prev_stage_dict['seconds']
+        msg_str = (
+            f'{name_str:<14} {prev_stage_dict["seconds"]:9.4f}s -> '
+            f'{stage_dict["seconds"]:9.4f}s ({(ratio - 1) * 100:+.1f}%)'
+        )
+        if ratio > 1 + threshold:
+            log.warning(f'Slower: {msg_str}')
+            is_regression = True
+        else:
+            log.info(msg_str)
+    return is_regression
+
+
+if __name__ == '__main__':
+    sys.exit(main())
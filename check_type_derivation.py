@@ -5,13 +5,39 @@
 
 This applies a type derivation procedure to all available EML docs and captures the
 results. This can be used for checking current procedures or investigating new ones.
+
+The EML docs are processed in a pool of worker processes with --jobs. The workers
+record the calls to the counter, and the calls are replayed on the counter in the main
+process, so the counts are the same as when processing the EML docs one by one.
+
+Many dataTables in different EML docs, such as in revisions of the same package, have
+identical attributeLists. Each worker keeps the derived types for the attributeLists it
+has seen, keyed by a hash of the canonical form (C14N) of the attributeList, which holds
+everything that the type derivation reads, so repeated attributeLists are only derived
+once per worker.
+
+With --dedupe, each distinct EML doc is only processed once. Its counts are added once
+for each copy, or, with --unique-only, once in total. With --dedupe raw, the EML docs
+are hashed in the workers before they are processed, and copies are found across all
+the docs. With --dedupe normalized, the docs are hashed from the tree parsed by
+eml_types, so each doc is only parsed once, and copies are only found within a chunk of
+EML docs.
+
+EML docs in tar or zip archives are not supported, since eml_types reads the EML docs by
+path.
 """
 
+import collections
+import functools
+import hashlib
 import logging
+import multiprocessing
 import pathlib
 import sys
 import types
 
+import lxml.etree
+
 import eml_types
 import eml_utils.lib as eml_lib
 import eml_utils.util as util
@@ -21,8 +47,19 @@ SRC_ROOT_PATH = THIS_PATH / '___data'
 # SRC_ROOT_PATH = THIS_PATH / '___samples'
 
 
+# Number of EML docs in each batch of work sent to a worker process.
+PATH_CHUNK_SIZE = 100
+
+# Max number of derived type lists to keep in each process. The least recently used
+# are evicted first.
+TYPE_CACHE_SIZE = 100_000
+
 log = logging.getLogger(__name__)
 
+# Derived type lists, keyed by attributeList hash, in order of last use. Held per
+# process.
+_type_cache = collections.OrderedDict()
+
 
 def main():
     parser = eml_lib.ArgumentParser(
@@ -37,6 +74,32 @@ def main():
             (extension must be \'.xml\')
         """,
     )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of worker processes to use. 0 uses one per available core',
+    )
+    parser.add_argument(
+        '--dedupe',
+        choices=('raw', 'normalized'),
+        help="""Process each distinct EML doc only once. 'raw' finds identical docs,
+        'normalized' also docs that only differ in text that only holds whitespace,
+        such as indentation""",
+    )
+    parser.add_argument(
+        '--unique-only',
+        action='store_true',
+        help='With --dedupe, count each distinct EML doc only once',
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -54,8 +117,20 @@ def main():
     args = parser.parse_args()
     counter = util.Counter()
 
+    if args.unique_only and not args.dedupe:
+        parser.error('--unique-only requires --dedupe')
+
+    if eml_lib.is_archive(args.eml_root):
+        parser.error('EML docs in an archive are not supported')
+
     try:
-        proc_all(args.eml_root, counter)
+        proc_all(
+            eml_lib.eml_path_gen(args.eml_root, args.index),
+            counter,
+            args.jobs,
+            args.dedupe,
+            args.unique_only,
+        )
     except eml_lib.EMLError as e:
         log.error(str(e))
         eml_lib.plog(e.xml_frag, 'EML fragment', log.error)
@@ -65,25 +140,139 @@ def main():
     return 0
 
 
-def proc_all(eml_root_path, counter):
-    for eml_path in eml_lib.eml_path_gen(eml_root_path):
-        proc_eml(eml_path, counter)
+def proc_all(path_iter, counter, jobs=1, dedupe=None, unique_only=False):
+    """Derive the types for the dataTables in all EML docs in {path_iter}, and add the
+    results to {counter}.
+
+    Each chunk of EML docs returns a CountRecorder for each doc, and the recorded calls
+    are replayed on {counter} in the main process, in order.
 
+    With {dedupe}, only the first copy of each distinct EML doc is processed. Its counts
+    are added once per copy, or, with {unique_only}, once in total. With 'raw', the
+    docs are first hashed in the workers, and the copies are counted across all the
+    docs by eml_lib.get_first_copy_list(). With 'normalized', the docs are hashed as
+    they are processed, and only copies within a chunk of EML docs are skipped. See
+    proc_path_list().
+    """
+    dup_counter = eml_lib.DuplicateCounter() if dedupe else None
+    count_iter = None
+    if dedupe == 'raw':
+        first_list = eml_lib.get_first_copy_list(
+            path_iter, dup_counter, jobs, PATH_CHUNK_SIZE
+        )
+        path_iter = [eml_path for eml_path, _ in first_list]
+        count_iter = (
+            1 if unique_only else dup_counter.copy_dict[hash_bytes]
+            for _, hash_bytes in first_list
+        )
+    hit_count = miss_count = 0
+    for recorder_list in proc_chunk_gen(path_iter, jobs, dedupe == 'normalized'):
+        for hash_bytes, doc_count, recorder in recorder_list:
+            if count_iter is not None:
+                doc_count = next(count_iter)
+            elif dup_counter is not None:
+                if not dup_counter.add(hash_bytes, doc_count):
+                    if unique_only:
+                        continue
+                elif unique_only:
+                    doc_count = 1
+            for _ in range(doc_count):
+                recorder.replay(counter)
+            hit_count += recorder.hit_count
+            miss_count += recorder.miss_count
+
+    if dup_counter is not None:
+        dup_counter.log()
+    log.info(f'Derived dataTables: {miss_count} reused: {hit_count}')
+
+
+def proc_chunk_gen(path_iter, jobs=1, normalize=False):
+    job_count = eml_lib.get_job_count(jobs)
+    proc_func = functools.partial(proc_path_list, normalize=normalize)
+    chunk_gen = eml_lib.chunk_gen(path_iter, PATH_CHUNK_SIZE)
+
+    if job_count == 1:
+        yield from map(proc_func, chunk_gen)
+        return
 
-def proc_eml(eml_path, counter):
+    log.debug(f'Using {job_count} worker processes')
+    with multiprocessing.Pool(job_count) as pool:
+        yield from pool.imap(proc_func, chunk_gen)
+
+
+def proc_path_list(path_list, normalize=False):
+    """Return a list of (hash_bytes, doc_count, CountRecorder) for the EML docs in
+    {path_list}.
+
+    Without {normalize}, there is one entry per EML doc, with hash_bytes None and
+    doc_count 1. With {normalize}, there is one entry per distinct EML doc in
+    {path_list}, with doc_count being the number of copies.
+
+    eml_types parses the EML docs by path, so with {normalize}, the docs are hashed
+    from the tree that eml_types parsed, as returned by eml_lib.get_tree_hash(), and
+    each doc is only parsed once. Docs without dataTables, and docs that cannot be
+    parsed, are hashed by contents.
+    """
+    if not normalize:
+        return [(None, 1, proc_recorded(eml_path)) for eml_path in path_list]
+    doc_dict = {}
+    for eml_path in path_list:
+        dt_list = get_data_table_list(eml_path)
+        if dt_list:
+            hash_bytes = eml_lib.get_tree_hash(dt_list[0].getroottree().getroot())
+        else:
+            hash_bytes = eml_lib.get_content_hash(eml_lib.read_eml(eml_path).data_bytes)
+        if hash_bytes in doc_dict:
+            doc_dict[hash_bytes][0] += 1
+        else:
+            doc_dict[hash_bytes] = [1, proc_recorded(eml_path, dt_list or [])]
+    return [
+        (hash_bytes, doc_count, recorder)
+        for hash_bytes, (doc_count, recorder) in doc_dict.items()
+    ]
+
+
+def proc_recorded(eml_path, dt_list=None):
+    recorder = CountRecorder()
+    proc_eml(eml_path, recorder, dt_list)
+    return recorder
+
+
+class CountRecorder:
+    """Stands in for util.Counter in the worker processes. The calls to count() are
+    recorded, so that they can be replayed on a util.Counter in the main process."""
+
+    def __init__(self):
+        self.call_list = []
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def count(self, *args, **kwargs):
+        self.call_list.append((args, kwargs))
+
+    def replay(self, counter):
+        for args, kwargs in self.call_list:
+            counter.count(*args, **kwargs)
+
+
+def proc_eml(eml_path, counter, dt_list=None):
+    """Derive the types for the dataTables in the EML doc at {eml_path}, and add the
+    results to {counter}. With {dt_list}, the dataTables have already been found by
+    get_data_table_list()."""
     log.debug('-' * 100)
     log.debug(eml_path.as_posix())
 
-    try:
-        dt_list = eml_types.get_data_table_list(eml_path)
-    except Exception as e:
-        log.error(
-            f'No dataTables in EML. Error="{repr(e)}". path="{eml_path.as_posix()}"'
-        )
-        return
+    if dt_list is None:
+        dt_list = get_data_table_list(eml_path)
+        if dt_list is None:
+            return
 
     for dt_el in dt_list:
-        type_list = eml_types.get_profiling_types(dt_el)
+        type_list, is_hit = get_type_list(dt_el)
+        if is_hit:
+            counter.hit_count += 1
+        else:
+            counter.miss_count += 1
         counter.count('total_columns', '_TOTAL_COLUMNS', inc_int=len(type_list))
         counter.count('total_columns', '_TOTAL_CSV')
 
@@ -99,5 +288,44 @@ def proc_eml(eml_path, counter):
             # counter.count(id_str='', key=type_dict.numeric_domain, detail_obj='')
 
 
+def get_data_table_list(eml_path):
+    """Return the dataTables in the EML doc at {eml_path}, as found by eml_types, or
+    None if the doc could not be read"""
+    try:
+        return eml_types.get_data_table_list(eml_path)
+    except Exception as e:
+        log.error(
+            f'No dataTables in EML. Error="{repr(e)}". path="{eml_path.as_posix()}"'
+        )
+        return None
+
+
+def get_type_list(dt_el):
+    """Return the types derived for dataTable {dt_el}, and True if the result was
+    reused from a dataTable with an identical attributeList.
+
+    The types are derived by eml_types.get_profiling_types(), which only reads the
+    attributes in the attributeList of the dataTable, so dataTables with identical
+    attributeLists give identical types, also if other parts of the dataTables, such as
+    the entity names and physical descriptions, differ.
+    """
+    h = hashlib.sha256()
+    for attr_list_el in dt_el.iterfind('.//attributeList'):
+        h.update(
+            lxml.etree.tostring(
+                attr_list_el, method='c14n', exclusive=True, with_comments=True
+            )
+        )
+    key = h.digest()
+    type_list = _type_cache.get(key)
+    if type_list is not None:
+        _type_cache.move_to_end(key)
+        return type_list, True
+    type_list = tuple(eml_types.get_profiling_types(dt_el))
+    _type_cache[key] = type_list
+    if len(_type_cache) > TYPE_CACHE_SIZE:
+        _type_cache.popitem(last=False)
+    return type_list, False
+
 if __name__ == '__main__':
     sys.exit(main())
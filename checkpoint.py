@@ -0,0 +1,172 @@
+"""Periodic checkpoints for long running scans over collections of EML docs.
+
+A checkpoint holds the partial aggregates for the EML docs that have been processed so
+far, and the position reached in the sequence of EML docs. The EML docs are always
+processed in the order in which they are found, also with worker processes, since the
+partial aggregates from the workers are merged in order. So a scan can be resumed from a
+checkpoint by skipping the number of EML docs that had been processed. The path of the
+last processed doc is stored as well, and checked when resuming, to catch changes to
+the collection.
+
+Checkpoints are written to a temporary file which is then renamed over the previous
+checkpoint, so a crash while writing a checkpoint leaves the previous one in place.
+
+A checkpoint is also written when the scan fails, holding the aggregates up to the last
+position reached before the failure. The path of the EML doc that failed is recorded in
+the checkpoint, and when resuming with {skip_failed}, the recorded docs are skipped. The
+skipped docs are still counted in the position, so the checkpoint stays aligned with
+the sequence of EML docs.
+"""
+
+import logging
+import os
+import pathlib
+import pickle
+import time
+
+import lib
+
+DEFAULT_INTERVAL_MIN = 10
+
+CHECKPOINT_FILE_SUFFIX = '.checkpoint.pickle'
+
+log = logging.getLogger(__name__)
+
+
+def get_checkpoint_path(stats_path):
+    return pathlib.Path(stats_path).with_suffix(CHECKPOINT_FILE_SUFFIX)
+
+
+class Checkpoint:
+    """Checkpoint at {checkpoint_path} for a scan with the arguments in {key_dict}.
+
+    Call update() as EML docs are processed. A checkpoint is written if at least
+    {interval_s} seconds have passed since the last one. With an {interval_s} of 0, no
+    checkpoints are written. Call fail() if the scan fails.
+
+    With {skip_failed}, EML docs on which earlier scans failed are skipped.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path,
+        key_dict,
+        interval_s=DEFAULT_INTERVAL_MIN * 60,
+        skip_failed=False,
+    ):
+        self.checkpoint_path = pathlib.Path(checkpoint_path)
+        self.key_dict = key_dict
+        self.interval_s = interval_s
+        self.skip_failed = skip_failed
+        self.doc_count = 0
+        self.last_path_str = None
+        self.dst_list = None
+        self.failed_list = []
+        # Positions of EML docs that were skipped, but not yet counted.
+        self._skip_pos_set = set()
+        self._save_ts = time.monotonic()
+
+    def exists(self):
+        return self.checkpoint_path.exists()
+
+    def load(self):
+        """Load the aggregates and the position from the checkpoint, if there is one.
+
+        Raises EMLError if the checkpoint was written for a scan with other arguments.
+        """
+        try:
+            checkpoint_dict = pickle.loads(self.checkpoint_path.read_bytes())
+        except FileNotFoundError:
+            log.info('No checkpoint. Starting from the beginning')
+            return
+        if checkpoint_dict['key'] != self.key_dict:
+            raise lib.EMLError(
+                f'Checkpoint was written for a different scan: '
+                f'{checkpoint_dict["key"]}'
+            )
+        self.doc_count = checkpoint_dict['doc_count']
+        self.last_path_str = checkpoint_dict['last_path']
+        self.dst_list = checkpoint_dict['dst_list']
+        self.failed_list = checkpoint_dict.get('failed_list', [])
+        log.info(f'Resuming from checkpoint after EML docs: {self.doc_count}')
+        for path_str in self.failed_list:
+            log.info(
+                f'{"Skipping" if self.skip_failed else "Not skipping"} EML doc that '
+                f'failed before: {path_str}'
+            )
+
+    def skip_gen(self, path_iter):
+        """Yield the paths in {path_iter} that come after the position of the
+        checkpoint, except for the EML docs that failed before, with {skip_failed}.
+        Raises EMLError if the path at the position is not the one that was processed
+        last before the checkpoint was written."""
+        path_iter = iter(path_iter)
+        last_path = None
+        for _, last_path in zip(range(self.doc_count), path_iter):
+            pass
+        if self.doc_count and (
+            last_path is None or last_path.as_posix() != self.last_path_str
+        ):
+            raise lib.EMLError(
+                f'EML docs have changed since the checkpoint was written. Expected '
+                f'{self.last_path_str} at position {self.doc_count}, found '
+                f'{last_path.as_posix() if last_path else "end of EML docs"}'
+            )
+        skip_set = set(self.failed_list) if self.skip_failed else set()
+        for pos, eml_path in enumerate(path_iter, self.doc_count):
+            if eml_path.as_posix() in skip_set:
+                self._skip_pos_set.add(pos)
+                continue
+            yield eml_path
+
+    def update(self, eml_path, dst_list, doc_count=1):
+        """Move the position forward by {doc_count} EML docs, ending with {eml_path},
+        for which the contributions have been added to {dst_list}, and write a
+        checkpoint if it's time for it. Skipped EML docs before each of the processed
+        docs are included in the position."""
+        for _ in range(doc_count):
+            while self.doc_count in self._skip_pos_set:
+                self._skip_pos_set.remove(self.doc_count)
+                self.doc_count += 1
+            self.doc_count += 1
+        self.last_path_str = eml_path.as_posix()
+        if self.interval_s and time.monotonic() - self._save_ts >= self.interval_s:
+            self.save(dst_list)
+
+    def fail(self, dst_list, failed_path_str=None):
+        """Write a checkpoint for the position reached before the scan failed, with
+        {dst_list} holding the contributions up to that position. {failed_path_str} is
+        the path of the EML doc that failed, if known."""
+        if failed_path_str is not None and failed_path_str not in self.failed_list:
+            self.failed_list.append(failed_path_str)
+        if not self.interval_s:
+            return
+        self.save(dst_list)
+        log.error(
+            f'Run again with --resume to continue from the checkpoint, and with '
+            f'--skip-failed to skip the EML docs that failed: '
+            f'{", ".join(self.failed_list) or "unknown"}'
+        )
+
+    def save(self, dst_list):
+        tmp_path = self.checkpoint_path.with_name(self.checkpoint_path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump(
+                {
+                    'key': self.key_dict,
+                    'doc_count': self.doc_count,
+                    'last_path': self.last_path_str,
+                    'dst_list': dst_list,
+                    'failed_list': self.failed_list,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self._save_ts = time.monotonic()
+        log.info(
+            f'Wrote checkpoint after EML docs: {self.doc_count}: '
+            f'{self.checkpoint_path.as_posix()}'
+        )
@@ -1,14 +1,23 @@
 """Functions shared by the EML utilities
 """
 import argparse
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import io
 import logging
+import lzma
+import multiprocessing
 import os
 import pathlib
 import pprint
+import re
 import shutil
-import subprocess
 import sys
+import tarfile
+import time
+import zipfile
 
 import lxml.etree
 
@@ -20,6 +29,48 @@ log = logging.getLogger(__name__)
 # consider it to be a possible limited vocabulary, and stop tracking it.
 MAX_VOCABULARY = 200
 
+# Only files with names that start with this prefix are processed as EML docs.
+EML_FILE_PREFIX = 'Level-1-EML.xml'
+
+# Archives that can be used in place of a directory tree of EML docs.
+ARCHIVE_SUFFIX_TUP = ('.tar', '.tar.xz', '.txz', '.tar.gz', '.tgz', '.tar.bz2', '.zip')
+
+# Number of threads used for scanning directories when creating a corpus index.
+DEFAULT_INDEX_THREADS = 32
+
+# Max number of compiled XPaths kept by get_xpath().
+XPATH_CACHE_SIZE = 256
+
+# Files in the xz format start with these bytes.
+XZ_MAGIC_BYTES = b'\xfd7zXZ\x00'
+
+# Size of the blocks copied when compressing and decompressing files.
+XZ_CHUNK_SIZE = 1024 * 1024
+
+# Size of the blocks read when hashing the contents of files.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Start of the header line of corpus indexes, followed by the root path of the index.
+INDEX_HEADER_PREFIX = '#eml_root\t'
+
+# Default number of EML docs read ahead of the parser by read_ahead_gen(), and max total
+# size of the docs that have been read but not yet parsed.
+DEFAULT_READ_AHEAD = 8
+DEFAULT_READ_AHEAD_MB = 64
+
+# Options of the parser used for all EML docs, in both DOM and stream mode. Entities are
+# not resolved and no DTDs or network resources are loaded, so untrusted docs cannot
+# expand or pull in external content. Comments are removed, so they do not split the
+# text of elements.
+EML_PARSER_DICT = dict(
+    resolve_entities=False, no_network=True, load_dtd=False, remove_comments=True
+)
+EML_PARSER = lxml.etree.XMLParser(**EML_PARSER_DICT)
+
+# Simple paths, as handled by parse_simple_path().
+SIMPLE_PATH_RX = re.compile(r"\.(//?([A-Za-z_][\w.-]*|\*))+")
+SIMPLE_STEP_RX = re.compile(r"(//?)([A-Za-z_][\w.-]*|\*)")
+
 THIS_PATH = pathlib.Path(__file__).parent.resolve()
 DEFAULT_EML_ROOT_DIR = THIS_PATH / '___data'
 
@@ -39,26 +90,436 @@ class ArgumentParser(argparse.ArgumentParser):
         )
 
 
-def eml_path_gen(root_path):
-    """Yield paths to all *.eml files under {root_path}"""
+def eml_path_gen(root_path, index_path=None, shard_tup=None):
+    """Yield paths to all EML docs under {root_path}.
+
+    If {index_path} is set, the paths are read from the corpus index at that location
+    instead of searching the directory tree. The index is created if it does not exist.
+
+    If {shard_tup} is set, only the paths in that shard are yielded. See is_in_shard().
+    """
+    for eml_path, _ in eml_entry_gen(root_path, index_path, False, shard_tup):
+        yield eml_path
+
+
+def eml_entry_gen(
+    root_path, index_path=None, stat=True, shard_tup=None, refresh_index=False
+):
+    """Yield (path, file_dict) for all EML docs under {root_path}.
+
+    file_dict holds the size and modification time of the doc. When reading from a
+    corpus index, they are the values recorded in the index. When searching the
+    directory tree and {stat} is False, file_dict is None.
+
+    The corpus index is created if it does not exist, or if it was created by an older
+    version of the tools. With {refresh_index}, it's always created again, so that it
+    holds the current EML docs, sizes and modification times.
+
+    If {root_path} is a tar or zip archive, the EML docs are read directly from the
+    archive, and are yielded as ArchiveMember objects in place of paths.
+    """
     log.debug(f'Returning EML docs from {root_path}')
+    if is_archive(root_path):
+        entry_gen = archive_entry_gen(root_path)
+    elif index_path is None:
+        entry_gen = _walk_entry_gen(root_path, stat)
+    else:
+        if refresh_index or not is_eml_index_usable(root_path, index_path):
+            build_eml_index(root_path, index_path)
+        entry_gen = read_eml_index(root_path, index_path)
     file_count = 0
-    for root_path, dir_list, file_list in os.walk(root_path):
-        for file_name in file_list:
-            file_path = pathlib.Path(root_path, file_name)
-            if file_path.name.startswith('Level-1-EML.xml'):
-                # if file_path.suffix == ".xml":
-                yield file_path
-                file_count += 1
-                if not file_count % 100:
-                    print(f"Processed EML files: {file_count}", file=sys.stderr)
+    for eml_path, file_dict in entry_gen:
+        if shard_tup and not is_in_shard(eml_path, root_path, shard_tup):
+            continue
+        yield eml_path, file_dict
+        file_count += 1
+        if not file_count % 100:
+            print(f"Processed EML files: {file_count}", file=sys.stderr)
+
+
+def is_eml_file_name(file_name):
+    return file_name.startswith(EML_FILE_PREFIX)
+
+
+def is_archive(file_path):
+    return os.path.isfile(file_path) and str(file_path).endswith(ARCHIVE_SUFFIX_TUP)
+
+
+def archive_entry_gen(archive_path):
+    """Yield (ArchiveMember, file_dict) for all EML docs in the tar or zip archive at
+    {archive_path}. Tar archives are read as a stream, so compressed archives are only
+    decompressed once."""
+    archive_path = pathlib.Path(archive_path)
+    if archive_path.suffix == '.zip':
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not is_eml_file_name(
+                    pathlib.PurePosixPath(info.filename).name
+                ):
+                    continue
+                mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+                yield ArchiveMember(
+                    archive_path, info.filename, zf.read(info)
+                ), {'size': info.file_size, 'mtime_ns': mtime_ns}
+        return
+    with tarfile.open(archive_path, 'r|*') as tf:
+        for info in tf:
+            if not info.isfile() or not is_eml_file_name(
+                pathlib.PurePosixPath(info.name).name
+            ):
+                continue
+            yield ArchiveMember(
+                archive_path, info.name, tf.extractfile(info).read()
+            ), {'size': info.size, 'mtime_ns': int(info.mtime) * 10**9}
+
+
+class ArchiveMember:
+    """EML doc read from an archive.
+
+    Stands in for the path of the EML doc in the rest of the tools. It holds the
+    contents of the doc, so it can be sent to worker processes without the archive
+    having to be opened again. open_eml(), get_eml_tree() and get_file_hash() accept it
+    in place of a path.
+    """
+
+    def __init__(self, archive_path, member_name, data_bytes):
+        self.archive_path = archive_path
+        self.member_name = member_name
+        self.data_bytes = data_bytes
+
+    @property
+    def name(self):
+        return pathlib.PurePosixPath(self.member_name).name
+
+    def as_posix(self):
+        return f'{self.archive_path.as_posix()}/{self.member_name}'
+
+    def __str__(self):
+        return self.as_posix()
+
+    def __repr__(self):
+        return f'ArchiveMember({self.as_posix()!r})'
+
+
+class BufferedEML:
+    """EML doc that has been read into memory, as returned by read_eml().
+
+    Stands in for the path of the EML doc, like ArchiveMember. {data_bytes} holds the
+    decompressed contents of the doc. If the doc has already been parsed, {tree} holds
+    the parsed tree, which get_eml_tree() returns instead of parsing the doc again.
+    """
+
+    def __init__(self, eml_path, data_bytes, tree=None):
+        self.eml_path = eml_path
+        self.data_bytes = data_bytes
+        self.tree = tree
+
+    @property
+    def name(self):
+        return self.eml_path.name
+
+    def as_posix(self):
+        return self.eml_path.as_posix()
+
+    def __str__(self):
+        return self.as_posix()
+
+    def __repr__(self):
+        return f'BufferedEML({self.as_posix()!r})'
+
+
+def _walk_entry_gen(root_path, stat):
+    dir_list = [os.fspath(root_path)]
+    while dir_list:
+        sub_list, entry_list = _scan_dir(dir_list.pop(), stat)
+        dir_list.extend(reversed(sub_list))
+        for path_str, file_dict in entry_list:
+            yield pathlib.Path(path_str), file_dict
+
+
+def _scan_dir(dir_path, stat=True):
+    """Return lists of subdirectories and EML docs in {dir_path}"""
+    sub_list = []
+    entry_list = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                sub_list.append(entry.path)
+            elif is_eml_file_name(entry.name):
+                file_dict = _get_entry_info(entry) if stat else None
+                entry_list.append((entry.path, file_dict))
+    return sub_list, entry_list
+
+
+def _get_entry_info(entry):
+    stat_result = entry.stat()
+    return {'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns}
+
+
+def build_eml_index(root_path, index_path, thread_count=DEFAULT_INDEX_THREADS):
+    """Create a corpus index of all EML docs under {root_path} at {index_path}.
+
+    The index is a text file with a header line holding {root_path}, followed by one
+    line per EML doc, holding the size, modification time and path of the doc, relative
+    to {root_path}. Directories are scanned
+    concurrently by {thread_count} threads, which hides most of the latency of network
+    file systems.
+    """
+    log.info(f'Creating corpus index. root="{root_path}" index="{index_path}"')
+    root_str = os.fspath(root_path)
+    row_list = []
+    with concurrent.futures.ThreadPoolExecutor(thread_count) as executor:
+        future_set = {executor.submit(_scan_dir, root_str)}
+        while future_set:
+            done_set, future_set = concurrent.futures.wait(
+                future_set, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done_set:
+                sub_list, entry_list = future.result()
+                future_set.update(executor.submit(_scan_dir, p) for p in sub_list)
+                for path_str, file_dict in entry_list:
+                    row_list.append(
+                        (
+                            pathlib.Path(path_str).relative_to(root_str).as_posix(),
+                            file_dict['size'],
+                            file_dict['mtime_ns'],
+                        )
+                    )
+    row_list.sort()
+    index_path = pathlib.Path(index_path)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        f.write(f'{INDEX_HEADER_PREFIX}{get_index_root_str(root_path)}\n')
+        for rel_str, size, mtime_ns in row_list:
+            f.write(f'{size}\t{mtime_ns}\t{rel_str}\n')
+    os.replace(tmp_path, index_path)
+    log.info(f'Indexed EML docs: {len(row_list)}')
+
+
+def read_eml_index(root_path, index_path):
+    """Yield (path, file_dict) for each EML doc in the corpus index at {index_path}.
+    Raises EMLError if the index was not created for {root_path}."""
+    check_eml_index_root(root_path, index_path)
+    with open(index_path, encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            size_str, mtime_str, rel_str = line.rstrip('\n').split('\t', 2)
+            yield pathlib.Path(root_path, rel_str), {
+                'size': int(size_str),
+                'mtime_ns': int(mtime_str),
+            }
+
+
+def get_index_root_str(root_path):
+    return pathlib.Path(root_path).resolve().as_posix()
+
+
+def read_index_root_str(index_path):
+    """Return the root path recorded in the header of the corpus index at {index_path},
+    or None if the index has no header."""
+    with open(index_path, encoding='utf-8') as f:
+        header_str = f.readline().rstrip('\n')
+    if not header_str.startswith(INDEX_HEADER_PREFIX):
+        return None
+    return header_str[len(INDEX_HEADER_PREFIX) :]
+
+
+def check_eml_index_root(root_path, index_path):
+    index_root_str = read_index_root_str(index_path)
+    if index_root_str != get_index_root_str(root_path):
+        raise EMLError(
+            f'Corpus index {pathlib.Path(index_path).as_posix()} was created for '
+            f'{index_root_str}, not for {get_index_root_str(root_path)}'
+        )
+
+
+def is_eml_index_usable(root_path, index_path):
+    """Return False if there is no corpus index at {index_path}, or if it was created
+    without a header. Raises EMLError if it was created for another root than
+    {root_path}."""
+    if not pathlib.Path(index_path).exists():
+        return False
+    if read_index_root_str(index_path) is None:
+        log.info('Corpus index has no header. Creating it again')
+        return False
+    check_eml_index_root(root_path, index_path)
+    return True
+
+
+def get_file_hash(file_path):
+    """Return a hex digest of the contents of {file_path}"""
+    if isinstance(file_path, BufferedEML):
+        file_path = file_path.eml_path
+    if isinstance(file_path, ArchiveMember):
+        return hashlib.sha256(file_path.data_bytes).hexdigest()
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk_bytes in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk_bytes)
+    return h.hexdigest()
+
+
+def content_hash_gen(
+    path_iter,
+    normalize=False,
+    read_ahead=DEFAULT_READ_AHEAD,
+    read_ahead_mb=DEFAULT_READ_AHEAD_MB,
+):
+    """Yield (eml_doc, hash_bytes) for each EML doc in {path_iter}.
+
+    eml_doc is a BufferedEML holding the contents of the doc, so the doc is only read
+    once, also if it's processed after hashing. The docs are read ahead as set by
+    {read_ahead} and {read_ahead_mb}. See read_ahead_gen().
+
+    hash_bytes is a digest of the decompressed contents of the doc. With {normalize}, it
+    is instead a digest of the parsed doc, as returned by get_tree_hash(), and the
+    parsed tree is kept in eml_doc. Docs that cannot be parsed are hashed by contents.
+    """
+    for eml_doc in read_ahead_gen(path_iter, read_ahead, read_ahead_mb):
+        if not isinstance(eml_doc, BufferedEML):
+            eml_doc = read_eml(eml_doc)
+        if normalize:
+            try:
+                eml_doc.tree = get_eml_tree(eml_doc)
+            except lxml.etree.LxmlError:
+                pass
+            else:
+                yield eml_doc, get_tree_hash(eml_doc.tree.getroot())
+                continue
+        yield eml_doc, get_content_hash(eml_doc.data_bytes)
+
+
+def get_content_hash(data_bytes):
+    """Return a digest of the contents of an EML doc, as used by content_hash_gen()"""
+    return hashlib.blake2b(data_bytes, digest_size=16).digest()
+
+
+def get_first_copy_list(
+    path_iter,
+    dup_counter,
+    jobs=1,
+    chunk_size=100,
+    read_ahead=DEFAULT_READ_AHEAD,
+    read_ahead_mb=DEFAULT_READ_AHEAD_MB,
+):
+    """Hash the EML docs in {path_iter} by contents, and return (eml_path, hash_bytes)
+    for the first copy of each distinct doc, in order.
+
+    The docs are hashed in chunks of {chunk_size} in a pool of worker processes, as set
+    by {jobs}, and each copy is added to {dup_counter} in this process, so copies are
+    found across the whole collection. When this returns, dup_counter.copy_dict holds
+    the final number of copies of each doc.
+    """
+    hash_func = functools.partial(
+        hash_path_list, read_ahead=read_ahead, read_ahead_mb=read_ahead_mb
+    )
+    job_count = get_job_count(jobs)
+    first_list = []
+
+    def add_chunk(hash_list):
+        for eml_path, hash_bytes in hash_list:
+            if dup_counter.count(hash_bytes):
+                first_list.append((eml_path, hash_bytes))
+
+    if job_count == 1:
+        for hash_list in map(hash_func, chunk_gen(path_iter, chunk_size)):
+            add_chunk(hash_list)
+    else:
+        with multiprocessing.Pool(job_count) as pool:
+            for hash_list in pool.imap(hash_func, chunk_gen(path_iter, chunk_size)):
+                add_chunk(hash_list)
+    return first_list
+
+
+def hash_path_list(
+    path_list, read_ahead=DEFAULT_READ_AHEAD, read_ahead_mb=DEFAULT_READ_AHEAD_MB
+):
+    """Return (eml_path, hash_bytes) for each EML doc in {path_list}, hashed by
+    contents"""
+    return [
+        (eml_doc.eml_path, hash_bytes)
+        for eml_doc, hash_bytes in content_hash_gen(
+            path_list, False, read_ahead, read_ahead_mb
+        )
+    ]
+
+
+def get_tree_hash(root_el):
+    """Return a digest of the elements, attributes, comments, processing instructions
+    and text below and including {root_el}.
+
+    Text and tails that only hold whitespace are skipped, so docs that only differ in
+    the whitespace between tags, such as in indentation, get the same digest. Other
+    whitespace, such as in attribute values and in text with other characters in it,
+    including text in CDATA sections, is included as is.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for el in root_el.iter():
+        if isinstance(el.tag, str):
+            node_tup = el.tag, sorted(el.attrib.items())
+        else:
+            node_tup = el.tag.__name__, getattr(el, 'target', None)
+        h.update(
+            repr(
+                (
+                    *node_tup,
+                    _get_non_blank(el.text),
+                    _get_non_blank(el.tail),
+                    len(el),
+                )
+            ).encode('utf-8')
+        )
+    return h.digest()
+
+
+def _get_non_blank(text):
+    if text is None or text.isspace():
+        return None
+    return text
+
+
+class DuplicateCounter:
+    """Number of copies of each distinct EML doc, by content hash, for reporting the
+    duplicate rate of a scan."""
+
+    def __init__(self):
+        self.copy_dict = {}
+        self.proc_count = 0
+
+    def add(self, hash_bytes, doc_count=1):
+        """Add {doc_count} copies of the EML doc with {hash_bytes}, which were processed
+        once. Return True if they are the first copies of the doc."""
+        self.proc_count += 1
+        is_first = hash_bytes not in self.copy_dict
+        self.copy_dict[hash_bytes] = self.copy_dict.get(hash_bytes, 0) + doc_count
+        return is_first
+
+    def count(self, hash_bytes):
+        """Add a copy of the EML doc with {hash_bytes}, which has not been processed.
+        Return True if it's the first copy, which is the only one to be processed."""
+        is_first = hash_bytes not in self.copy_dict
+        if is_first:
+            self.proc_count += 1
+        self.copy_dict[hash_bytes] = self.copy_dict.get(hash_bytes, 0) + 1
+        return is_first
+
+    def log(self):
+        doc_count = sum(self.copy_dict.values())
+        unique_count = len(self.copy_dict)
+        dup_count = doc_count - unique_count
+        max_count = max(self.copy_dict.values(), default=0)
+        log.info(
+            f'EML docs: {doc_count} distinct: {unique_count} duplicates: {dup_count} '
+            f'({dup_count / (doc_count or 1):.1%}) max copies: {max_count} '
+            f'processed: {self.proc_count}'
+        )
 
 
 def get_element_dict(frag_el):
     """Return a dict of elements to text contents. Includes all elements that contain
     text and are below the {frag_el} in the DOM."""
     d = {}
-    for el in frag_el.xpath(".//*"):
+    for el in get_xpath(".//*")(frag_el):
         text = first(el, "text()")
         if text is not None:
             text = text.strip()
@@ -69,14 +530,81 @@ def get_element_dict(frag_el):
 
 
 def get_eml_tree(eml_path):
-    return lxml.etree.parse(eml_path.as_posix())
+    if isinstance(eml_path, BufferedEML):
+        if eml_path.tree is not None:
+            return eml_path.tree
+        return lxml.etree.fromstring(eml_path.data_bytes, EML_PARSER).getroottree()
+    if isinstance(eml_path, ArchiveMember) or is_xz(eml_path):
+        with open_eml(eml_path) as f:
+            return lxml.etree.parse(f, EML_PARSER)
+    return lxml.etree.parse(eml_path.as_posix(), EML_PARSER)
+
+
+def read_ahead_gen(path_iter, depth=DEFAULT_READ_AHEAD, max_mb=DEFAULT_READ_AHEAD_MB):
+    """Yield the EML docs in {path_iter} as BufferedEML objects, in the same order.
+
+    The docs are read by a pool of {depth} threads, ahead of the consumer, so that the
+    reads overlap with processing of the docs that have already been read. No more docs
+    are read ahead while the docs that have been read, but not yet yielded, take more
+    than {max_mb}. With a {depth} of 0, the paths are yielded as is.
+    """
+    if depth < 1:
+        yield from path_iter
+        return
+    max_bytes = max_mb * 1024 * 1024
+    path_iter = iter(path_iter)
+    future_deque = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(depth) as executor:
+        while True:
+            while (
+                len(future_deque) < depth
+                and _get_read_bytes(future_deque) < max_bytes
+            ):
+                eml_path = next(path_iter, None)
+                if eml_path is None:
+                    break
+                future_deque.append(executor.submit(read_eml, eml_path))
+            if not future_deque:
+                return
+            yield future_deque.popleft().result()
+
+
+def _get_read_bytes(future_deque):
+    """Return the total size of the docs that have been read by the futures in
+    {future_deque}. Failed reads are raised when the future is yielded, in order."""
+    return sum(
+        len(f.result().data_bytes)
+        for f in future_deque
+        if f.done() and f.exception() is None
+    )
+
+
+def read_eml(eml_path):
+    """Return a BufferedEML holding the contents of the EML doc at {eml_path}"""
+    with open_eml(eml_path) as f:
+        return BufferedEML(eml_path, f.read())
+
+
+def get_xpath(xpath_str, namespaces=None):
+    """Return a compiled XPath for {xpath_str}.
 
+    Compiled XPaths are kept in an LRU cache keyed on the expression and namespaces, so
+    callers that apply the same expression to many elements only compile it once.
+    """
+    ns_tup = tuple(sorted(namespaces.items())) if namespaces else None
+    return _get_xpath(xpath_str, ns_tup)
+
+
+@functools.lru_cache(maxsize=XPATH_CACHE_SIZE)
+def _get_xpath(xpath_str, ns_tup):
+    return lxml.etree.XPath(xpath_str, namespaces=dict(ns_tup) if ns_tup else None)
 
-def first(el, xpath):
+
+def first(el, xpath, namespaces=None):
     """Return the first match to the xpath if there was a match, else None. Can this be
     done directly in xpath 1.0?
     """
-    res_el = el.xpath(f"({xpath})[1]")
+    res_el = get_xpath(f"({xpath})[1]", namespaces)(el)
     try:
         res_str = res_el[0]
     except IndexError:
@@ -85,8 +613,8 @@ def first(el, xpath):
     return res_str
 
 
-def has(el, xpath):
-    return first(el, xpath) is not None
+def has(el, xpath, namespaces=None):
+    return first(el, xpath, namespaces) is not None
 
 
 def pretty_format_fragment(root_el):
@@ -99,6 +627,96 @@ def pretty_format_fragment(root_el):
     return buf.getvalue().decode("utf-8")
 
 
+def merge_stats(dst_el_dict, src_el_dict):
+    """Add the counts in aggregate {src_el_dict} to aggregate {dst_el_dict}.
+
+    The aggregates are on the {tag: {'tag_count', 'unique_count'}} form created by
+    mk_stats. The merge is associative and commutative, so partial aggregates created
+    from any partitioning of the EML docs merge to the same result as a single pass.
+    """
+    for tag, src_tag_dict in src_el_dict.items():
+        dst_tag_dict = dst_el_dict.setdefault(tag, {'tag_count': 0, 'unique_count': {}})
+        dst_tag_dict['tag_count'] += src_tag_dict['tag_count']
+        dst_unique_dict = dst_tag_dict['unique_count']
+        for text, count in src_tag_dict['unique_count'].items():
+            dst_unique_dict[text] = dst_unique_dict.get(text, 0) + count
+    return dst_el_dict
+
+
+def sub_stats(dst_el_dict, src_el_dict):
+    """Subtract the counts in aggregate {src_el_dict} from aggregate {dst_el_dict}.
+
+    This is the reverse of merge_stats(). Values and tags for which the count drops to
+    zero are removed.
+    """
+    for tag, src_tag_dict in src_el_dict.items():
+        dst_tag_dict = dst_el_dict[tag]
+        dst_tag_dict['tag_count'] -= src_tag_dict['tag_count']
+        dst_unique_dict = dst_tag_dict['unique_count']
+        for text, count in src_tag_dict['unique_count'].items():
+            dst_unique_dict[text] -= count
+            if not dst_unique_dict[text]:
+                del dst_unique_dict[text]
+        if not dst_tag_dict['tag_count']:
+            del dst_el_dict[tag]
+    return dst_el_dict
+
+
+def scale_stats(el_dict, factor):
+    """Multiply the counts in aggregate {el_dict} by {factor}, as if it had been merged
+    {factor} times"""
+    for tag_dict in el_dict.values():
+        tag_dict['tag_count'] *= factor
+        unique_dict = tag_dict['unique_count']
+        for text in unique_dict:
+            unique_dict[text] *= factor
+    return el_dict
+
+
+def chunk_gen(it, chunk_size):
+    """Yield lists of up to {chunk_size} items from iterable {it}"""
+    chunk_list = []
+    for item in it:
+        chunk_list.append(item)
+        if len(chunk_list) == chunk_size:
+            yield chunk_list
+            chunk_list = []
+    if chunk_list:
+        yield chunk_list
+
+
+def get_job_count(jobs):
+    """Return the number of worker processes to use for a --jobs argument. 0 means
+    one per available core."""
+    return jobs or os.cpu_count() or 1
+
+
+def parse_shard(shard_str):
+    """Parse a --shard argument on the form 'i/N' into a shard tuple, (i, N)"""
+    m = re.fullmatch(r'(\d+)/(\d+)', shard_str)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError(
+            f'Invalid shard: {shard_str}. Must be i/N, with 1 <= i <= N'
+        )
+    return int(m.group(1)), int(m.group(2))
+
+
+def is_in_shard(eml_path, root_path, shard_tup):
+    """Return True if the EML doc at {eml_path} is in shard i of N in {shard_tup}.
+
+    Docs are assigned to shards by a hash of their path relative to {root_path}, so the
+    assignment is the same on all hosts, regardless of where the collection is mounted,
+    and each doc is in exactly one of the N shards.
+    """
+    shard_idx, shard_count = shard_tup
+    if isinstance(eml_path, ArchiveMember):
+        key_str = eml_path.member_name
+    else:
+        key_str = pathlib.PurePath(eml_path).relative_to(root_path).as_posix()
+    h = hashlib.blake2b(key_str.encode('utf-8'), digest_size=8)
+    return int.from_bytes(h.digest(), 'big') % shard_count == shard_idx - 1
+
+
 def merge_dict_set(dst_d, src_d):
     for el_name, text_dict in src_d.items():
         if el_name not in block_set:
@@ -133,15 +751,104 @@ def plog(obj, msg=None, logger=log.debug):
     logger("")
 
 
-def xpath(root_el, path_str, full_path=False):
+def compile_xpath(path_str, namespaces=None):
+    """Return a compiled XPath for {path_str}, which is taken to be relative to the
+    root element, as in xpath(). The compiled XPath is cached by get_xpath().
+    """
     if not path_str.startswith(".//"):
         path_str = ".//" + path_str
-    el_list = root_el.xpath(path_str)
+    return get_xpath(path_str, namespaces)
+
+
+def xpath(root_el, path_str, full_path=False, namespaces=None):
+    """Apply {path_str} to {root_el}. {path_str} may be a string or an XPath object
+    returned by compile_xpath().
+    """
+    if isinstance(path_str, lxml.etree.XPath):
+        xpath_obj = path_str
+    else:
+        xpath_obj = compile_xpath(path_str, namespaces)
+    el_list = xpath_obj(root_el)
     if full_path:
-        el_list = [(el, get_el_path(root_el.getroot(), el)) for el in el_list]
+        resolver = ElementPathResolver(root_el.getroot())
+        el_list = [(el, ElementPath(resolver, el)) for el in el_list]
     return el_list
 
 
+def parse_simple_path(path_str):
+    """Parse a simple path into a tuple of (axis, name) steps.
+
+    Simple paths are the subset of XPath used for most aggregations, such as
+    './/dataTable//*' and './/attributeList/attribute//*'. They consist only of child
+    ('/') and descendant ('//') steps with element names or '*', and are taken to be
+    relative to the root element, as in xpath(). Returns None if {path_str} is not a
+    simple path.
+    """
+    if not path_str.startswith(".//"):
+        path_str = ".//" + path_str
+    if not SIMPLE_PATH_RX.fullmatch(path_str):
+        return None
+    return tuple(SIMPLE_STEP_RX.findall(path_str[1:]))
+
+
+@functools.lru_cache(maxsize=10000)
+def match_simple_path(step_tup, tag_tup):
+    """Return True if the element reached by the tags in {tag_tup}, starting at the
+    root element, is selected by simple path {step_tup}."""
+    pos_set = {0}
+    for axis_str, name_str in step_tup:
+        next_set = set()
+        for pos in pos_set:
+            if axis_str == "/":
+                pos_range = range(pos + 1, min(pos + 2, len(tag_tup)))
+            else:
+                pos_range = range(pos + 1, len(tag_tup))
+            for i in pos_range:
+                if name_str == "*" or name_str == tag_tup[i]:
+                    next_set.add(i)
+        if not next_set:
+            return False
+        pos_set = next_set
+    return len(tag_tup) - 1 in pos_set
+
+
+def iter_simple_path(eml_path, step_list):
+    """Stream the EML doc at {eml_path}, and yield (match_list, tag, text) for each
+    element selected by at least one of the simple paths in {step_list}.
+
+    match_list holds a bool for each simple path, which is True if the path selects
+    the element. Elements are yielded in the order in which they end.
+    """
+    for tag_tup, text in iter_tag_path(eml_path):
+        match_list = [match_simple_path(s, tag_tup) for s in step_list]
+        if any(match_list):
+            yield match_list, tag_tup[-1], text
+
+
+def iter_tag_path(eml_path):
+    """Stream the EML doc at {eml_path}, and yield (tag_tup, text) for each element.
+
+    tag_tup holds the tags of the element and its ancestors, starting at the root
+    element. Elements are yielded in the order in which they end, and are cleared
+    immediately after, so memory use does not grow with the size of the doc.
+    """
+    tag_list = []
+    with open_eml(eml_path) as f:
+        for event_str, el in lxml.etree.iterparse(
+            f, events=("start", "end"), **EML_PARSER_DICT
+        ):
+            if event_str == "start":
+                tag_list.append(el.tag)
+                continue
+            yield tuple(tag_list), el.text
+            tag_list.pop()
+            el.clear(keep_tail=True)
+            parent_el = el.getparent()
+            if parent_el is not None:
+                while el.getprevious() is not None:
+                    del parent_el[0]
+
+
 def get_dt_filename(dt_el):
     return first(dt_el, ".//physical/objectName/text()")
 
@@ -153,33 +860,48 @@ def get_el_path(root_el, el):
 
 def to_xz(src_path, dst_path):
     log_copy(src_path, dst_path)
-    with dst_path.open('wb') as f:
-        subprocess.run(['xz', src_path.as_posix(), '--stdout'], stdout=f)
+    with src_path.open('rb') as src_f, lzma.open(dst_path, 'wb') as dst_f:
+        shutil.copyfileobj(src_f, dst_f, XZ_CHUNK_SIZE)
 
 
 def from_xz(src_path, dst_path):
     log_copy(src_path, dst_path)
-    with dst_path.open('wb') as f:
-        subprocess.run(['unxz', src_path.as_posix(), '--stdout'], stdout=f)
+    with lzma.open(src_path, 'rb') as src_f, dst_path.open('wb') as dst_f:
+        shutil.copyfileobj(src_f, dst_f, XZ_CHUNK_SIZE)
 
 
 def read_xz(src_path):
-    with subprocess.Popen(['xzcat', src_path.as_posix()], stdout=subprocess.PIPE) as p:
-        return p.communicate()[0]
+    with lzma.open(src_path, 'rb') as f:
+        return f.read()
 
 
 def decode_xz(xz_bytes):
-    try:
-        with subprocess.Popen(
-            ['xz', '--decompress', '--stdout'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as p:
-            # return p.communicate(input=io.BytesIO(xz_bytes))[0]
-            return p.communicate(input=xz_bytes)[0]
-    except Exception as e:
+    """Return the decompressed contents of {xz_bytes}. Bytes that are not in the xz
+    format are returned as is. Raises lzma.LZMAError if the bytes are in the xz format,
+    but cannot be decompressed.
+    """
+    if not xz_bytes.startswith(XZ_MAGIC_BYTES):
         return xz_bytes
+    return lzma.decompress(xz_bytes, format=lzma.FORMAT_XZ)
+
+
+def is_xz(file_path):
+    return str(file_path).endswith('.xz')
+
+
+def open_eml(eml_path):
+    """Open the EML doc at {eml_path} for reading as bytes. Docs with suffix '.xz' are
+    decompressed while they are read. {eml_path} may also be an ArchiveMember or a
+    BufferedEML."""
+    if isinstance(eml_path, BufferedEML):
+        return io.BytesIO(eml_path.data_bytes)
+    if isinstance(eml_path, ArchiveMember):
+        f = io.BytesIO(eml_path.data_bytes)
+    else:
+        f = open(eml_path, 'rb')
+    if is_xz(eml_path):
+        return lzma.open(f, 'rb')
+    return f
 
 
 def from_xz_dir(src_dir_path: pathlib.Path, dst_dir_path: pathlib.Path):
@@ -201,7 +923,81 @@ def log_copy(src_path, dst_path):
     log.debug(f'-> {dst_path.as_posix()}')
 
 
+class ElementPathResolver:
+    """Resolve the paths of elements in the tree below {root_el}.
+
+    The paths are the same as those returned by get_el_path(), but are created for all
+    elements in a single traversal of the tree, the first time a path is requested.
+    Each path is built from the path of its parent, so the cost is linear in the size
+    of the tree.
+    """
+
+    def __init__(self, root_el):
+        self._root_el = root_el
+        self._path_dict = None
+
+    def get_path(self, el):
+        if self._path_dict is None:
+            self._path_dict = self._build_path_dict()
+        return self._path_dict[el]
+
+    def _build_path_dict(self):
+        path_dict = {self._root_el: '.'}
+        stack_list = [(self._root_el, '')]
+        while stack_list:
+            parent_el, parent_path = stack_list.pop()
+            child_list = [c for c in parent_el if isinstance(c.tag, str)]
+            tag_total_dict = {}
+            for child_el in child_list:
+                tag_total_dict[child_el.tag] = tag_total_dict.get(child_el.tag, 0) + 1
+            tag_idx_dict = {}
+            for child_el in child_list:
+                tag = child_el.tag
+                if tag_total_dict[tag] > 1:
+                    tag_idx_dict[tag] = tag_idx_dict.get(tag, 0) + 1
+                    tag = f'{tag}[{tag_idx_dict[tag]}]'
+                child_path = f'{parent_path}/{tag}' if parent_path else tag
+                path_dict[child_el] = child_path
+                stack_list.append((child_el, child_path))
+        return path_dict
+
+
+class ElementPath:
+    """Path of an element, as returned by get_el_path(), which is only resolved when it
+    is used as a string."""
+
+    __slots__ = ('_resolver', '_el')
+
+    def __init__(self, resolver, el):
+        self._resolver = resolver
+        self._el = el
+
+    def __str__(self):
+        return self._resolver.get_path(self._el)
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
 class EMLError(Exception):
     def __init__(self, msg, xml_frag=None):
         self.xml_frag = xml_frag
         super(EMLError, self).__init__(msg)
+
+
+class EMLDocError(EMLError):
+    """Processing of the EML doc at {eml_path_str} failed. Unlike most exceptions from
+    lxml, it can be sent from worker processes."""
+
+    def __init__(self, msg, eml_path_str=None, xml_frag=None):
+        self.eml_path_str = eml_path_str
+        super(EMLDocError, self).__init__(msg, xml_frag)
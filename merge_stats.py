@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Combine partial stats files into a single stats file.
+
+This merges stats files created by mk_stats.py for the same XPath, such as the partial
+stats files created with --shard on a set of hosts, into one stats file that can be
+read by pprint_stats.py. The partial stats files may be in pickle or compact format.
+
+The partial stats files must have been created with the same XPath and --top-k. With
+--top-k, each tag must hold the error bounds of the counts and the estimate of unique
+values, which are used when merging. If they were created with --shard, each shard may
+only be included once, and a warning is logged if any shards are missing.
+
+With --max-vocabulary, tags with more unique values than the limit in the merged result
+are not considered to hold a limited vocabulary, and are dropped, as for
+lib.MAX_VOCABULARY.
+"""
+
+import logging
+import pathlib
+import sys
+import time
+
+import lib
+import mk_stats
+import sketch
+import stats_file
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        'pickle',
+        help='Stats file to create',
+    )
+    parser.add_argument(
+        'partial',
+        nargs='+',
+        type=pathlib.Path,
+        help='Partial stats files to merge, in pickle or compact format',
+    )
+    parser.add_argument(
+        '--format',
+        choices=('pickle', 'compact'),
+        default='pickle',
+        help="""Format of the merged stats file. It's written with suffix '.stats' in
+        the compact format""",
+    )
+    parser.add_argument(
+        '--max-vocabulary',
+        metavar='N',
+        nargs='?',
+        type=int,
+        const=lib.MAX_VOCABULARY,
+        help="""Drop tags with more than N unique values. If N is not given,
+        lib.MAX_VOCABULARY is used""",
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    start_ts = time.time()
+
+    try:
+        result_dict, args_dict = merge_all(args.partial, args.max_vocabulary)
+    except lib.EMLError as e:
+        log.error(str(e))
+        return 1
+    except Exception:
+        log.exception('Unhandled exception')
+        return 1
+
+    mk_stats.write_stats(args.pickle, result_dict, args_dict, args.format)
+
+    m, s = divmod(time.time() - start_ts, 60)
+    log.debug(f'Elapsed: {int(m)}m {int(s)}s')
+
+    return 0
+
+
+def merge_all(stats_path_list, max_vocabulary=None):
+    """Return the merged aggregate of the stats files in {stats_path_list}, and the
+    arguments to store with it.
+
+    Tags with more than {max_vocabulary} unique values are dropped, and values for them
+    in the remaining stats files are skipped.
+    """
+    result_dict = {}
+    args_list = []
+    block_set = set()
+
+    for stats_path in stats_path_list:
+        log.info(f'Merging: {stats_path.as_posix()}')
+        part_dict, part_args_dict = read_partial(stats_path)
+        args_list.append(part_args_dict or {})
+        check_args(args_list, stats_path)
+        top_k = args_list[0].get('top_k') or 0
+        for tag in block_set.intersection(part_dict):
+            del part_dict[tag]
+        if top_k:
+            check_sketch(part_dict, stats_path)
+            sketch.merge_finalized_stats(result_dict, part_dict, top_k)
+        else:
+            lib.merge_stats(result_dict, part_dict)
+        if max_vocabulary is not None:
+            for tag in list(part_dict):
+                if len(result_dict[tag]['unique_count']) > max_vocabulary:
+                    log.debug(f'Exceeded max vocabulary: {tag}')
+                    del result_dict[tag]
+                    block_set.add(tag)
+
+    if block_set:
+        log.info(f'Dropped tags that exceeded max vocabulary: {len(block_set)}')
+    check_shards(args_list)
+
+    args_dict = dict(
+        args_list[0],
+        shard=None,
+        merged=[stats_path.as_posix() for stats_path in stats_path_list],
+    )
+    return result_dict, args_dict
+
+
+def read_partial(stats_path):
+    """Return the aggregate in {stats_path} as a plain dict, and the arguments with
+    which it was created"""
+    stats, args_dict = stats_file.read_stats(stats_path)
+    if isinstance(stats, stats_file.CompactStats):
+        with stats:
+            return stats.to_dict(), args_dict
+    return stats, args_dict
+
+
+def check_args(args_list, stats_path):
+    """Raise EMLError if the last stats file in {args_list} was created with a different
+    XPath or --top-k than the first"""
+    first_dict, last_dict = args_list[0], args_list[-1]
+    for key in 'xpath', 'top_k':
+        if first_dict.get(key) != last_dict.get(key):
+            raise lib.EMLError(
+                f'Cannot merge {stats_path.as_posix()}: {key} is '
+                f'{last_dict.get(key)!r}, expected {first_dict.get(key)!r}'
+            )
+
+
+def check_sketch(part_dict, stats_path):
+    """Raise EMLError if any of the tags in {part_dict}, which was created with --top-k,
+    are missing the error bounds or the estimate of unique values"""
+    for tag, tag_dict in part_dict.items():
+        if 'count_error' not in tag_dict or 'unique_estimate' not in tag_dict:
+            raise lib.EMLError(
+                f'Cannot merge {stats_path.as_posix()}: Created with --top-k, but '
+                f'missing count_error or unique_estimate for tag: {tag}'
+            )
+
+
+def check_shards(args_list):
+    """Raise EMLError if a shard was included more than once, and log a warning if any
+    shards are missing."""
+    shard_set = set()
+    count_set = set()
+    for args_dict in args_list:
+        if not args_dict.get('shard'):
+            continue
+        shard_idx, shard_count = args_dict['shard']
+        if (shard_idx, shard_count) in shard_set:
+            raise lib.EMLError(
+                f'Shard included more than once: {shard_idx}/{shard_count}'
+            )
+        shard_set.add((shard_idx, shard_count))
+        count_set.add(shard_count)
+    for shard_count in count_set:
+        missing_list = [
+            i for i in range(1, shard_count + 1) if (i, shard_count) not in shard_set
+        ]
+        if missing_list:
+            log.warning(
+                f'Missing shards of {shard_count}: '
+                f'{", ".join(str(i) for i in missing_list)}'
+            )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,55 @@
 #!/usr/bin/env python
 
-"""Create a set of predefined aggregation files concurrently.
+"""Create a set of predefined aggregation files in a single pass.
 
 Configured directly in the source.
+
+Each EML doc is parsed only once, and all the XPaths are applied to the parsed doc, so
+creating all the aggregation files costs about the same as creating a single one.
+
+With --config, the aggregation files are instead defined in a JSON file, and each is
+created by a separate run of mk_stats.py. This allows each query to have its own
+options. The file holds a list of jobs:
+
+    {"jobs": [
+        {"pickle": "stats-all-elements.pickle", "xpath": ".//*", "memory_mb": 8000,
+         "args": ["--jobs", "4", "--format", "compact"]},
+        ...
+    ]}
+
+"memory_mb" is the memory the job is expected to use, and "args" holds additional
+arguments for mk_stats.py. Both are optional. A job may also have a "name", which is
+used for its log file, and defaults to the name of the pickle file without suffix.
+
+The jobs are run concurrently, up to --max-jobs at a time, and are only started while
+the total expected memory of the running jobs stays within --memory. Jobs are started
+in order of descending memory, so the largest jobs are packed first. A job that needs
+more than --memory is run when no other jobs are running. The output of each job is
+written to a log file in --log-dir, and the exit code and elapsed time of each job are
+logged when all jobs have completed.
+
+"memory_mb" is only used for scheduling, and is not enforced by default. With
+--limit-memory, the address space of each process of a job, including its worker
+processes, is limited to "memory_mb", and a job that goes over it fails. Address space
+includes memory that is mapped but not used, so the limit needs some headroom.
+
+Each job runs its own pool of worker processes. With --jobs 0, the available cores are
+divided between the jobs that can run at the same time, instead of each job using one
+worker process per core.
 """
-import subprocess
+import json
 import logging
+import os
+import pathlib
+import resource
+import subprocess
 import sys
+import time
 
 import lib
+import mk_path_index
+import mk_stats
+import result_cache
 
 STAT_TUP = (
     ('stats-datatable-only.pickle', './/dataTable'),
@@ -17,6 +58,17 @@ STAT_TUP = (
     ('stats-all-elements.pickle', './/*'),
 )
 
+DEFAULT_LOG_DIR = lib.THIS_PATH / '___logs'
+
+# Expected memory use of jobs that don't set "memory_mb".
+DEFAULT_JOB_MEMORY_MB = 1024
+
+# Share of the physical memory that is used by default for --memory.
+DEFAULT_MEMORY_SHARE = 0.8
+
+# Seconds between checks for completed jobs.
+POLL_INTERVAL_S = 0.2
+
 log = logging.getLogger(__name__)
 
 
@@ -24,17 +76,366 @@ def main():
     parser = lib.ArgumentParser(
         description=__doc__,
     )
-    parser.parse_args()
+    parser.add_argument(
+        '--eml-root',
+        metavar='path',
+        type=pathlib.Path,
+        default=lib.DEFAULT_EML_ROOT_DIR,
+        help="""Path to root of directory tree to search for EML docs
+            (extension must be \'.xml\'), or to a .tar, .tar.xz or .zip archive
+            holding EML docs
+        """,
+    )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of worker processes to use. 0 uses one per available core',
+    )
+    parser.add_argument(
+        '--path-index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Answer the queries from an index created by mk_path_index.py instead
+        of scanning the EML docs""",
+    )
+    parser.add_argument(
+        '--top-k',
+        metavar='K',
+        type=int,
+        default=0,
+        help="""Only track approximate counts for the K most common values of each
+        element. 0 tracks all values exactly""",
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="""Always scan the EML docs, instead of returning cached results for the
+        same queries against an unchanged collection of EML docs. With the cache, the
+        EML docs are listed before the scan to detect changes, and --index is created
+        again""",
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='path',
+        type=pathlib.Path,
+        default=result_cache.DEFAULT_CACHE_DIR,
+        help='Directory in which to cache query results',
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        type=int,
+        default=result_cache.DEFAULT_CACHE_SIZE_MB,
+        help='Max total size of cached query results',
+    )
+    parser.add_argument(
+        '--config',
+        metavar='path',
+        type=pathlib.Path,
+        help="""JSON file defining the aggregation files to create, each with a
+        separate run of mk_stats.py. See above""",
+    )
+    parser.add_argument(
+        '--max-jobs',
+        metavar='N',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='With --config, max number of mk_stats.py runs at a time',
+    )
+    parser.add_argument(
+        '--memory',
+        metavar='MB',
+        type=int,
+        default=get_default_memory_mb(),
+        help="""With --config, max total expected memory of the mk_stats.py runs
+        at a time""",
+    )
+    parser.add_argument(
+        '--limit-memory',
+        action='store_true',
+        help="""With --config, limit the address space of each process of each
+        mk_stats.py run to its "memory_mb". See above""",
+    )
+    parser.add_argument(
+        '--log-dir',
+        metavar='path',
+        type=pathlib.Path,
+        default=DEFAULT_LOG_DIR,
+        help='With --config, directory in which to write a log file for each run',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    if args.config:
+        try:
+            job_list = get_job_list(read_config(args.config), args)
+        except lib.EMLError as e:
+            log.error(str(e))
+            return 1
+        start_ts = time.time()
+        try:
+            run_jobs(job_list, args.max_jobs, args.memory)
+        finally:
+            log_summary(job_list, time.time() - start_ts)
+        return 0 if all(job.returncode == 0 for job in job_list) else 1
 
     for pickle_path, xpath_str in STAT_TUP:
         print(f'{pickle_path} {xpath_str}')
 
-        cmd_list = [
-            './mk_stats.py',
+    start_ts = time.time()
+
+    xpath_list = [xpath_str for _, xpath_str in STAT_TUP]
+
+    try:
+        if args.path_index:
+            result_list = mk_path_index.query(args.path_index, xpath_list)
+        elif args.no_cache:
+            result_list = mk_stats.proc_all(
+                lib.eml_path_gen(args.eml_root, args.index),
+                xpath_list,
+                args.jobs,
+                top_k=args.top_k,
+            )
+        else:
+            result_list = mk_stats.proc_all_cached(
+                result_cache.ResultCache(args.cache_dir, args.cache_size),
+                args.eml_root,
+                args.index,
+                xpath_list,
+                args.jobs,
+                top_k=args.top_k,
+            )
+    except lib.EMLError as e:
+        log.error(str(e))
+        lib.plog(e.xml_frag, 'EML fragment', log.error)
+        return 1
+    except Exception:
+        log.exception('Unhandled exception')
+        return 1
+
+    for (pickle_path, xpath_str), result_dict in zip(STAT_TUP, result_list):
+        mk_stats.write_stats(
             pickle_path,
-            xpath_str,
-        ]
-        subprocess.Popen(cmd_list, stdout=subprocess.PIPE)
+            result_dict,
+            dict(vars(args), pickle=pickle_path, xpath=xpath_str),
+        )
+
+    m, s = divmod(time.time() - start_ts, 60)
+    log.debug(f'Elapsed: {int(m)}m {int(s)}s')
+
+    return 0
+
+
+def get_default_memory_mb():
+    try:
+        total_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return 8 * 1024
+    return int(total_bytes * DEFAULT_MEMORY_SHARE / 1024 / 1024)
+
+
+def read_config(config_path):
+    """Return the list of job dicts in the config file at {config_path}"""
+    try:
+        config_dict = json.loads(pathlib.Path(config_path).read_text(encoding='utf-8'))
+        config_list = config_dict['jobs']
+        for job_dict in config_list:
+            for key in 'pickle', 'xpath':
+                if not isinstance(job_dict.get(key), str):
+                    raise ValueError(f'Job without "{key}": {job_dict}')
+            if 'name' in job_dict and not isinstance(job_dict['name'], str):
+                raise ValueError(f'"name" must be a string: {job_dict}')
+            arg_list = job_dict.get('args', [])
+            if not isinstance(arg_list, list) or not all(
+                isinstance(arg_str, str) for arg_str in arg_list
+            ):
+                raise ValueError(f'"args" must be a list of strings: {job_dict}')
+            memory_mb = job_dict.get('memory_mb', DEFAULT_JOB_MEMORY_MB)
+            if type(memory_mb) is not int or memory_mb < 1:
+                raise ValueError(f'"memory_mb" must be a positive integer: {job_dict}')
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise lib.EMLError(f'Invalid config file: {config_path}: {e!r}')
+    return config_list
+
+
+def get_job_list(config_list, args):
+    """Return a Job for each job dict in {config_list}. The EML docs and cache options
+    in the command line {args} are passed on to each job."""
+    common_list = [
+        '--eml-root',
+        args.eml_root.as_posix(),
+        '--jobs',
+        str(get_job_worker_count(args.jobs, args.max_jobs, len(config_list))),
+    ]
+    if args.index:
+        common_list += ['--index', args.index.as_posix()]
+    if args.path_index:
+        common_list += ['--path-index', args.path_index.as_posix()]
+    if args.top_k:
+        common_list += ['--top-k', str(args.top_k)]
+    if args.no_cache:
+        common_list += ['--no-cache']
+    common_list += [
+        '--cache-dir',
+        args.cache_dir.as_posix(),
+        '--cache-size',
+        str(args.cache_size),
+    ]
+
+    job_list = []
+    for job_dict in config_list:
+        name = job_dict.get('name') or pathlib.Path(job_dict['pickle']).stem
+        if any(job.name == name for job in job_list):
+            raise lib.EMLError(f'Duplicate job name in config file: {name}')
+        job_list.append(
+            Job(
+                name,
+                [
+                    sys.executable,
+                    (lib.THIS_PATH / 'mk_stats.py').as_posix(),
+                    *common_list,
+                    *job_dict.get('args', []),
+                    job_dict['pickle'],
+                    job_dict['xpath'],
+                ],
+                job_dict.get('memory_mb', DEFAULT_JOB_MEMORY_MB),
+                args.log_dir / f'{name}.log',
+                args.limit_memory,
+            )
+        )
+    return job_list
+
+
+def get_job_worker_count(jobs, max_jobs, job_count):
+    """Return the number of worker processes to pass to each mk_stats.py run with
+    {jobs}. With 0, the cores are divided between the runs that can run at a time, as
+    set by {max_jobs} and the {job_count}."""
+    if jobs:
+        return jobs
+    return max(1, (os.cpu_count() or 1) // max(1, min(max_jobs, job_count)))
+
+
+class Job:
+    """A run of mk_stats.py with arguments {cmd_list}, expected to use {memory_mb}, with
+    output written to {log_path}. With {limit_memory}, the address space of each of its
+    processes is limited to {memory_mb}."""
+
+    def __init__(self, name, cmd_list, memory_mb, log_path, limit_memory=False):
+        self.name = name
+        self.cmd_list = cmd_list
+        self.memory_mb = memory_mb
+        self.log_path = log_path
+        self.limit_memory = limit_memory
+        self.returncode = None
+        self.elapsed_s = None
+        self._proc = None
+        self._start_ts = None
+
+    def start(self):
+        log.info(f'Starting: {self.name} ({self.memory_mb} MB)')
+        log.debug(' '.join(self.cmd_list))
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.log_path.open('wb') as f:
+            self._proc = subprocess.Popen(
+                self.cmd_list,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+                preexec_fn=self._set_memory_limit if self.limit_memory else None,
+            )
+        self._start_ts = time.time()
+
+    def _set_memory_limit(self):
+        # Runs in the child process before mk_stats.py is started. The limit is
+        # inherited by the worker processes of the run.
+        limit_bytes = self.memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+    def poll(self):
+        """Return True if the job has completed"""
+        self.returncode = self._proc.poll()
+        if self.returncode is None:
+            return False
+        self.elapsed_s = time.time() - self._start_ts
+        log.info(
+            f'{"Completed" if self.returncode == 0 else "Failed"}: {self.name} '
+            f'exit code={self.returncode} {self.elapsed_s:.1f}s'
+        )
+        return True
+
+    def terminate(self):
+        self._proc.terminate()
+        self._proc.wait()
+        self.poll()
+
+
+def run_jobs(job_list, max_jobs, memory_mb):
+    """Run the jobs in {job_list}, with at most {max_jobs} running at a time, and with
+    a total expected memory of at most {memory_mb}. See above."""
+    pending_list = sorted(job_list, key=lambda job: -job.memory_mb)
+    running_list = []
+    for job in pending_list:
+        if job.memory_mb > memory_mb:
+            log.warning(
+                f'Job needs more than --memory, and will run alone: {job.name} '
+                f'({job.memory_mb} MB)'
+            )
+    try:
+        while pending_list or running_list:
+            for job in list(pending_list):
+                if len(running_list) >= max_jobs:
+                    break
+                used_mb = sum(running_job.memory_mb for running_job in running_list)
+                if used_mb + job.memory_mb <= memory_mb or not running_list:
+                    pending_list.remove(job)
+                    job.start()
+                    running_list.append(job)
+            time.sleep(POLL_INTERVAL_S)
+            running_list = [job for job in running_list if not job.poll()]
+    finally:
+        for job in running_list:
+            log.warning(f'Terminating: {job.name}')
+            job.terminate()
+
+
+def log_summary(job_list, elapsed_s):
+    log.info('Summary:')
+    for job in job_list:
+        if job.returncode is None:
+            status_str = 'not run'
+        elif job.returncode == 0:
+            status_str = 'ok'
+        else:
+            status_str = f'failed ({job.returncode})'
+        elapsed_str = '' if job.elapsed_s is None else f'{job.elapsed_s:.1f}s'
+        log.info(
+            f'    {job.name:<30} {status_str:<12} {elapsed_str:>10} '
+            f'{job.memory_mb:>8} MB  {job.log_path.as_posix()}'
+        )
+    elapsed_list = [job.elapsed_s for job in job_list if job.elapsed_s is not None]
+    failed_count = sum(1 for job in job_list if job.returncode)
+    log.info(
+        f'Jobs: {len(job_list)} failed: {failed_count} '
+        f'total job time: {sum(elapsed_list):.1f}s elapsed: {elapsed_s:.1f}s'
+    )
 
 
 if __name__ == '__main__':
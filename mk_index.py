@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Create a corpus index listing the EML docs in a directory tree.
+
+The index is a text file with one line per EML doc, holding the size, modification time
+and path of the doc, after a header line holding the root of the directory tree. An
+index can only be used with the same root. The other tools accept the index with
+--index, and read the list of EML docs from it instead of searching the directory tree,
+which can take minutes on network file systems.
+
+The directory tree is scanned by a pool of threads. Run this again to pick up EML docs
+that were added or removed after the index was created.
+"""
+
+import logging
+import pathlib
+import sys
+
+import lib
+
+DEFAULT_INDEX_PATH = lib.THIS_PATH / 'eml-index.tsv'
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        '--eml-root',
+        metavar='path',
+        type=pathlib.Path,
+        default=lib.DEFAULT_EML_ROOT_DIR,
+        help="""Path to root of directory tree to search for EML docs
+            (extension must be \'.xml\')
+        """,
+    )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        default=DEFAULT_INDEX_PATH,
+        help='Path to the corpus index file to create. Replaced if it exists',
+    )
+    parser.add_argument(
+        '--threads',
+        metavar='N',
+        type=int,
+        default=lib.DEFAULT_INDEX_THREADS,
+        help='Number of threads to use for scanning directories',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    lib.build_eml_index(args.eml_root, args.index, args.threads)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Create an index of element paths and values for a collection of EML docs.
+
+This makes a single pass over the EML docs, and records the normalized path, tag and
+stripped text of each element in each doc in an SQLite database. The normalized path is
+the list of tags from the root element down to the element, without positions.
+
+mk_stats.py can then answer simple path queries, such as './/dataTable//*', with
+--path-index, by reading only the index. This turns new exploratory queries into a
+matter of seconds, instead of another full scan of the EML docs.
+
+The size and modification time of each EML doc are recorded in the index. Running this
+again with an existing index only parses EML docs that were added or changed since they
+were indexed, and removes docs that no longer exist, as mk_stats.py --incremental does.
+With --index, the corpus index is created again first, so that changes are detected.
+"""
+
+import json
+import logging
+import multiprocessing
+import pathlib
+import sqlite3
+import sys
+import time
+
+import lib
+
+DEFAULT_PATH_INDEX_PATH = lib.THIS_PATH / 'eml-paths.sqlite'
+
+# Number of EML docs in each batch of work sent to a worker process, and in each
+# database transaction.
+PATH_CHUNK_SIZE = 100
+
+SCHEMA_SQL = """
+create table if not exists doc (
+    id integer primary key,
+    path text unique not null,
+    size integer,
+    mtime_ns integer
+);
+create table if not exists node (
+    id integer primary key,
+    path text unique not null,
+    tag text not null
+);
+create table if not exists value (
+    id integer primary key,
+    text text unique not null
+);
+create table if not exists occurrence (
+    doc_id integer not null,
+    node_id integer not null,
+    value_id integer not null,
+    count integer not null
+);
+create index if not exists occurrence_node_idx on occurrence (node_id);
+create index if not exists occurrence_doc_idx on occurrence (doc_id);
+"""
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        '--eml-root',
+        metavar='path',
+        type=pathlib.Path,
+        default=lib.DEFAULT_EML_ROOT_DIR,
+        help="""Path to root of directory tree to search for EML docs
+            (extension must be \'.xml\'), or to a .tar, .tar.xz or .zip archive
+            holding EML docs
+        """,
+    )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
+    parser.add_argument(
+        '--path-index',
+        metavar='path',
+        type=pathlib.Path,
+        default=DEFAULT_PATH_INDEX_PATH,
+        help='Path to the SQLite path index to create or update',
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of worker processes to use. 0 uses one per available core',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    start_ts = time.time()
+
+    try:
+        add_all(
+            lib.eml_entry_gen(args.eml_root, args.index, refresh_index=True),
+            args.path_index,
+            args.jobs,
+        )
+    except lib.EMLError as e:
+        log.error(str(e))
+        lib.plog(e.xml_frag, 'EML fragment', log.error)
+        return 1
+    except Exception:
+        log.exception('Unhandled exception')
+        return 1
+    else:
+        m, s = divmod(time.time() - start_ts, 60)
+        log.debug(f'Elapsed: {int(m)}m {int(s)}s')
+
+    return 0
+
+
+def open_path_index(path_index_path):
+    conn = sqlite3.connect(path_index_path)
+    conn.executescript(SCHEMA_SQL)
+    col_set = {row[1] for row in conn.execute('pragma table_info(doc)')}
+    for col_str in 'size', 'mtime_ns':
+        # Indexes created before the sizes and modification times were recorded. The
+        # EML docs in them are indexed again on the next update.
+        if col_str not in col_set:
+            conn.execute(f'alter table doc add column {col_str} integer')
+    return conn
+
+
+def add_all(entry_iter, path_index_path, jobs=1):
+    """Update the path index at {path_index_path} to hold the EML docs in {entry_iter},
+    which holds (path, file_dict), as yielded by lib.eml_entry_gen().
+
+    EML docs that are not in the index are added. Docs for which the size or
+    modification time differs from the one recorded in the index are indexed again,
+    and docs in the index that are not in {entry_iter} are removed.
+    """
+    conn = open_path_index(path_index_path)
+    old_dict = {
+        path_str: (doc_id, size, mtime_ns)
+        for doc_id, path_str, size, mtime_ns in conn.execute(
+            'select id, path, size, mtime_ns from doc'
+        )
+    }
+    seen_set = set()
+    id_cache = IdCache(conn)
+    add_count = update_count = 0
+
+    def changed_gen():
+        for eml_path, file_dict in entry_iter:
+            path_str = eml_path.as_posix()
+            seen_set.add(path_str)
+            old_tup = old_dict.get(path_str)
+            if old_tup is None or old_tup[1:] != (
+                file_dict['size'],
+                file_dict['mtime_ns'],
+            ):
+                yield eml_path, file_dict
+
+    for doc_list in proc_doc_gen(changed_gen(), jobs):
+        with conn:
+            for path_str, file_dict, occurrence_dict in doc_list:
+                old_tup = old_dict.get(path_str)
+                if old_tup is None:
+                    add_count += 1
+                else:
+                    delete_doc(conn, old_tup[0])
+                    update_count += 1
+                add_doc(conn, id_cache, path_str, file_dict, occurrence_dict)
+
+    # All EML docs have been seen once the workers are done.
+    del_list = [
+        doc_id
+        for path_str, (doc_id, *_) in old_dict.items()
+        if path_str not in seen_set
+    ]
+    with conn:
+        for doc_id in del_list:
+            delete_doc(conn, doc_id)
+
+    conn.close()
+    log.info(
+        f'Path index EML docs added: {add_count} updated: {update_count} '
+        f'removed: {len(del_list)} unchanged: '
+        f'{len(seen_set) - add_count - update_count}'
+    )
+
+
+def proc_doc_gen(entry_iter, jobs=1):
+    """Yield lists of (path, file_dict, occurrence_dict) for chunks of the EML docs in
+    {entry_iter}."""
+    job_count = lib.get_job_count(jobs)
+    chunk_gen = lib.chunk_gen(entry_iter, PATH_CHUNK_SIZE)
+
+    if job_count == 1:
+        yield from map(proc_entry_list, chunk_gen)
+        return
+
+    with multiprocessing.Pool(job_count) as pool:
+        yield from pool.imap(proc_entry_list, chunk_gen)
+
+
+def proc_entry_list(entry_list):
+    return [
+        (p.as_posix(), file_dict, get_occurrence_dict(p)) for p, file_dict in entry_list
+    ]
+
+
+def get_occurrence_dict(eml_path):
+    """Return a dict of (tag_tup, text) to count for the elements below the root
+    element in the EML doc at {eml_path}"""
+    log.debug(eml_path)
+    occurrence_dict = {}
+    for tag_tup, text in lib.iter_tag_path(eml_path):
+        if len(tag_tup) > 1:
+            key = tag_tup, (text or '').strip()
+            occurrence_dict[key] = occurrence_dict.get(key, 0) + 1
+    return occurrence_dict
+
+
+def add_doc(conn, id_cache, path_str, file_dict, occurrence_dict):
+    doc_id = conn.execute(
+        'insert into doc (path, size, mtime_ns) values (?, ?, ?)',
+        (path_str, file_dict['size'], file_dict['mtime_ns']),
+    ).lastrowid
+    conn.executemany(
+        """
+        insert into occurrence (doc_id, node_id, value_id, count)
+        values (?, ?, ?, ?)
+        """,
+        (
+            (doc_id, id_cache.get_node_id(tag_tup), id_cache.get_value_id(text), count)
+            for (tag_tup, text), count in occurrence_dict.items()
+        ),
+    )
+
+
+def delete_doc(conn, doc_id):
+    """Remove the EML doc with {doc_id} and its occurrences from the path index. The
+    paths and values are kept, since they may be used by other docs."""
+    conn.execute('delete from occurrence where doc_id = ?', (doc_id,))
+    conn.execute('delete from doc where id = ?', (doc_id,))
+
+
+class IdCache:
+    """Map normalized paths and values to their ids in the path index, adding them to
+    the index as required."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._node_dict = {
+            path_str: node_id
+            for node_id, path_str in conn.execute('select id, path from node')
+        }
+        self._value_dict = {}
+
+    def get_node_id(self, tag_tup):
+        path_str = json.dumps(tag_tup)
+        node_id = self._node_dict.get(path_str)
+        if node_id is None:
+            node_id = self._node_dict[path_str] = self._conn.execute(
+                'insert into node (path, tag) values (?, ?)', (path_str, tag_tup[-1])
+            ).lastrowid
+        return node_id
+
+    def get_value_id(self, text):
+        value_id = self._value_dict.get(text)
+        if value_id is None:
+            row = self._conn.execute(
+                'select id from value where text = ?', (text,)
+            ).fetchone()
+            if row is None:
+                value_id = self._conn.execute(
+                    'insert into value (text) values (?)', (text,)
+                ).lastrowid
+            else:
+                value_id = row[0]
+            self._value_dict[text] = value_id
+        return value_id
+
+
+def query(path_index_path, xpath_list):
+    """Return a list of aggregates, one per XPath in {xpath_list}, from the path index
+    at {path_index_path}.
+
+    The aggregates are the same as those created by mk_stats.proc_all() for the EML
+    docs in the index. The XPaths must be simple paths, as handled by
+    lib.parse_simple_path().
+    """
+    step_list = []
+    for xpath_str in xpath_list:
+        step_tup = lib.parse_simple_path(xpath_str)
+        if step_tup is None:
+            raise lib.EMLError(
+                f'XPath is not supported by the path index: {xpath_str}'
+            )
+        step_list.append(step_tup)
+
+    conn = sqlite3.connect(
+        f'file:{pathlib.Path(path_index_path).as_posix()}?mode=ro', uri=True
+    )
+    node_list = [
+        (node_id, tuple(json.loads(path_str)), tag)
+        for node_id, path_str, tag in conn.execute('select id, path, tag from node')
+    ]
+    result_list = []
+    for step_tup in step_list:
+        node_tag_dict = {
+            node_id: tag
+            for node_id, tag_tup, tag in node_list
+            if lib.match_simple_path(step_tup, tag_tup)
+        }
+        result_list.append(query_nodes(conn, node_tag_dict))
+    conn.close()
+    return result_list
+
+
+def query_nodes(conn, node_tag_dict):
+    """Return an aggregate for the elements at the nodes in {node_tag_dict}"""
+    conn.execute('create temp table if not exists sel_node (id integer primary key)')
+    conn.execute('delete from sel_node')
+    conn.executemany(
+        'insert into sel_node (id) values (?)', ((i,) for i in node_tag_dict)
+    )
+    dst_el_dict = {}
+    for node_id, text, count in conn.execute(
+        """
+        select o.node_id, v.text, sum(o.count)
+        from occurrence o
+        join sel_node s on s.id = o.node_id
+        join value v on v.id = o.value_id
+        group by o.node_id, o.value_id
+        """
+    ):
+        tag_dict = dst_el_dict.setdefault(
+            node_tag_dict[node_id], {'tag_count': 0, 'unique_count': {}}
+        )
+        tag_dict['tag_count'] += count
+        tag_dict['unique_count'][text] = tag_dict['unique_count'].get(text, 0) + count
+    return dst_el_dict
+
+
+if __name__ == '__main__':
+    sys.exit(main())
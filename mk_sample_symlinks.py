@@ -12,8 +12,33 @@ tree when it's sufficient to process only a randomly selected subset instead of
 collection of EML docs.
 
 The symlinks are created as relative if possible. Relative symlinks will not break if
-they are in the same subtree, and the whole subtree is moved to another location.
+they are in the same subtree, and the whole subtree is moved to another location. The
+directory structure below --eml-root is recreated below --sample-root, so that the
+symlinks don't collide, and so that the tools see the same scopes and packages in the
+samples as in the full tree.
+
+The samples are selected in a single pass over the EML docs, without holding the list
+of all the docs. Each doc gets a random key that is derived from its path and --seed,
+and the docs with the lowest keys are kept. So the selection is reproducible for a
+given seed, and does not depend on the order in which the docs are found.
+
+With --stratify, the docs are grouped by scope, by package or by file size:
+
+- scope: The samples are divided between the scopes in proportion to the number of docs
+  in each scope, and are selected randomly within each scope.
+- package: Packages are selected randomly, and one random revision of each selected
+  package is used, so that packages with many revisions are not overrepresented.
+- size: As for scope, but grouped by the file size, rounded down to a power of 2.
+
+Stratifying by scope or package requires the EML docs to be at
+<scope>/<identifier>/<revision>/ below --eml-root, as in the PASTA repository, with
+numeric identifiers and revisions.
+
+If --sample-root is below --eml-root, the EML docs below --sample-root, which are the
+symlinks created by earlier runs, are not sampled.
 """
+import hashlib
+import heapq
 import logging
 import os
 import pathlib
@@ -49,12 +74,29 @@ def main():
             (extension must be \'.xml\')
         """,
     )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
     parser.add_argument(
         '--sample-root',
         type=pathlib.Path,
         default=DEFAULT_SAMPLE_ROOT_DIR,
         help='Directory in which to create the symlinks. Created if it does not exist',
     )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='Seed for selecting the samples. By default, a random seed is used',
+    )
+    parser.add_argument(
+        '--stratify',
+        choices=('scope', 'package', 'size'),
+        help='Group the EML docs by scope, package or file size when sampling',
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -68,27 +110,185 @@ def main():
         stream=sys.stdout,
     )
 
-    if not args.sample_root.exists():
-        args.sample_root.mkdir(parents=True)
+    if lib.is_archive(args.eml_root):
+        parser.error('Cannot create symlinks to EML docs in an archive')
+
+    seed = random.randrange(2**32) if args.seed is None else args.seed
+    log.info(f'Using seed: {seed}')
+
+    entry_iter = exclude_dir_gen(
+        lib.eml_entry_gen(args.eml_root, args.index, stat=args.stratify == 'size'),
+        args.sample_root,
+    )
+    try:
+        sample_list = get_sample_list(
+            entry_iter, args.eml_root, args.sample_count, seed, args.stratify
+        )
+    except lib.EMLError as e:
+        log.error(str(e))
+        return 1
+    if len(sample_list) < args.sample_count:
+        log.warning(f'Found only {len(sample_list)} EML docs')
+
+    try:
+        create_symlinks(sample_list, args.eml_root, args.sample_root)
+    except OSError as e:
+        log.error(str(e))
+        return 1
+
+    return 0
+
 
-    path_list = list(lib.eml_path_gen(args.eml_root))
-    log.debug(f'All count: {len(path_list)}')
-    sample_list = random.sample(path_list, args.sample_count)
+def get_sample_list(entry_iter, eml_root_path, sample_count, seed, stratify=None):
+    """Return a sorted list of paths to {sample_count} EML docs selected randomly from
+    {entry_iter}, which yields (path, file_dict) as returned by lib.eml_entry_gen().
+    See the module docstring for {stratify}."""
+    reservoir_dict = {}
+    doc_count_dict = {}
+    for eml_path, file_dict in entry_iter:
+        rel_path = eml_path.relative_to(eml_root_path)
+        if stratify is None:
+            stratum_str, group_str = '', rel_path.as_posix()
+        elif stratify == 'scope':
+            check_layout(rel_path, stratify)
+            stratum_str, group_str = rel_path.parts[0], rel_path.as_posix()
+        elif stratify == 'package':
+            check_layout(rel_path, stratify)
+            stratum_str, group_str = '', rel_path.parent.parent.as_posix()
+        elif stratify == 'size':
+            stratum_str = str(1 << file_dict['size'].bit_length() >> 1)
+            group_str = rel_path.as_posix()
+        else:
+            assert False, stratify
+        reservoir = reservoir_dict.get(stratum_str)
+        if reservoir is None:
+            reservoir = reservoir_dict[stratum_str] = Reservoir(sample_count, seed)
+        reservoir.add(group_str, eml_path)
+        doc_count_dict[stratum_str] = doc_count_dict.get(stratum_str, 0) + 1
+
+    log.info(f'Found EML docs: {sum(doc_count_dict.values())}')
+
+    sample_list = []
+    for stratum_str, stratum_count in get_allocation(
+        doc_count_dict, sample_count
+    ).items():
+        log.debug(
+            f'Stratum "{stratum_str}": docs={doc_count_dict[stratum_str]} '
+            f'samples={stratum_count}'
+        )
+        sample_list.extend(reservoir_dict[stratum_str].get_list(stratum_count))
+
+    return sorted(sample_list)
+
+
+def check_layout(rel_path, stratify):
+    """Raise EMLError if {rel_path} is not <scope>/<identifier>/<revision>/<file>, which
+    is required for stratifying by {stratify}."""
+    if len(rel_path.parts) != 4 or not all(p.isdigit() for p in rel_path.parts[1:3]):
+        raise lib.EMLError(
+            f'Cannot stratify by {stratify}. EML doc is not at '
+            f'<scope>/<identifier>/<revision>/ below --eml-root: {rel_path.as_posix()}'
+        )
+
+
+def exclude_dir_gen(entry_iter, dir_path):
+    """Yield the entries in {entry_iter} for EML docs that are not below {dir_path}"""
+    dir_path = pathlib.Path(os.path.abspath(dir_path))
+    for eml_path, file_dict in entry_iter:
+        if not pathlib.Path(os.path.abspath(eml_path)).is_relative_to(dir_path):
+            yield eml_path, file_dict
+
+
+def get_allocation(doc_count_dict, sample_count):
+    """Divide {sample_count} between the strata in proportion to their doc counts in
+    {doc_count_dict}, rounding by largest remainder."""
+    total_count = sum(doc_count_dict.values())
+    if total_count <= sample_count:
+        return dict(doc_count_dict)
+    alloc_dict = {}
+    remainder_list = []
+    for stratum_str, doc_count in doc_count_dict.items():
+        alloc_dict[stratum_str], remainder = divmod(
+            doc_count * sample_count, total_count
+        )
+        remainder_list.append((-remainder, stratum_str))
+    for _, stratum_str in sorted(remainder_list)[
+        : sample_count - sum(alloc_dict.values())
+    ]:
+        alloc_dict[stratum_str] += 1
+    return alloc_dict
+
+
+class Reservoir:
+    """Fixed size random sample of groups of items.
+
+    Keeps the {size} groups with the lowest keys, and the item with the lowest key in
+    each of them. Keys are hashes of the seed and the group or item, so the result does
+    not depend on the order in which the items are added.
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        # Max-heap of (-group key, group) for the kept groups.
+        self._heap = []
+        self._item_dict = {}
+
+    def add(self, group_str, item):
+        if group_str in self._item_dict:
+            item_key, _ = self._item_dict[group_str]
+            new_key = self.get_key(item.as_posix())
+            if new_key < item_key:
+                self._item_dict[group_str] = new_key, item
+            return
+        group_key = self.get_key(group_str)
+        if len(self._heap) >= self.size:
+            if not self._heap or group_key >= -self._heap[0][0]:
+                return
+            _, evicted_str = heapq.heappop(self._heap)
+            del self._item_dict[evicted_str]
+        heapq.heappush(self._heap, (-group_key, group_str))
+        self._item_dict[group_str] = self.get_key(item.as_posix()), item
+
+    def get_list(self, count):
+        """Return the items of the {count} groups with the lowest keys"""
+        return [
+            self._item_dict[group_str][1]
+            for _, group_str in heapq.nlargest(count, self._heap)
+        ]
+
+    def get_key(self, key_str):
+        return int.from_bytes(
+            hashlib.blake2b(
+                f'{self.seed}\0{key_str}'.encode('utf-8'), digest_size=8
+            ).digest(),
+            'big',
+        )
+
+
+def create_symlinks(sample_list, eml_root_path, sample_root_path):
+    """Create symlinks below {sample_root_path} to the EML docs in {sample_list},
+    mirroring their locations below {eml_root_path}."""
+    eml_root_path = pathlib.Path(os.path.abspath(eml_root_path))
+    sample_root_path = pathlib.Path(os.path.abspath(sample_root_path))
+    is_relative = sample_root_path.is_relative_to(eml_root_path)
+
+    link_list = []
     for src_path in sample_list:
-        dst_path = args.sample_root / src_path.name
+        src_path = pathlib.Path(os.path.abspath(src_path))
+        dst_path = sample_root_path / src_path.relative_to(eml_root_path)
+        if is_relative:
+            src_path = pathlib.Path(os.path.relpath(src_path, dst_path.parent))
+        link_list.append((src_path, dst_path))
 
-        if args.sample_root.is_relative_to(args.eml_root):
-            dst_path = dst_path.relative_to(src_path)
+    for dir_path in sorted({dst_path.parent for _, dst_path in link_list}):
+        dir_path.mkdir(parents=True, exist_ok=True)
 
+    for src_path, dst_path in link_list:
         log.debug(f'{dst_path} -> {src_path}')
+        os.symlink(src_path, dst_path)
 
-        try:
-            os.symlink(src_path, dst_path)
-        except EnvironmentError as e:
-            print(e)
-            return 1
-
-    return 0
+    log.info(f'Created symlinks: {len(link_list)}')
 
 
 if __name__ == '__main__':
@@ -11,18 +11,61 @@ another tool to further filter the data and print final results.
 As the intermediate file is expensive to create for large collections of EML doc, we
 store it with the utilities themselves, instead of in /tmp (which is not persistent
 across reboots).
+
+With --incremental, a manifest is stored next to the intermediate file. It holds the
+modification time, size and, optionally, a content hash for each EML doc, together with
+the contribution of the doc to the aggregates. On the next run with --incremental, only
+EML docs that were added or changed since the manifest was written are parsed, and the
+contributions of changed and deleted docs are subtracted from the aggregates. With
+--index, the corpus index is created again first, so that changes are detected.
+
+With --shard i/N, only the EML docs in shard i of N are processed, and the result is a
+partial stats file. The docs are assigned to shards by a hash of their path, so N hosts
+can each process one shard of the same collection, and the partial stats files can then
+be combined with merge_stats.py.
+
+Long running scans write a checkpoint next to the intermediate file at regular
+intervals, holding the partial aggregates and the position reached in the collection.
+A checkpoint is also written if the scan fails, and the path of the EML doc that failed
+is logged and recorded in the checkpoint. The scan can be continued from the last
+checkpoint with --resume, and with --skip-failed, the EML docs that failed are skipped.
+The checkpoint is removed when the scan completes.
+
+With --dedupe, the EML docs are first hashed, and the copies of each distinct doc are
+counted across the whole collection. Only the first copy is then parsed, and its
+contribution is added once for each copy, so the result is the same as without
+--dedupe, or, with --unique-only, once in total. With --dedupe normalized, the docs are
+hashed after parsing, ignoring text that only holds whitespace, so docs that only
+differ in indentation are also considered copies. Since each doc is parsed to be hashed,
+docs are hashed and processed in the same pass, and only copies within a chunk of EML
+docs are skipped. Scans with --dedupe are not checkpointed.
 """
 
+import collections
+import functools
+import itertools
 import logging
+import multiprocessing
 import pathlib
 import pickle
 import sys
 import time
 
+import checkpoint
 import lib
+import mk_path_index
+import query_client
+import result_cache
+import sketch
+import stats_file
+import telemetry
 
 THIS_PATH = pathlib.Path(__file__).parent.resolve()
 
+# Number of EML docs in each batch of work sent to a worker process when running with
+# --jobs.
+PATH_CHUNK_SIZE = 100
+
 log = logging.getLogger(__name__)
 
 
@@ -35,10 +78,18 @@ def main():
         metavar='path',
         type=pathlib.Path,
         default=lib.DEFAULT_EML_ROOT_DIR,
-        help="""Path to root of directory tree to search for EML docs 
-            (extension must be \'.xml\')
+        help="""Path to root of directory tree to search for EML docs
+            (extension must be \'.xml\'), or to a .tar, .tar.xz or .zip archive
+            holding EML docs
         """,
     )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
     parser.add_argument(
         'pickle',
         default='stats.pickle',
@@ -48,6 +99,156 @@ def main():
         'xpath',
         help='Selection for the elements to track',
     )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of worker processes to use. 0 uses one per available core',
+    )
+    parser.add_argument(
+        '--shard',
+        metavar='i/N',
+        type=lib.parse_shard,
+        help="""Only process the EML docs in shard i of N, with 1 <= i <= N, and write
+        a partial stats file. See merge_stats.py""",
+    )
+    parser.add_argument(
+        '--format',
+        choices=('pickle', 'compact'),
+        default='pickle',
+        help="""Format of the stats file. 'compact' is much smaller, and can be read
+        without loading it all into memory. It's written with suffix '.stats'""",
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help="""Stream the EML docs instead of parsing them to a DOM. This keeps memory
+        use flat for large docs. Only simple paths like './/dataTable//*' are supported
+        in this mode. Other XPaths fall back to parsing to a DOM""",
+    )
+    parser.add_argument(
+        '--read-ahead',
+        metavar='N',
+        type=int,
+        default=lib.DEFAULT_READ_AHEAD,
+        help="""Number of EML docs to read ahead of the parser, in a pool of threads,
+        so that reading and parsing overlap. 0 reads each EML doc when it's parsed.
+        Not used with --stream""",
+    )
+    parser.add_argument(
+        '--read-ahead-mb',
+        metavar='MB',
+        type=int,
+        default=lib.DEFAULT_READ_AHEAD_MB,
+        help='Max total size of EML docs that have been read ahead of the parser',
+    )
+    parser.add_argument(
+        '--dedupe',
+        choices=('raw', 'normalized'),
+        help="""Parse each distinct EML doc only once. 'raw' finds identical docs,
+        'normalized' also docs that only differ in text that only holds whitespace,
+        such as indentation""",
+    )
+    parser.add_argument(
+        '--unique-only',
+        action='store_true',
+        help='With --dedupe, count each distinct EML doc only once',
+    )
+    parser.add_argument(
+        '--top-k',
+        metavar='K',
+        type=int,
+        default=0,
+        help="""Only track approximate counts for the K most common values of each
+        element, together with an estimate of the number of unique values. This keeps
+        memory use fixed for elements with free text. 0 tracks all values exactly""",
+    )
+    parser.add_argument(
+        '--path-index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Answer the query from an index created by mk_path_index.py instead of
+        scanning the EML docs. Only simple paths like './/dataTable//*' are
+        supported""",
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="""Update the existing stats file, only processing EML docs that were
+        added, changed or deleted since it was created""",
+    )
+    parser.add_argument(
+        '--hash',
+        action='store_true',
+        help="""With --incremental, also compare content hashes, so that EML docs
+        that were touched without changing their contents are not processed again""",
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="""Always scan the EML docs, instead of returning a cached result for the
+        same query against an unchanged collection of EML docs. With the cache, the EML
+        docs are listed before the scan to detect changes, and --index is created
+        again""",
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='path',
+        type=pathlib.Path,
+        default=result_cache.DEFAULT_CACHE_DIR,
+        help='Directory in which to cache query results',
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        type=int,
+        default=result_cache.DEFAULT_CACHE_SIZE_MB,
+        help='Max total size of cached query results',
+    )
+    parser.add_argument(
+        '--server',
+        metavar='path',
+        type=pathlib.Path,
+        nargs='?',
+        const=query_client.DEFAULT_SOCKET_PATH,
+        help="""Send the query to the server started with query_server.py, listening
+        on this Unix socket, instead of processing the EML docs""",
+    )
+    parser.add_argument(
+        '--checkpoint',
+        metavar='MIN',
+        type=float,
+        default=checkpoint.DEFAULT_INTERVAL_MIN,
+        help="""Minutes between checkpoints of the partial aggregates. 0 disables
+        checkpoints. Scans with --dedupe are not checkpointed""",
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue from the last checkpoint, if there is one',
+    )
+    parser.add_argument(
+        '--skip-failed',
+        action='store_true',
+        help="""With --resume, skip the EML docs on which earlier runs failed, as
+        recorded in the checkpoint""",
+    )
+    parser.add_argument(
+        '--telemetry',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Write the parse, XPath and aggregate times for each EML doc, progress
+        with throughput and ETA, and the slowest EML docs, to this JSON lines file.
+        The ETA is only available with --index""",
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Profile the run with cProfile and write the stats to this file. With
+        --jobs, only the main process is profiled""",
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -64,18 +265,69 @@ def main():
     args = parser.parse_args()
     start_ts = time.time()
 
+    if args.incremental and args.top_k:
+        parser.error('--top-k cannot be combined with --incremental')
+
+    if args.path_index and (args.incremental or args.top_k):
+        parser.error('--path-index cannot be combined with --incremental or --top-k')
+
+    if args.server and (args.path_index or args.incremental or args.top_k):
+        parser.error(
+            '--server cannot be combined with --path-index, --incremental or --top-k'
+        )
+
+    if args.shard and (args.path_index or args.server):
+        parser.error('--shard cannot be combined with --path-index or --server')
+
+    if args.resume and (args.path_index or args.server or args.incremental):
+        parser.error(
+            '--resume cannot be combined with --path-index, --server or --incremental'
+        )
+
+    if args.dedupe and (
+        args.path_index or args.server or args.incremental or args.telemetry
+    ):
+        parser.error(
+            '--dedupe cannot be combined with --path-index, --server, --incremental '
+            'or --telemetry'
+        )
+
+    if args.skip_failed and not args.resume:
+        parser.error('--skip-failed requires --resume')
+
+    if args.dedupe and args.resume:
+        parser.error('--dedupe scans are not checkpointed, and cannot be resumed')
+
+    if args.unique_only and not args.dedupe:
+        parser.error('--unique-only requires --dedupe')
+
+    if args.telemetry and (args.path_index or args.incremental):
+        parser.error(
+            '--telemetry cannot be combined with --path-index or --incremental'
+        )
+
+    if args.stream and lib.parse_simple_path(args.xpath) is None:
+        log.warning(
+            f'XPath is not supported in --stream mode. Parsing to DOM: {args.xpath}'
+        )
+
     try:
-        result_dict = proc_all(args.eml_root, args.xpath)
+        with telemetry.profile(args.profile):
+            result_dict, manifest_dict = proc_args(args)
     except lib.EMLError as e:
         log.error(str(e))
         lib.plog(e.xml_frag, 'EML fragment', log.error)
+        return 1
     except Exception:
         log.exception('Unhandled exception')
+        return 1
     else:
-        pickle_path = pathlib.Path(args.pickle).with_suffix('.pickle')
-        result_dict['__args'] = vars(args)
-        pickle_path.write_bytes(pickle.dumps(result_dict))
-        log.debug(f'Wrote statistics to {pickle_path.as_posix()}')
+        write_stats(args.pickle, result_dict, vars(args), args.format)
+        if args.incremental:
+            write_manifest(get_stats_path(args.pickle, args.format), manifest_dict)
+        checkpoint.get_checkpoint_path(get_stats_path(args.pickle, args.format)).unlink(
+            missing_ok=True
+        )
 
         m, s = divmod(time.time() - start_ts, 60)
         log.debug(f'Elapsed: {int(m)}m {int(s)}s')
@@ -83,24 +335,826 @@ def main():
     return 0
 
 
-def proc_all(eml_root_path, root_xpath):
-    dst_el_dict = {}
+def proc_args(args):
+    """Return the aggregate, and the manifest if running with --incremental, for the
+    query set by the command line {args}."""
+    if args.path_index:
+        (result_dict,) = mk_path_index.query(args.path_index, [args.xpath])
+        return result_dict, None
+    if args.server:
+        (result_dict,) = query_client.query_stats(
+            args.server, args.eml_root, [args.xpath]
+        )
+        return result_dict, None
+    if args.incremental:
+        (result_dict,), manifest_dict = proc_incremental(
+            lib.eml_entry_gen(
+                args.eml_root, args.index, shard_tup=args.shard, refresh_index=True
+            ),
+            [args.xpath],
+            get_stats_path(args.pickle, args.format),
+            args.hash,
+            args.jobs,
+            args.stream,
+            read_ahead=args.read_ahead,
+            read_ahead_mb=args.read_ahead_mb,
+        )
+        return result_dict, manifest_dict
+
+    telemetry_obj = None
+    if args.telemetry:
+        total_count = telemetry.get_index_count(args.index)
+        if total_count and args.shard:
+            # The shards are close to equal in size, so this is good enough for the ETA.
+            total_count = -(-total_count // args.shard[1])
+        telemetry_obj = telemetry.Telemetry(args.telemetry, total_count)
+    checkpoint_obj = None if args.dedupe else get_checkpoint(args)
+    try:
+        if args.no_cache:
+            if telemetry_obj:
+                path_iter = telemetry_obj.path_gen(
+                    lib.eml_entry_gen(args.eml_root, args.index, shard_tup=args.shard)
+                )
+            else:
+                path_iter = lib.eml_path_gen(args.eml_root, args.index, args.shard)
+            (result_dict,) = proc_all(
+                path_iter,
+                [args.xpath],
+                args.jobs,
+                args.stream,
+                args.top_k,
+                telemetry_obj,
+                read_ahead=args.read_ahead,
+                read_ahead_mb=args.read_ahead_mb,
+                checkpoint_obj=checkpoint_obj,
+                dedupe=args.dedupe,
+                unique_only=args.unique_only,
+            )
+        else:
+            (result_dict,) = proc_all_cached(
+                result_cache.ResultCache(args.cache_dir, args.cache_size),
+                args.eml_root,
+                args.index,
+                [args.xpath],
+                args.jobs,
+                args.stream,
+                args.top_k,
+                telemetry_obj,
+                read_ahead=args.read_ahead,
+                read_ahead_mb=args.read_ahead_mb,
+                shard_tup=args.shard,
+                checkpoint_obj=checkpoint_obj,
+                dedupe=args.dedupe,
+                unique_only=args.unique_only,
+            )
+    finally:
+        if telemetry_obj is not None:
+            telemetry_obj.close()
+    return result_dict, None
+
+
+def get_checkpoint(args):
+    """Return the checkpoint for the scan set by the command line {args}, loaded from
+    the last checkpoint if running with --resume. Returns None if checkpoints are
+    disabled and the scan is not resumed."""
+    if args.checkpoint == 0 and not args.resume:
+        return None
+    checkpoint_obj = checkpoint.Checkpoint(
+        checkpoint.get_checkpoint_path(get_stats_path(args.pickle, args.format)),
+        {
+            'eml_root': pathlib.Path(args.eml_root).resolve().as_posix(),
+            'index': args.index and pathlib.Path(args.index).resolve().as_posix(),
+            'xpath': args.xpath,
+            'top_k': args.top_k,
+            'shard': args.shard,
+        },
+        args.checkpoint * 60,
+        args.skip_failed,
+    )
+    if args.resume:
+        checkpoint_obj.load()
+    elif checkpoint_obj.exists():
+        log.warning(
+            f'Not resuming from existing checkpoint. It will be replaced: '
+            f'{checkpoint_obj.checkpoint_path.as_posix()}'
+        )
+    return checkpoint_obj
+
+
+def proc_all(
+    path_iter,
+    xpath_list,
+    jobs=1,
+    stream=False,
+    top_k=0,
+    telemetry_obj=None,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+    checkpoint_obj=None,
+    dedupe=None,
+    unique_only=False,
+):
+    """Apply each XPath in {xpath_list} to all EML docs in {path_iter}.
+
+    Each EML doc is parsed only once, regardless of the number of XPaths. Returns a list
+    with one aggregate per XPath, in the same order as {xpath_list}.
+
+    With {jobs} other than 1, the EML docs are split into chunks that are processed in
+    a pool of worker processes. Each worker returns partial aggregates for its chunk,
+    which are merged into the final result.
+
+    With {stream}, EML docs are not parsed to a DOM, but streamed through
+    lib.iter_simple_path(), if all the XPaths are simple enough to support it.
+
+    With {top_k} other than 0, only approximate counts for the {top_k} most common
+    values of each tag are tracked. See sketch.finalize_stats() for the form of the
+    returned aggregates.
+
+    With {telemetry_obj}, a record with the stage times of each EML doc is added to it.
+    The sizes of the EML docs are only known if {path_iter} was created by
+    telemetry_obj.path_gen().
+
+    EML docs that are parsed to a DOM are read ahead of the parser as set by
+    {read_ahead} and {read_ahead_mb}. See lib.read_ahead_gen().
+
+    With {checkpoint_obj}, the scan starts from the position and aggregates loaded into
+    it, if any, and it's updated as the EML docs are processed.
+
+    With {dedupe}, each distinct EML doc is only processed once. See proc_dedupe().
+    Raises EMLError if {dedupe} is combined with {telemetry_obj} or {checkpoint_obj}.
+    """
+    if dedupe:
+        if telemetry_obj is not None or checkpoint_obj is not None:
+            raise lib.EMLError(
+                'Scans with dedupe do not support telemetry or checkpoints'
+            )
+        return proc_dedupe(
+            path_iter,
+            xpath_list,
+            dedupe == 'normalized',
+            unique_only,
+            jobs,
+            stream,
+            top_k,
+            read_ahead,
+            read_ahead_mb,
+        )
+
+    job_count = lib.get_job_count(jobs)
+    proc_func = functools.partial(
+        proc_path_list_timed if telemetry_obj else proc_path_list,
+        xpath_list=xpath_list,
+        stream=stream,
+        top_k=top_k,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+    )
+    merge_func = sketch.merge_stats if top_k else lib.merge_stats
+    dst_list = [{} for _ in xpath_list]
+
+    if checkpoint_obj is not None:
+        dst_list = checkpoint_obj.dst_list or dst_list
+        path_iter = checkpoint_obj.skip_gen(path_iter)
+
+    try:
+        if job_count == 1:
+            dst_list = proc_path_list(
+                path_iter,
+                xpath_list,
+                stream,
+                top_k,
+                telemetry_obj.add if telemetry_obj else None,
+                read_ahead,
+                read_ahead_mb,
+                dst_list,
+                checkpoint_obj,
+            )
+        else:
+            log.debug(f'Using {job_count} worker processes')
+            # The last path of each chunk that has been sent to the workers, in order.
+            last_path_deque = collections.deque()
+
+            with multiprocessing.Pool(job_count) as pool:
+                for part_list in pool.imap(
+                    proc_func, tracked_chunk_gen(path_iter, last_path_deque)
+                ):
+                    if telemetry_obj:
+                        part_list, doc_list = part_list
+                        for doc_dict in doc_list:
+                            telemetry_obj.add(doc_dict)
+                    for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+                        merge_func(dst_el_dict, part_el_dict)
+                    chunk_size, last_path = last_path_deque.popleft()
+                    if checkpoint_obj is not None:
+                        checkpoint_obj.update(last_path, dst_list, chunk_size)
+    except BaseException as e:
+        # dst_list holds the contributions up to the last position passed to the
+        # checkpoint.
+        if checkpoint_obj is not None:
+            checkpoint_obj.fail(dst_list, getattr(e, 'eml_path_str', None))
+        raise
+
+    if top_k:
+        dst_list = [sketch.finalize_stats(dst_el_dict) for dst_el_dict in dst_list]
+
+    return dst_list
+
+
+def proc_dedupe(
+    path_iter,
+    xpath_list,
+    normalize=False,
+    unique_only=False,
+    jobs=1,
+    stream=False,
+    top_k=0,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Like proc_all(), but only process the first copy of each distinct EML doc in
+    {path_iter}, and add its contribution once per copy, or, with {unique_only}, once
+    in total.
+
+    Without {normalize}, the EML docs are first hashed in the worker processes, and the
+    copies are counted across the whole collection by lib.get_first_copy_list(). Only
+    the first copy of each doc is then sent to the workers to be parsed, along with its
+    number of copies.
+
+    With {normalize}, a doc must be parsed to be hashed, so the docs are hashed and
+    processed in the same pass, as returned by proc_dedupe_list(). Copies within a chunk
+    of EML docs are only processed once. Copies in different chunks are each parsed in
+    their own chunk, and the parent adds or drops their contributions by the copies it
+    has seen so far. Revisions of a package are next to each other in the order in
+    which EML docs are found, so most copies are in the same chunk.
+    """
+    job_count = lib.get_job_count(jobs)
+    dup_counter = lib.DuplicateCounter()
+
+    if normalize:
+        proc_func = functools.partial(
+            proc_dedupe_list,
+            xpath_list=xpath_list,
+            normalize=True,
+            stream=stream,
+            read_ahead=read_ahead,
+            read_ahead_mb=read_ahead_mb,
+        )
+        dst_list = [{} for _ in xpath_list]
+
+        def merge_chunk(doc_list):
+            for hash_bytes, doc_count, part_list in doc_list:
+                if not dup_counter.add(hash_bytes, doc_count):
+                    if unique_only:
+                        continue
+                elif unique_only:
+                    doc_count = 1
+                for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+                    if doc_count > 1:
+                        lib.scale_stats(part_el_dict, doc_count)
+                    if top_k:
+                        sketch.add_stats(dst_el_dict, part_el_dict, top_k)
+                    else:
+                        lib.merge_stats(dst_el_dict, part_el_dict)
+
+        chunk_gen = lib.chunk_gen(path_iter, PATH_CHUNK_SIZE)
+        if job_count == 1:
+            for doc_list in map(proc_func, chunk_gen):
+                merge_chunk(doc_list)
+        else:
+            log.debug(f'Using {job_count} worker processes')
+            with multiprocessing.Pool(job_count) as pool:
+                for doc_list in pool.imap(proc_func, chunk_gen):
+                    merge_chunk(doc_list)
+    else:
+        first_list = lib.get_first_copy_list(
+            path_iter, dup_counter, jobs, PATH_CHUNK_SIZE, read_ahead, read_ahead_mb
+        )
+        path_count_list = [
+            (eml_path, 1 if unique_only else dup_counter.copy_dict[hash_bytes])
+            for eml_path, hash_bytes in first_list
+        ]
+        proc_func = functools.partial(
+            proc_count_list,
+            xpath_list=xpath_list,
+            stream=stream,
+            top_k=top_k,
+            read_ahead=read_ahead,
+            read_ahead_mb=read_ahead_mb,
+        )
+        merge_func = sketch.merge_stats if top_k else lib.merge_stats
+        dst_list = [{} for _ in xpath_list]
+
+        def merge_chunk(part_list):
+            for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+                merge_func(dst_el_dict, part_el_dict)
+
+        chunk_gen = lib.chunk_gen(path_count_list, PATH_CHUNK_SIZE)
+        if job_count == 1:
+            for part_list in map(proc_func, chunk_gen):
+                merge_chunk(part_list)
+        else:
+            log.debug(f'Using {job_count} worker processes')
+            with multiprocessing.Pool(job_count) as pool:
+                for part_list in pool.imap(proc_func, chunk_gen):
+                    merge_chunk(part_list)
+
+    dup_counter.log()
+
+    if top_k:
+        dst_list = [sketch.finalize_stats(dst_el_dict) for dst_el_dict in dst_list]
+
+    return dst_list
+
+
+def proc_count_list(
+    path_count_list,
+    xpath_list,
+    stream=False,
+    top_k=0,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Like proc_path_list(), for a list of (eml_path, doc_count), where the
+    contribution of each EML doc is added {doc_count} times"""
+    return proc_path_list(
+        [eml_path for eml_path, _ in path_count_list],
+        xpath_list,
+        stream,
+        top_k,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+        doc_count_list=[doc_count for _, doc_count in path_count_list],
+    )
+
+
+def proc_dedupe_list(
+    path_list,
+    xpath_list,
+    normalize=False,
+    stream=False,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Return (hash_bytes, doc_count, part_list) for each distinct EML doc in
+    {path_list}, in order of first copy. doc_count is the number of copies of the doc
+    in {path_list}, and part_list holds the contribution of a single copy for each
+    XPath in {xpath_list}. See lib.content_hash_gen() for {normalize}.
+    """
+    doc_proc = get_doc_proc(xpath_list, stream)
+    doc_dict = {}
+    for eml_doc, hash_bytes in lib.content_hash_gen(
+        path_list, normalize, read_ahead, read_ahead_mb
+    ):
+        if hash_bytes in doc_dict:
+            doc_dict[hash_bytes][0] += 1
+            continue
+        part_list = [{} for _ in xpath_list]
+        doc_proc(eml_doc, part_list)
+        # Drop the contents and parsed tree before the next doc.
+        eml_doc.tree = eml_doc.data_bytes = None
+        doc_dict[hash_bytes] = [1, part_list]
+    return [
+        (hash_bytes, doc_count, part_list)
+        for hash_bytes, (doc_count, part_list) in doc_dict.items()
+    ]
+
+
+def pending_path_gen(path_iter, pending_deque):
+    """Yield the paths in {path_iter}, and add each to {pending_deque} as it's
+    yielded"""
+    for eml_path in path_iter:
+        pending_deque.append(eml_path)
+        yield eml_path
+
+
+def tracked_chunk_gen(path_iter, last_path_deque):
+    """Yield chunks of the paths in {path_iter}, as lib.chunk_gen(), and add the size
+    and last path of each chunk to {last_path_deque} as it's yielded."""
+    for path_list in lib.chunk_gen(path_iter, PATH_CHUNK_SIZE):
+        last_path_deque.append((len(path_list), path_list[-1]))
+        yield path_list
+
+
+def proc_all_cached(
+    cache,
+    eml_root_path,
+    index_path,
+    xpath_list,
+    jobs=1,
+    stream=False,
+    top_k=0,
+    telemetry_obj=None,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+    shard_tup=None,
+    checkpoint_obj=None,
+    dedupe=None,
+    unique_only=False,
+):
+    """Like proc_all(), but return cached aggregates for XPaths that have already been
+    applied to the same collection of EML docs, and only scan the EML docs for the
+    rest. With {shard_tup}, only the EML docs in that shard are scanned.
+
+    The EML docs are listed once, and the same list is used both for the fingerprint
+    of the collection and for the scan. The corpus index at {index_path}, if any, is
+    created again, so that the fingerprint holds the current sizes and modification
+    times.
+    """
+    if lib.is_archive(eml_root_path):
+        entry_list = None
+        entry_iter = lib.eml_entry_gen(eml_root_path, shard_tup=shard_tup)
+    else:
+        entry_iter = entry_list = list(
+            lib.eml_entry_gen(
+                eml_root_path, index_path, shard_tup=shard_tup, refresh_index=True
+            )
+        )
+    if telemetry_obj:
+        path_iter = telemetry_obj.path_gen(entry_iter)
+    else:
+        path_iter = (eml_path for eml_path, _ in entry_iter)
+    fingerprint_str = result_cache.get_corpus_fingerprint(eml_root_path, entry_list)
+    key_list = [
+        result_cache.get_key(
+            xpath_str,
+            fingerprint_str,
+            top_k=top_k,
+            shard=shard_tup,
+            unique_only=unique_only,
+        )
+        for xpath_str in xpath_list
+    ]
+    result_list = [cache.get(key) for key in key_list]
+    miss_list = [i for i, result_dict in enumerate(result_list) if result_dict is None]
+
+    if miss_list:
+        part_list = proc_all(
+            path_iter,
+            [xpath_list[i] for i in miss_list],
+            jobs,
+            stream,
+            top_k,
+            telemetry_obj,
+            read_ahead,
+            read_ahead_mb,
+            checkpoint_obj,
+            dedupe,
+            unique_only,
+        )
+        for i, result_dict in zip(miss_list, part_list):
+            cache.put(key_list[i], result_dict)
+            result_list[i] = result_dict
+
+    return result_list
+
+
+def proc_path_list(
+    path_iter,
+    xpath_list,
+    stream=False,
+    top_k=0,
+    doc_func=None,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+    dst_list=None,
+    checkpoint_obj=None,
+    doc_count_list=None,
+):
+    """Return a list of aggregates for the EML docs in {path_iter}, one per XPath in
+    {xpath_list}.
+
+    With {top_k}, the aggregates are approximate, as created by sketch.add_stats(),
+    and the exact counts are only kept for one EML doc at a time.
+
+    With {doc_func}, it's called with the telemetry record of each EML doc.
+
+    With {dst_list}, the contributions of the EML docs are added to those aggregates.
+    With {checkpoint_obj}, it's updated after each EML doc, and {dst_list} only holds
+    the contributions of EML docs that were processed without errors.
+
+    With {doc_count_list}, holding a count for each EML doc in {path_iter}, the
+    contribution of each doc is added that number of times.
+
+    Raises EMLDocError, holding the path of the EML doc, if processing of a doc fails.
+    """
+    doc_proc = get_doc_proc(xpath_list, stream)
+    if dst_list is None:
+        dst_list = [{} for _ in xpath_list]
+
+    # EML docs that have been taken from path_iter but not yet processed, in order. The
+    # first one is the doc that is being processed.
+    pending_deque = collections.deque()
+    path_iter = pending_path_gen(path_iter, pending_deque)
+
+    if not is_stream(xpath_list, stream):
+        path_iter = lib.read_ahead_gen(path_iter, read_ahead, read_ahead_mb)
+
+    count_iter = iter(doc_count_list) if doc_count_list is not None else None
+
+    try:
+        for eml_path in path_iter:
+            doc_count = next(count_iter) if count_iter is not None else 1
+            if top_k:
+                part_list = [{} for _ in xpath_list]
+                time_tup = doc_proc(eml_path, part_list)
+                for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+                    if doc_count > 1:
+                        lib.scale_stats(part_el_dict, doc_count)
+                    sketch.add_stats(dst_el_dict, part_el_dict, top_k)
+            elif doc_count > 1 or checkpoint_obj is not None:
+                # A doc that fails part way must not leave partial contributions in
+                # the aggregates that are checkpointed.
+                part_list = [{} for _ in xpath_list]
+                time_tup = doc_proc(eml_path, part_list)
+                for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+                    if doc_count > 1:
+                        lib.scale_stats(part_el_dict, doc_count)
+                    lib.merge_stats(dst_el_dict, part_el_dict)
+            else:
+                time_tup = doc_proc(eml_path, dst_list)
+                # shared.merge_dict_set(dst_el_dict, el_dict)
+            if doc_func is not None:
+                doc_func(telemetry.get_doc_record(eml_path, time_tup))
+            if checkpoint_obj is not None:
+                checkpoint_obj.update(eml_path, dst_list)
+            pending_deque.popleft()
+    except lib.EMLDocError:
+        raise
+    except Exception as e:
+        path_str = pending_deque[0].as_posix() if pending_deque else None
+        log.exception(f'Failed on EML doc: {path_str}')
+        raise lib.EMLDocError(
+            f'Failed on EML doc: {path_str}: {e!r}',
+            path_str,
+            getattr(e, 'xml_frag', None),
+        ) from e
+
+    return dst_list
 
-    for eml_path in lib.eml_path_gen(eml_root_path):
-        proc_eml(eml_path, root_xpath, dst_el_dict)
-        # shared.merge_dict_set(dst_el_dict, el_dict)
 
-    return dst_el_dict
+def proc_path_list_timed(
+    path_list,
+    xpath_list,
+    stream=False,
+    top_k=0,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Like proc_path_list(), but also return the telemetry records of the EML docs"""
+    doc_list = []
+    dst_list = proc_path_list(
+        path_list,
+        xpath_list,
+        stream,
+        top_k,
+        doc_list.append,
+        read_ahead,
+        read_ahead_mb,
+    )
+    return dst_list, doc_list
+
+
+def proc_incremental(
+    entry_iter,
+    xpath_list,
+    stats_path,
+    use_hash,
+    jobs=1,
+    stream=False,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Update the aggregates stored in {stats_path} for EML docs that were added,
+    changed or deleted since the aggregates were created. {entry_iter} yields (path,
+    file_dict) for each EML doc, as returned by lib.eml_entry_gen().
+
+    Returns the updated aggregates, and the updated manifest. If there is no usable
+    manifest for the aggregates, all the EML docs are processed.
+    """
+    result_list, manifest_dict = read_manifest(stats_path, xpath_list)
+    doc_dict = manifest_dict['doc_dict']
+    new_doc_dict = {}
+    changed_list = []
+
+    for eml_path, file_dict in entry_iter:
+        path_str = eml_path.as_posix()
+        old_dict = doc_dict.pop(path_str, None)
+        if old_dict is not None:
+            if is_unchanged(eml_path, old_dict, file_dict, use_hash):
+                new_doc_dict[path_str] = dict(old_dict, **file_dict)
+                continue
+            sub_stats_list(result_list, old_dict['part_list'])
+        if use_hash and 'hash' not in file_dict:
+            file_dict['hash'] = lib.get_file_hash(eml_path)
+        changed_list.append((eml_path, file_dict))
+
+    for path_str, old_dict in doc_dict.items():
+        log.debug(f'Removing deleted EML doc: {path_str}')
+        sub_stats_list(result_list, old_dict['part_list'])
+
+    log.info(
+        f'EML docs: unchanged={len(new_doc_dict)} '
+        f'added_or_changed={len(changed_list)} deleted={len(doc_dict)}'
+    )
+
+    for (eml_path, file_dict), part_list in zip(
+        changed_list,
+        proc_doc_gen(
+            [eml_path for eml_path, _ in changed_list],
+            xpath_list,
+            jobs,
+            stream,
+            read_ahead,
+            read_ahead_mb,
+        ),
+    ):
+        for dst_el_dict, part_el_dict in zip(result_list, part_list):
+            lib.merge_stats(dst_el_dict, part_el_dict)
+        new_doc_dict[eml_path.as_posix()] = dict(file_dict, part_list=part_list)
+
+    return result_list, {
+        'xpath_list': list(xpath_list),
+        'result_list': result_list,
+        'doc_dict': new_doc_dict,
+    }
+
+
+def is_unchanged(eml_path, old_dict, file_dict, use_hash):
+    if (old_dict['size'], old_dict['mtime_ns']) == (
+        file_dict['size'],
+        file_dict['mtime_ns'],
+    ):
+        return True
+    if not use_hash or old_dict.get('hash') is None:
+        return False
+    file_dict['hash'] = lib.get_file_hash(eml_path)
+    return file_dict['hash'] == old_dict['hash']
+
+
+def sub_stats_list(dst_list, part_list):
+    for dst_el_dict, part_el_dict in zip(dst_list, part_list):
+        lib.sub_stats(dst_el_dict, part_el_dict)
+
+
+def proc_doc_gen(
+    path_list,
+    xpath_list,
+    jobs=1,
+    stream=False,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    """Yield a list of aggregates for each EML doc in {path_list}, holding the
+    contribution of the doc for each XPath in {xpath_list}."""
+    job_count = lib.get_job_count(jobs)
+    proc_func = functools.partial(
+        proc_doc_list,
+        xpath_list=xpath_list,
+        stream=stream,
+        read_ahead=read_ahead,
+        read_ahead_mb=read_ahead_mb,
+    )
+    chunk_gen = lib.chunk_gen(path_list, PATH_CHUNK_SIZE)
+
+    if job_count == 1:
+        for doc_list in map(proc_func, chunk_gen):
+            yield from doc_list
+        return
+
+    with multiprocessing.Pool(job_count) as pool:
+        for doc_list in pool.imap(proc_func, chunk_gen):
+            yield from doc_list
+
+
+def proc_doc_list(
+    path_list,
+    xpath_list,
+    stream=False,
+    read_ahead=lib.DEFAULT_READ_AHEAD,
+    read_ahead_mb=lib.DEFAULT_READ_AHEAD_MB,
+):
+    doc_proc = get_doc_proc(xpath_list, stream)
+    if not is_stream(xpath_list, stream):
+        path_list = lib.read_ahead_gen(path_list, read_ahead, read_ahead_mb)
+    doc_list = []
+    for eml_path in path_list:
+        part_list = [{} for _ in xpath_list]
+        doc_proc(eml_path, part_list)
+        doc_list.append(part_list)
+    return doc_list
+
+
+def get_manifest_path(stats_path):
+    return pathlib.Path(stats_path).with_suffix('.manifest.pickle')
+
 
+def get_stats_path(stats_path, format_str='pickle'):
+    if format_str == 'compact':
+        return pathlib.Path(stats_path).with_suffix(stats_file.STATS_FILE_SUFFIX)
+    return pathlib.Path(stats_path).with_suffix('.pickle')
 
-def proc_eml(eml_path, root_xpath, dst_el_dict):
+
+def read_manifest(stats_path, xpath_list):
+    """Return the stored aggregates and manifest for {stats_path}, or empty ones if
+    they don't exist or were created with other XPaths.
+
+    The manifest holds the aggregate for each XPath in {xpath_list}, in order. Manifests
+    written before the aggregates were stored in them can only be used for a single
+    XPath, for which the aggregate is read from {stats_path}.
+    """
+    empty_tup = [{} for _ in xpath_list], {'xpath_list': xpath_list, 'doc_dict': {}}
+    manifest_path = get_manifest_path(stats_path)
+    if not (stats_path.exists() and manifest_path.exists()):
+        log.info('No existing stats and manifest. Processing all EML docs')
+        return empty_tup
+    manifest_dict = pickle.loads(manifest_path.read_bytes())
+    if manifest_dict['xpath_list'] != list(xpath_list):
+        log.info('Stats were created for other XPaths. Processing all EML docs')
+        return empty_tup
+    if 'result_list' in manifest_dict:
+        return manifest_dict['result_list'], manifest_dict
+    if len(xpath_list) != 1:
+        log.info('Manifest holds no aggregates. Processing all EML docs')
+        return empty_tup
+    return [stats_file.load_stats_dict(stats_path)], manifest_dict
+
+
+def write_manifest(stats_path, manifest_dict):
+    manifest_path = get_manifest_path(stats_path)
+    manifest_path.write_bytes(pickle.dumps(manifest_dict))
+    log.debug(f'Wrote manifest to {manifest_path.as_posix()}')
+
+
+def write_stats(stats_path, result_dict, args_dict, format_str='pickle'):
+    stats_path = get_stats_path(stats_path, format_str)
+    if format_str == 'compact':
+        stats_file.write_compact(stats_path, result_dict, args_dict)
+    else:
+        stats_path.write_bytes(pickle.dumps(dict(result_dict, __args=args_dict)))
+    log.debug(f'Wrote statistics to {stats_path.as_posix()}')
+
+
+def get_doc_proc(xpath_list, stream=False):
+    """Return a function that adds the contribution of a single EML doc to a list of
+    aggregates, one per XPath in {xpath_list}, and returns the time spent in each
+    stage, as returned by proc_eml().
+
+    With {stream}, the EML doc is streamed if all the XPaths are simple paths supported
+    by lib.iter_simple_path(). Otherwise, the EML doc is parsed to a DOM, and the
+    XPaths are applied to that.
+    """
+    if is_stream(xpath_list, stream):
+        step_list = [lib.parse_simple_path(xpath_str) for xpath_str in xpath_list]
+        return lambda eml_path, dst_list: proc_eml_stream(eml_path, step_list, dst_list)
+    xpath_obj_list = [lib.compile_xpath(xpath_str) for xpath_str in xpath_list]
+    return lambda eml_path, dst_list: proc_eml(eml_path, xpath_obj_list, dst_list)
+
+
+def is_stream(xpath_list, stream):
+    """Return True if EML docs are streamed for {xpath_list}. See get_doc_proc()"""
+    return stream and all(
+        lib.parse_simple_path(xpath_str) is not None for xpath_str in xpath_list
+    )
+
+
+def proc_eml_stream(eml_path, step_list, dst_list):
+    """Like proc_eml(), but streams the EML doc. Parsing, matching and counting are
+    interleaved, so all the time is returned as parse time."""
+    log.debug('-' * 100)
+    log.debug(eml_path)
+
+    start_ts = time.perf_counter()
+    for match_list, tag, text in lib.iter_simple_path(eml_path, step_list):
+        text = (text or '').strip()
+        for dst_el_dict in itertools.compress(dst_list, match_list):
+            count_el(dst_el_dict, tag, text)
+    return time.perf_counter() - start_ts, 0.0, 0.0
+
+
+def proc_eml(eml_path, xpath_list, dst_list):
+    """Add the elements matched by each XPath in {xpath_list} to the aggregates in
+    {dst_list}. Returns the seconds spent parsing, applying XPaths and aggregating."""
     log.debug('-' * 100)
     log.debug(eml_path)
 
+    start_ts = time.perf_counter()
     root_el = lib.get_eml_tree(eml_path)
-    el_list = lib.xpath(root_el, root_xpath, full_path=True)
+    parse_ts = time.perf_counter()
+    xpath_s = aggregate_s = 0.0
+
+    for xpath_obj, dst_el_dict in zip(xpath_list, dst_list):
+        xpath_ts = time.perf_counter()
+        el_list = lib.xpath(root_el, xpath_obj)
+        aggregate_ts = time.perf_counter()
+        proc_el_list(el_list, dst_el_dict)
+        xpath_s += aggregate_ts - xpath_ts
+        aggregate_s += time.perf_counter() - aggregate_ts
 
-    for el, el_path in el_list:
+    return parse_ts - start_ts, xpath_s, aggregate_s
+
+
+def proc_el_list(el_list, dst_el_dict):
+    for el in el_list:
         text = (getattr(el, 'text', '') or '').strip()
         # if text or :
         # log.debug(f'url: {shared.get_dt_url(el)}')
@@ -109,13 +1163,14 @@ def proc_eml(eml_path, root_xpath, dst_el_dict):
         # el_dict = shared.get_element_dict(el)
         # shared.merge_dict_set(D, el_dict)
         #     el = shared.get_el(el)
-        el = el.tag
-        dst_el_dict.setdefault(el, {'tag_count': 0, 'unique_count': {}})
-        dst_el_dict[el]['unique_count'].setdefault(text, 0)
-        dst_el_dict[el]['tag_count'] += 1
-        dst_el_dict[el]['unique_count'][text] += 1
+        count_el(dst_el_dict, el.tag, text)
+
 
-    # return D
+def count_el(dst_el_dict, el, text):
+    dst_el_dict.setdefault(el, {'tag_count': 0, 'unique_count': {}})
+    dst_el_dict[el]['unique_count'].setdefault(text, 0)
+    dst_el_dict[el]['tag_count'] += 1
+    dst_el_dict[el]['unique_count'][text] += 1
 
 
 if __name__ == '__main__':
@@ -7,14 +7,29 @@ This reads aggregated query results from an intermediate file created by another
 applies simple filters as defined by the command line parameters, and pretty prints the
 results. Since it works against previously created aggregations, it enables filters to
 be quickly checked and adjusted when examining the results.
+
+The filters are applied before the values are ordered, and only the --top values for
+each element are selected from the remaining ones, so the values are never fully sorted.
+Results are written as each element is processed.
+
+With --output-format csv, a row is written for each value, with columns tag,
+tag_count, value, count and count_error. With --output-format json, a JSON object is
+written on a separate line for each element, holding the element, the tag count and a
+list of [value, count] pairs.
 """
 
+import contextlib
+import csv
+import heapq
+import itertools
+import json
 import logging
+import os
 import pathlib
-import pickle
 import sys
 
 import lib
+import stats_file
 
 log = logging.getLogger(__name__)
 
@@ -30,7 +45,13 @@ def main():
     )
     parser.add_argument(
         'pickle',
-        help='Stats pickle file',
+        help='Stats file, in pickle or compact format',
+    )
+    parser.add_argument(
+        '--tag',
+        action='append',
+        help="""Only print this element. Can be repeated. With stats files in the
+        compact format, only the values for the selected elements are read""",
     )
     parser.add_argument(
         '--values',
@@ -56,6 +77,19 @@ def main():
         default=DEFAULT_TOP_VALUES,
         help='Only print the top N values for each element',
     )
+    parser.add_argument(
+        '--output-format',
+        choices=('text', 'csv', 'json'),
+        default='text',
+        help="""Format of the results. 'text' is written to the debug level log,
+        'csv' and 'json' to --output""",
+    )
+    parser.add_argument(
+        '--output',
+        metavar='path',
+        type=pathlib.Path,
+        help='File to which to write csv and json results. Default is stdout',
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -63,53 +97,142 @@ def main():
     )
     args = parser.parse_args()
 
+    # Keep the log out of csv and json results written to stdout.
+    is_stdout_output = args.output_format != 'text' and not args.output
     logging.basicConfig(
         format='%(levelname)8s %(message)s',
         level=logging.DEBUG if args.debug else logging.INFO,
-        stream=sys.stdout,
+        stream=sys.stderr if is_stdout_output else sys.stdout,
     )
 
-    pickle_path = pathlib.Path(args.pickle)
-    stats_dict = pickle.loads(pickle_path.read_bytes())
+    stats_path = pathlib.Path(args.pickle)
+    stats_dict, args_dict = stats_file.read_stats(stats_path)
+    is_sorted = isinstance(stats_dict, stats_file.CompactStats)
 
     lib.plog(
-        stats_dict.get('__args', 'unk'),
+        args_dict or 'unk',
         'Stats were genereated with params',
         log.debug,
     )
 
-    try:
-        del stats_dict['__args']
-    except KeyError:
-        pass
-
-    lib.plog(stats_dict.keys(), 'Keys in stats dict', log.debug)
-
-    # plog(stats_dict)
-
-    def k(x):
-        # print(x)
-        return -x[1]
-
-    for el_path, tag_dict in stats_dict.items():
-        printed_count = 0
-        if len(tag_dict) >= args.values:
-            first = True
-            for text_str, value_count in sorted(
-                tag_dict['unique_count'].items(), key=k
-            ):
-                if value_count >= args.occurences and len(text_str) <= args.length:
-                    if first:
-                        log.debug('')
-                        log.debug(f'{tag_dict["tag_count"]:8} {el_path}:')
-                        first = False
-
-                    log.debug(f'    {value_count:8} {text_str}')
-                    printed_count += 1
-                    if args.top > 0 and args.top == printed_count:
-                        break
+    lib.plog(list(stats_dict.keys()), 'Keys in stats dict', log.debug)
+
+    if args.tag:
+        tag_list = [tag for tag in args.tag if tag in stats_dict]
+    else:
+        tag_list = list(stats_dict.keys())
+
+    report_gen = get_report_gen(stats_dict, tag_list, args, is_sorted)
+
+    if args.output_format == 'text':
+        print_report(report_gen)
+    else:
+        try:
+            with (
+                args.output.open('w', newline='', encoding='utf-8')
+                if args.output
+                else contextlib.nullcontext(sys.stdout)
+            ) as f:
+                if args.output_format == 'csv':
+                    write_csv(f, report_gen)
+                else:
+                    write_json(f, report_gen)
+                f.flush()
+        except BrokenPipeError:
+            # The reader of stdout, such as head, exited before reading all the
+            # results. Point stdout at devnull, so that flushing it at exit does not
+            # fail again.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+
     return 0
 
 
+def print_stats(stats_dict, tag_list, args, is_sorted=False):
+    """Print the values for the tags in {tag_list}, filtered as set by {args}. With
+    {is_sorted}, values are assumed to already be ordered by descending count."""
+    print_report(get_report_gen(stats_dict, tag_list, args, is_sorted))
+
+
+def get_report_gen(stats_dict, tag_list, args, is_sorted=False):
+    """Yield (el_path, tag_dict, value_list) for each tag in {tag_list} that has
+    values remaining after applying the filters in {args}. value_list holds the
+    selected (text, count) pairs, highest count first."""
+    for el_path in tag_list:
+        tag_dict = stats_dict[el_path]
+        if len(tag_dict['unique_count']) < args.values:
+            continue
+        value_list = select_values(tag_dict['unique_count'], args, is_sorted)
+        if value_list:
+            yield el_path, tag_dict, value_list
+
+
+def select_values(unique_dict, args, is_sorted=False):
+    """Return the top values in {unique_dict} that pass the filters in {args}"""
+    value_iter = (
+        (text_str, value_count)
+        for text_str, value_count in unique_dict.items()
+        if value_count >= args.occurences and len(text_str) <= args.length
+    )
+    if is_sorted:
+        # Values in the compact format are already ordered by count.
+        if args.top > 0:
+            value_iter = itertools.islice(value_iter, args.top)
+        return list(value_iter)
+    if args.top > 0:
+        return heapq.nlargest(args.top, value_iter, key=lambda x: x[1])
+    return sorted(value_iter, key=lambda x: x[1], reverse=True)
+
+
+def print_report(report_gen):
+    for el_path, tag_dict, value_list in report_gen:
+        log.debug('')
+        log.debug(f'{tag_dict["tag_count"]:8} {el_path}:')
+        if 'unique_estimate' in tag_dict:
+            log.debug(
+                f'    Approximate. Unique values: ~{tag_dict["unique_estimate"]}'
+            )
+        for text_str, value_count in value_list:
+            if 'count_error' in tag_dict:
+                error_count = tag_dict['count_error'][text_str]
+                log.debug(f'    {value_count:8} (-{error_count}) {text_str}')
+            else:
+                log.debug(f'    {value_count:8} {text_str}')
+
+
+def write_csv(f, report_gen):
+    writer = csv.writer(f)
+    writer.writerow(('tag', 'tag_count', 'value', 'count', 'count_error'))
+    for el_path, tag_dict, value_list in report_gen:
+        error_dict = tag_dict.get('count_error', {})
+        for text_str, value_count in value_list:
+            writer.writerow(
+                (
+                    el_path,
+                    tag_dict['tag_count'],
+                    text_str,
+                    value_count,
+                    error_dict.get(text_str, ''),
+                )
+            )
+
+
+def write_json(f, report_gen):
+    for el_path, tag_dict, value_list in report_gen:
+        tag_json = {
+            'tag': el_path,
+            'tag_count': tag_dict['tag_count'],
+            'values': value_list,
+        }
+        if 'count_error' in tag_dict:
+            tag_json['count_error'] = {
+                text_str: tag_dict['count_error'][text_str]
+                for text_str, _ in value_list
+            }
+        if 'unique_estimate' in tag_dict:
+            tag_json['unique_estimate'] = tag_dict['unique_estimate']
+        f.write(json.dumps(tag_json) + '\n')
+
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Client for the query server in query_server.py.
+
+Requests and responses are JSON objects, each on a single line, and each connection
+carries a single request.
+
+Run as a command, this shows the state of the server with 'info', or makes the server
+find and parse the EML docs again with 'reload', for instance after EML docs have been
+added or changed.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import socket
+import sys
+
+import lib
+
+DEFAULT_SOCKET_PATH = lib.THIS_PATH / '___query.sock'
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        'command',
+        choices=('info', 'reload'),
+        help='Request to send to the server',
+    )
+    parser.add_argument(
+        '--socket',
+        metavar='path',
+        type=pathlib.Path,
+        default=DEFAULT_SOCKET_PATH,
+        help='Path of the Unix socket on which the server listens',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    try:
+        if args.command == 'info':
+            info_dict = get_info(args.socket)
+        else:
+            info_dict = reload(args.socket)
+    except lib.EMLError as e:
+        log.error(str(e))
+        return 1
+    except OSError as e:
+        log.error(f'Cannot connect to query server: {args.socket.as_posix()}: {e!r}')
+        return 1
+    except Exception:
+        log.exception('Unhandled exception')
+        return 1
+
+    for key, value in info_dict.items():
+        print(f'{key}: {value}')
+
+    return 0
+
+
+def request(socket_path, request_dict):
+    """Send {request_dict} to the server listening on {socket_path}, and return the
+    response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(os.fspath(socket_path))
+        sock.sendall(json.dumps(request_dict).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            response_dict = json.loads(f.readline())
+    if 'error' in response_dict:
+        raise lib.EMLError(f'Query server error: {response_dict["error"]}')
+    return response_dict
+
+
+def get_info(socket_path):
+    """Return the number of EML docs held by the server at {socket_path}, and the state
+    of its cache of parsed trees"""
+    return request(socket_path, {'op': 'info'})
+
+
+def reload(socket_path):
+    """Make the server at {socket_path} find and parse the EML docs again, and return
+    the same as get_info()"""
+    return request(socket_path, {'op': 'reload'})
+
+
+def query_stats(socket_path, eml_root_path, xpath_list):
+    """Return aggregates for {xpath_list} from the server at {socket_path}. EML docs
+    that the server could not parse are skipped, and logged."""
+    response_dict = request(
+        socket_path,
+        {
+            'op': 'stats',
+            'eml_root': os.path.abspath(eml_root_path),
+            'xpath_list': list(xpath_list),
+        },
+    )
+    for path_str in response_dict.get('failed_list', []):
+        log.warning(f'Skipped EML doc that the server could not parse: {path_str}')
+    return response_dict['result_list']
+
+
+def query_xpath(socket_path, path_iter, xpath_list, only_text):
+    """Return results as created by xpath.proc_path_list() from the server at
+    {socket_path}"""
+    path_list = []
+    for eml_path in path_iter:
+        if isinstance(eml_path, lib.ArchiveMember):
+            raise lib.EMLError('The query server cannot serve EML docs in an archive')
+        path_list.append(os.path.abspath(eml_path))
+    return request(
+        socket_path,
+        {
+            'op': 'xpath',
+            'xpath_list': list(xpath_list),
+            'path_list': path_list,
+            'only_text': only_text,
+        },
+    )['doc_list']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
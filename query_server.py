@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# language=markdown
+"""Serve XPath and aggregate queries from EML docs kept parsed in memory.
+
+When exploring a collection or sample set of EML docs, the same docs are parsed again on
+every run of xpath.py and mk_stats.py. This server loads the EML docs once, keeps the
+parsed trees in memory, and answers the same queries as the tools, without parsing.
+
+The trees are kept in an LRU cache with a configurable memory budget. The memory used by
+a tree is estimated from the decompressed size of the EML doc. EML docs that don't fit
+in the budget are parsed again when they are queried. EML docs are parsed with the same
+parser settings as by mk_stats.py, so the results match.
+
+The server listens on a Unix socket. xpath.py and mk_stats.py send their queries to the
+server, using query_client.py, instead of processing the EML docs themselves when
+they're run with --server. mk_stats.py queries must be for the same --eml-root as the
+server. xpath.py queries may be for any EML docs, which are then added to the cache.
+"""
+
+import collections
+import json
+import logging
+import os
+import pathlib
+import socketserver
+import stat
+import sys
+import time
+
+import lxml.etree
+
+import lib
+import mk_stats
+import query_client
+import xpath
+
+DEFAULT_MEMORY_MB = 2048
+
+# Approximate ratio between the memory used by a parsed tree and the decompressed size
+# of the EML doc.
+TREE_MEMORY_FACTOR = 8
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = lib.ArgumentParser(
+        description=__doc__,
+    )
+    parser.add_argument(
+        '--eml-root',
+        metavar='path',
+        type=pathlib.Path,
+        default=lib.DEFAULT_EML_ROOT_DIR,
+        help="""Path to root of directory tree to search for EML docs
+            (extension must be \'.xml\')
+        """,
+    )
+    parser.add_argument(
+        '--index',
+        metavar='path',
+        type=pathlib.Path,
+        help="""Path to corpus index file listing the EML docs below --eml-root. The
+        index is created if it does not exist. See mk_index.py""",
+    )
+    parser.add_argument(
+        '--socket',
+        metavar='path',
+        type=pathlib.Path,
+        default=query_client.DEFAULT_SOCKET_PATH,
+        help='Path of the Unix socket on which to listen',
+    )
+    parser.add_argument(
+        '--memory',
+        metavar='MB',
+        type=int,
+        default=DEFAULT_MEMORY_MB,
+        help='Approximate max memory to use for parsed EML docs',
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Debug level logging',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(levelname)8s %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO,
+        stream=sys.stdout,
+    )
+
+    if lib.is_archive(args.eml_root):
+        parser.error('The server cannot serve EML docs in an archive')
+
+    if args.socket.exists():
+        if not stat.S_ISSOCK(args.socket.lstat().st_mode):
+            parser.error(f'Not a socket: {args.socket.as_posix()}')
+        args.socket.unlink()
+
+    corpus = Corpus(args.eml_root, args.index, args.memory)
+    corpus.load()
+
+    with QueryServer(args.socket.as_posix(), corpus) as server:
+        log.info(f'Listening on {args.socket.as_posix()}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            args.socket.unlink(missing_ok=True)
+
+    return 0
+
+
+class Corpus:
+    """EML docs below {eml_root_path}, with the parsed trees held in an LRU cache"""
+
+    def __init__(self, eml_root_path, index_path=None, memory_mb=DEFAULT_MEMORY_MB):
+        self.eml_root_path = pathlib.Path(eml_root_path)
+        self.index_path = index_path
+        self.max_bytes = memory_mb * 1024 * 1024
+        self.path_list = []
+        self.hit_count = 0
+        self.miss_count = 0
+        self._tree_dict = collections.OrderedDict()
+        self._total_bytes = 0
+
+    def load(self):
+        """Find the EML docs, and parse them until the memory budget is used"""
+        start_ts = time.time()
+        self._tree_dict.clear()
+        self._total_bytes = 0
+        self.path_list = list(lib.eml_path_gen(self.eml_root_path, self.index_path))
+        for eml_path in self.path_list:
+            if self._total_bytes >= self.max_bytes:
+                break
+            try:
+                self.get_tree(eml_path, evict=False)
+            except (OSError, lxml.etree.LxmlError) as e:
+                log.warning(f'Skipped EML doc: {eml_path.as_posix()}: {e!r}')
+        log.info(
+            f'Loaded EML docs: {len(self.path_list)} parsed={len(self._tree_dict)} '
+            f'in {time.time() - start_ts:.1f}s'
+        )
+
+    def get_tree(self, eml_path, evict=True):
+        """Return the parsed tree for {eml_path}. If the tree is not in the cache, it's
+        added. If there's no room for it, the least recently used trees are evicted if
+        {evict} is set. Else, the tree is returned without adding it, so that scans
+        over all the EML docs don't evict the trees that will be needed next."""
+        path_str = eml_path.as_posix()
+        tree_tup = self._tree_dict.get(path_str)
+        if tree_tup is not None:
+            self._tree_dict.move_to_end(path_str)
+            self.hit_count += 1
+            return tree_tup[0]
+        self.miss_count += 1
+        eml_doc = lib.read_eml(eml_path)
+        root_el = lib.get_eml_tree(eml_doc)
+        tree_bytes = len(eml_doc.data_bytes) * TREE_MEMORY_FACTOR
+        if not evict and self._total_bytes + tree_bytes > self.max_bytes:
+            return root_el
+        self._tree_dict[path_str] = root_el, tree_bytes
+        self._total_bytes += tree_bytes
+        while self._total_bytes > self.max_bytes and len(self._tree_dict) > 1:
+            _, (_, evicted_bytes) = self._tree_dict.popitem(last=False)
+            self._total_bytes -= evicted_bytes
+        return root_el
+
+    def get_info(self):
+        return {
+            'eml_root': self.eml_root_path.as_posix(),
+            'doc_count': len(self.path_list),
+            'parsed_count': len(self._tree_dict),
+            'parsed_mb': self._total_bytes / 1024**2,
+            'hit_count': self.hit_count,
+            'miss_count': self.miss_count,
+        }
+
+    def is_root(self, eml_root_path):
+        return os.path.samefile(self.eml_root_path, eml_root_path)
+
+
+class QueryServer(socketserver.UnixStreamServer):
+    """Handles one request at a time, since the parsed trees are shared"""
+
+    def __init__(self, socket_path, corpus):
+        self.corpus = corpus
+        super().__init__(socket_path, QueryHandler)
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        start_ts = time.time()
+        request_dict = {}
+        try:
+            request_obj = json.loads(self.rfile.readline())
+            if not isinstance(request_obj, dict):
+                raise lib.EMLError(f'Request must be a JSON object: {request_obj!r}')
+            request_dict = request_obj
+            response_dict = proc_request(self.server.corpus, request_dict)
+        except Exception as e:
+            log.exception('Request failed')
+            response_dict = {'error': repr(e)}
+        self.wfile.write(json.dumps(response_dict).encode('utf-8') + b'\n')
+        log.info(
+            f'{request_dict.get("op")}: {time.time() - start_ts:.3f}s '
+            f'{request_dict.get("xpath_list", "")}'
+        )
+
+
+def proc_request(corpus, request_dict):
+    op_str = request_dict['op']
+    if op_str == 'info':
+        return corpus.get_info()
+    if op_str == 'reload':
+        corpus.load()
+        return corpus.get_info()
+    if op_str == 'stats':
+        if not corpus.is_root(request_dict['eml_root']):
+            raise lib.EMLError(
+                f'Server holds EML docs below {corpus.eml_root_path.as_posix()}'
+            )
+        result_list, failed_list = get_stats(corpus, request_dict['xpath_list'])
+        return {'result_list': result_list, 'failed_list': failed_list}
+    if op_str == 'xpath':
+        return {
+            'doc_list': get_xpath_results(
+                corpus,
+                request_dict['xpath_list'],
+                request_dict['path_list'],
+                request_dict['only_text'],
+            )
+        }
+    raise lib.EMLError(f'Unknown request: {op_str}')
+
+
+def get_stats(corpus, xpath_list):
+    """Return aggregates as created by mk_stats.proc_all(), one per XPath in
+    {xpath_list}, for all EML docs in {corpus}, and the list of paths of the EML docs
+    that could not be read or parsed. Those docs are logged and skipped."""
+    xpath_obj_list = [lib.compile_xpath(xpath_str) for xpath_str in xpath_list]
+    dst_list = [{} for _ in xpath_list]
+    failed_list = []
+    for eml_path in corpus.path_list:
+        try:
+            root_el = corpus.get_tree(eml_path, evict=False)
+        except (OSError, lxml.etree.LxmlError) as e:
+            log.warning(f'Skipped EML doc: {eml_path.as_posix()}: {e!r}')
+            failed_list.append(eml_path.as_posix())
+            continue
+        for xpath_obj, dst_el_dict in zip(xpath_obj_list, dst_list):
+            mk_stats.proc_el_list(lib.xpath(root_el, xpath_obj), dst_el_dict)
+    return dst_list, failed_list
+
+
+def get_xpath_results(corpus, xpath_list, path_list, only_text):
+    """Return results as created by xpath.proc_path_list() for the EML docs in
+    {path_list}"""
+    xpath_obj_list = [lib.get_xpath(xpath_str) for xpath_str in xpath_list]
+    doc_list = []
+    for path_str in path_list:
+        try:
+            root_el = corpus.get_tree(pathlib.Path(path_str))
+            result_list = xpath.proc_tree(xpath_obj_list, root_el, only_text)
+        except (OSError, lxml.etree.LxmlError) as e:
+            result_list = repr(e)
+        doc_list.append((path_str, result_list))
+    return doc_list
+
+
+if __name__ == '__main__':
+    sys.exit(main())
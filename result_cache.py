@@ -0,0 +1,117 @@
+"""Persistent cache for aggregate query results.
+
+Results are stored under a key created from the normalized XPath, the options that
+affect the result, and a fingerprint of the corpus. Re-running a query against an
+unchanged corpus returns the stored aggregate instead of scanning the EML docs again.
+
+The corpus fingerprint is a hash of the size and modification time of the archive if
+the corpus is an archive, and otherwise of the paths, sizes and modification times of
+all the EML docs. The cache is kept below a
+configurable size by evicting the least recently used results.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import pickle
+
+import lib
+
+DEFAULT_CACHE_DIR = lib.THIS_PATH / '___cache'
+DEFAULT_CACHE_SIZE_MB = 1024
+
+CACHE_FILE_SUFFIX = '.result.pickle'
+
+log = logging.getLogger(__name__)
+
+
+def get_corpus_fingerprint(eml_root_path, entry_iter=None):
+    """Return a hex digest that changes when EML docs are added, changed or removed
+    below {eml_root_path}.
+
+    {entry_iter} yields (path, file_dict) for the EML docs, as returned by
+    lib.eml_entry_gen(). It's not used if {eml_root_path} is an archive. If it's None,
+    the EML docs are found by searching the directory tree.
+    """
+    h = hashlib.sha256()
+    h.update(pathlib.Path(eml_root_path).resolve().as_posix().encode('utf-8'))
+    if lib.is_archive(eml_root_path):
+        stat_result = os.stat(eml_root_path)
+        h.update(f'{stat_result.st_size} {stat_result.st_mtime_ns}'.encode('utf-8'))
+    else:
+        if entry_iter is None:
+            entry_iter = lib.eml_entry_gen(eml_root_path)
+        for eml_path, file_dict in entry_iter:
+            h.update(f'{eml_path.as_posix()}\n'.encode('utf-8'))
+            h.update(f'{file_dict["size"]} {file_dict["mtime_ns"]}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def normalize_xpath(xpath_str):
+    """Return {xpath_str} on the form used by lib.compile_xpath()"""
+    xpath_str = xpath_str.strip()
+    if not xpath_str.startswith('.//'):
+        xpath_str = './/' + xpath_str
+    return xpath_str
+
+
+def get_key(xpath_str, fingerprint_str, **option_dict):
+    key_dict = dict(
+        option_dict,
+        xpath=normalize_xpath(xpath_str),
+        corpus=fingerprint_str,
+        parser=lib.EML_PARSER_DICT,
+    )
+    key_str = json.dumps(key_dict, sort_keys=True)
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Content addressed store of aggregates, with LRU eviction by total size"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_CACHE_SIZE_MB):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key):
+        """Return the aggregate stored under {key}, or None if there is none"""
+        cache_path = self._get_path(key)
+        try:
+            result_dict = pickle.loads(cache_path.read_bytes())
+        except FileNotFoundError:
+            log.debug(f'Result cache miss: {key}')
+            return None
+        # Eviction is by modification time, so update it on each hit.
+        os.utime(cache_path)
+        log.info(f'Using cached result: {cache_path.as_posix()}')
+        return result_dict
+
+    def put(self, key, result_dict):
+        cache_path = self._get_path(key)
+        tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+        tmp_path.write_bytes(pickle.dumps(result_dict))
+        os.replace(tmp_path, cache_path)
+        log.debug(f'Stored result in cache: {cache_path.as_posix()}')
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used results until the cache is below its max size"""
+        entry_list = []
+        for cache_path in self.cache_dir.glob(f'*{CACHE_FILE_SUFFIX}'):
+            stat_result = cache_path.stat()
+            entry_list.append(
+                (stat_result.st_mtime_ns, stat_result.st_size, cache_path)
+            )
+        total_bytes = sum(size for _, size, _ in entry_list)
+        for _, size, cache_path in sorted(entry_list):
+            if total_bytes <= self.max_bytes:
+                break
+            log.debug(f'Evicting cached result: {cache_path.as_posix()}')
+            cache_path.unlink(missing_ok=True)
+            total_bytes -= size
+
+    def _get_path(self, key):
+        return self.cache_dir / f'{key}{CACHE_FILE_SUFFIX}'
@@ -0,0 +1,212 @@
+"""Fixed size summaries for approximate value counting.
+
+mk_stats keeps an exact count for each distinct value of each tag, so memory use grows
+without limit for free text elements. In approximate mode, the exact counts for each EML
+doc are instead folded into a Space-Saving summary, which tracks the K most frequent
+values with bounds on their counts, and a HyperLogLog sketch, which estimates the number
+of distinct values. Both have a fixed size, and both can be merged, so partial
+aggregates from worker processes can be combined as for exact aggregates.
+"""
+
+import hashlib
+import heapq
+import math
+
+# Number of index bits in the HyperLogLog sketches. The sketches use 2 ** bits bytes,
+# and the standard error of the estimate is about 1.04 / sqrt(2 ** bits).
+DEFAULT_HLL_BITS = 12
+
+
+class SpaceSaving:
+    """Space-Saving summary holding the approximate top {k} values in a stream.
+
+    Each tracked value has a count and an error. The true count of the value is
+    between count - error and count. Values that are not tracked have a true count of at
+    most min_count().
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.counter_dict = {}
+        self._heap = []
+
+    def add(self, value, count=1):
+        counter = self.counter_dict.get(value)
+        if counter is not None:
+            counter[0] += count
+            self._push(value, counter)
+            return
+        if len(self.counter_dict) < self.k:
+            counter = self.counter_dict[value] = [count, 0]
+            self._push(value, counter)
+            return
+        min_value, min_count = self._pop_min()
+        del self.counter_dict[min_value]
+        counter = self.counter_dict[value] = [min_count + count, min_count]
+        self._push(value, counter)
+
+    def merge(self, other):
+        """Merge another summary into this one. Values that are tracked in only one of
+        the summaries get the min_count() of the other summary as count and error."""
+        self_min = self.min_count()
+        other_min = other.min_count()
+        merged_dict = {}
+        for value in self.counter_dict.keys() | other.counter_dict.keys():
+            count_a, error_a = self.counter_dict.get(value, (self_min, self_min))
+            count_b, error_b = other.counter_dict.get(value, (other_min, other_min))
+            merged_dict[value] = [count_a + count_b, error_a + error_b]
+        top_list = heapq.nlargest(self.k, merged_dict.items(), key=lambda x: x[1][0])
+        self.counter_dict = dict(top_list)
+        self._heap = []
+        for value, counter in self.counter_dict.items():
+            self._push(value, counter)
+        return self
+
+    def min_count(self):
+        """Upper bound for the count of values that are not tracked"""
+        if len(self.counter_dict) < self.k:
+            return 0
+        return min(counter[0] for counter in self.counter_dict.values())
+
+    def items(self):
+        """Return (value, count, error) for the tracked values, highest count first"""
+        return sorted(
+            ((v, c[0], c[1]) for v, c in self.counter_dict.items()),
+            key=lambda x: (-x[1], x[0]),
+        )
+
+    def _push(self, value, counter):
+        heapq.heappush(self._heap, (counter[0], value))
+        # The heap holds stale entries for values with updated counts. Rebuild it when
+        # it grows too large.
+        if len(self._heap) > 4 * self.k + 16:
+            self._heap = [(c[0], v) for v, c in self.counter_dict.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, value = heapq.heappop(self._heap)
+            counter = self.counter_dict.get(value)
+            if counter is not None and counter[0] == count:
+                return value, count
+
+
+class HyperLogLog:
+    """HyperLogLog sketch estimating the number of distinct values added to it"""
+
+    def __init__(self, bits=DEFAULT_HLL_BITS):
+        self.bits = bits
+        self.register_arr = bytearray(1 << bits)
+
+    def add(self, value):
+        h = int.from_bytes(
+            hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big'
+        )
+        idx = h >> (64 - self.bits)
+        rest = h & ((1 << (64 - self.bits)) - 1)
+        rank = (64 - self.bits) - rest.bit_length() + 1
+        if rank > self.register_arr[idx]:
+            self.register_arr[idx] = rank
+
+    def merge(self, other):
+        assert self.bits == other.bits
+        self.register_arr = bytearray(map(max, self.register_arr, other.register_arr))
+        return self
+
+    def estimate(self):
+        m = len(self.register_arr)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-r for r in self.register_arr)
+        zero_count = self.register_arr.count(0)
+        if raw <= 2.5 * m and zero_count:
+            return round(m * math.log(m / zero_count))
+        return round(raw)
+
+
+def add_stats(dst_el_dict, src_el_dict, k):
+    """Fold the exact aggregate {src_el_dict} into the approximate aggregate
+    {dst_el_dict}, tracking the top {k} values for each tag."""
+    for tag, src_tag_dict in src_el_dict.items():
+        dst_tag_dict = dst_el_dict.get(tag)
+        if dst_tag_dict is None:
+            dst_tag_dict = dst_el_dict[tag] = {
+                'tag_count': 0,
+                'top_k': SpaceSaving(k),
+                'distinct': HyperLogLog(),
+            }
+        dst_tag_dict['tag_count'] += src_tag_dict['tag_count']
+        for text, count in src_tag_dict['unique_count'].items():
+            dst_tag_dict['top_k'].add(text, count)
+            dst_tag_dict['distinct'].add(text)
+    return dst_el_dict
+
+
+def merge_stats(dst_el_dict, src_el_dict):
+    """Merge approximate aggregate {src_el_dict} into approximate aggregate
+    {dst_el_dict}"""
+    for tag, src_tag_dict in src_el_dict.items():
+        dst_tag_dict = dst_el_dict.get(tag)
+        if dst_tag_dict is None:
+            dst_el_dict[tag] = src_tag_dict
+            continue
+        dst_tag_dict['tag_count'] += src_tag_dict['tag_count']
+        dst_tag_dict['top_k'].merge(src_tag_dict['top_k'])
+        dst_tag_dict['distinct'].merge(src_tag_dict['distinct'])
+    return dst_el_dict
+
+
+def finalize_stats(sketch_el_dict):
+    """Return an aggregate on the regular {tag: {'tag_count', 'unique_count'}} form for
+    approximate aggregate {sketch_el_dict}.
+
+    'unique_count' holds the top K values with their approximate counts. Each tag also
+    gets 'count_error', with the max overestimate of each of the counts, and
+    'unique_estimate', with the estimated number of distinct values.
+    """
+    el_dict = {}
+    for tag, sketch_tag_dict in sketch_el_dict.items():
+        item_list = sketch_tag_dict['top_k'].items()
+        el_dict[tag] = {
+            'tag_count': sketch_tag_dict['tag_count'],
+            'unique_count': {text: count for text, count, _ in item_list},
+            'count_error': {text: error for text, _, error in item_list},
+            'unique_estimate': sketch_tag_dict['distinct'].estimate(),
+        }
+    return el_dict
+
+
+def merge_finalized_stats(dst_el_dict, src_el_dict, k):
+    """Merge approximate aggregate {src_el_dict} into approximate aggregate
+    {dst_el_dict}, where both are on the form returned by finalize_stats(), keeping the
+    top {k} values for each tag.
+
+    The counts are merged as by SpaceSaving.merge(). The HyperLogLog sketches are not
+    stored in the finalized form, so 'unique_estimate' is the largest of the estimates,
+    which is a lower bound for the number of distinct values.
+    """
+    for tag, src_tag_dict in src_el_dict.items():
+        dst_tag_dict = dst_el_dict.get(tag)
+        if dst_tag_dict is None:
+            dst_el_dict[tag] = src_tag_dict
+            continue
+        top_k = _get_space_saving(dst_tag_dict, k)
+        top_k.merge(_get_space_saving(src_tag_dict, k))
+        item_list = top_k.items()
+        dst_tag_dict['tag_count'] += src_tag_dict['tag_count']
+        dst_tag_dict['unique_count'] = {text: count for text, count, _ in item_list}
+        dst_tag_dict['count_error'] = {text: error for text, _, error in item_list}
+        dst_tag_dict['unique_estimate'] = max(
+            dst_tag_dict['unique_estimate'], src_tag_dict['unique_estimate']
+        )
+    return dst_el_dict
+
+
+def _get_space_saving(tag_dict, k):
+    """Return a SpaceSaving summary holding the values of finalized {tag_dict}"""
+    top_k = SpaceSaving(k)
+    error_dict = tag_dict['count_error']
+    top_k.counter_dict = {
+        text: [count, error_dict[text]]
+        for text, count in tag_dict['unique_count'].items()
+    }
+    return top_k
@@ -0,0 +1,354 @@
+"""Compact on-disk format for the aggregates created by mk_stats.
+
+The pickle format stores the aggregates as nested dicts of Python strings, which must be
+unpickled in full before any of it can be used. The compact format stores each unique
+string once, in a string table, and refers to tags and values by integer index. Values
+are stored in count arrays that are sorted by descending count, so the most common
+values for a tag are at the start of its slice of the arrays.
+
+The file is read through a memory map. Opening it only decodes the tag directory, and
+the values for a tag are only decoded when they are accessed, so tools can read just the
+tags they need.
+
+Layout (all integers little endian):
+
+    header      HEADER_STRUCT
+    str_offset  u64[str_count + 1], offsets of the strings in str_blob
+    str_blob    UTF-8 encoded strings
+    tag_dir     TAG_STRUCT[tag_count], one entry per tag
+    value_str   u32[value_total], str index of each value
+    value_count u64[value_total], count of each value
+    value_error u64[value_total], max overestimate of each count, for --top-k
+    value_order u32[value_total], positions of the values in each tag, by value
+    args        JSON encoded arguments with which the aggregates were created
+
+The value_error section is only present if any of the tags have 'count_error', and its
+offset in the header is 0 otherwise. value_order holds, for the slice of each tag, the
+positions within the slice sorted by value, so a value can be looked up by binary
+search.
+"""
+
+import array
+import collections.abc
+import json
+import mmap
+import pathlib
+import pickle
+import struct
+import sys
+
+import lib
+
+MAGIC_PREFIX = b'EMLSTAT'
+MAGIC_BYTES = MAGIC_PREFIX + b'\x02'
+
+# magic, str_count, tag_count, value_total, then the offsets of the str_offset,
+# str_blob, tag_dir, value_str, value_count, value_error, value_order and args sections.
+HEADER_STRUCT = struct.Struct('<8sIIQQQQQQQQQ')
+# tag str index, tag_count, value start, value count, unique_estimate (-1 if none), and
+# flags.
+TAG_STRUCT = struct.Struct('<QQQQqQ')
+TAG_HAS_ERROR = 1
+
+STATS_FILE_SUFFIX = '.stats'
+
+
+def write_compact(stats_path, result_dict, args_dict):
+    """Write the aggregates in {result_dict} to {stats_path} in the compact format"""
+    str_dict = {}
+
+    def intern(s):
+        return str_dict.setdefault(s, len(str_dict))
+
+    tag_list = []
+    value_str = array.array('I')
+    value_count = array.array('Q')
+    value_error = array.array('Q')
+    value_order = array.array('I')
+    has_error = any('count_error' in d for t, d in result_dict.items() if t != '__args')
+
+    for tag, tag_dict in result_dict.items():
+        if tag == '__args':
+            continue
+        value_list = sorted(
+            tag_dict['unique_count'].items(), key=lambda x: (-x[1], x[0])
+        )
+        error_dict = tag_dict.get('count_error')
+        tag_list.append(
+            (
+                intern(tag),
+                tag_dict['tag_count'],
+                len(value_str),
+                len(value_list),
+                tag_dict.get('unique_estimate', -1),
+                TAG_HAS_ERROR if error_dict is not None else 0,
+            )
+        )
+        for text, count in value_list:
+            value_str.append(intern(text))
+            value_count.append(count)
+            if has_error:
+                value_error.append(error_dict[text] if error_dict is not None else 0)
+        value_order.extend(
+            sorted(range(len(value_list)), key=lambda i: value_list[i][0])
+        )
+
+    blob = bytearray()
+    str_offset = array.array('Q', [0])
+    for s in str_dict:
+        blob += s.encode('utf-8')
+        str_offset.append(len(blob))
+
+    tag_dir = b''.join(TAG_STRUCT.pack(*t) for t in tag_list)
+    args_bytes = json.dumps(args_dict, default=str).encode('utf-8')
+
+    section_list = [
+        _to_le_bytes(str_offset),
+        bytes(blob),
+        tag_dir,
+        _to_le_bytes(value_str),
+        _to_le_bytes(value_count),
+        _to_le_bytes(value_error) if has_error else None,
+        _to_le_bytes(value_order),
+        args_bytes,
+    ]
+    pos = HEADER_STRUCT.size
+    pos_list = []
+    for i, section_bytes in enumerate(section_list):
+        if section_bytes is None:
+            pos_list.append(0)
+            section_list[i] = b''
+            continue
+        # Keep the array sections aligned to 8 bytes.
+        pos_list.append(pos)
+        pad = -len(section_bytes) % 8
+        section_list[i] = section_bytes + b'\0' * pad
+        pos += len(section_list[i])
+
+    with pathlib.Path(stats_path).open('wb') as f:
+        f.write(
+            HEADER_STRUCT.pack(
+                MAGIC_BYTES,
+                len(str_dict),
+                len(tag_list),
+                len(value_str),
+                *pos_list,
+            )
+        )
+        for section_bytes in section_list:
+            f.write(section_bytes)
+
+
+def _to_le_bytes(a):
+    if sys.byteorder != 'little':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def is_compact(stats_path):
+    with pathlib.Path(stats_path).open('rb') as f:
+        return f.read(len(MAGIC_PREFIX)) == MAGIC_PREFIX
+
+
+def read_stats(stats_path):
+    """Return (stats, args) for the aggregates in {stats_path}.
+
+    stats is a mapping of tag to {'tag_count', 'unique_count'}, with 'count_error' and
+    'unique_estimate' for aggregates created with --top-k. For files in the compact
+    format, it's a CompactStats, which decodes the values lazily, and for which
+    'unique_count' is ordered by descending count. For pickle files, it's the unpickled
+    dict.
+    """
+    if is_compact(stats_path):
+        stats = CompactStats(stats_path)
+        return stats, stats.args
+    stats_dict = pickle.loads(pathlib.Path(stats_path).read_bytes())
+    args = stats_dict.pop('__args', None)
+    return stats_dict, args
+
+
+def load_stats_dict(stats_path):
+    """Return the aggregates in {stats_path} as a plain dict, regardless of format"""
+    stats, _ = read_stats(stats_path)
+    if isinstance(stats, CompactStats):
+        with stats:
+            return stats.to_dict()
+    return stats
+
+
+class CompactStats(collections.abc.Mapping):
+    """Read only mapping of tag to {'tag_count', 'unique_count'} for a stats file in the
+    compact format.
+
+    Raises EMLError if the file was written in an older version of the format.
+    """
+
+    def __init__(self, stats_path):
+        self._file = pathlib.Path(stats_path).open('rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(MAGIC_BYTES)] != MAGIC_BYTES:
+            self._mmap.close()
+            self._file.close()
+            raise lib.EMLError(
+                f'Stats file is in an older compact format. Create it again: '
+                f'{pathlib.Path(stats_path).as_posix()}'
+            )
+        (
+            _,
+            str_count,
+            tag_count,
+            value_total,
+            str_offset_pos,
+            str_blob_pos,
+            tag_dir_pos,
+            value_str_pos,
+            value_count_pos,
+            value_error_pos,
+            value_order_pos,
+            self._args_pos,
+        ) = HEADER_STRUCT.unpack_from(self._mmap)
+        buf = memoryview(self._mmap)
+        self._view_list = [buf]
+        self._str_offset = self._cast(buf, str_offset_pos, 'Q', str_count + 1)
+        self._str_blob_pos = str_blob_pos
+        self._value_str = self._cast(buf, value_str_pos, 'I', value_total)
+        self._value_count = self._cast(buf, value_count_pos, 'Q', value_total)
+        self._value_error = (
+            self._cast(buf, value_error_pos, 'Q', value_total)
+            if value_error_pos
+            else None
+        )
+        self._value_order = self._cast(buf, value_order_pos, 'I', value_total)
+        self._tag_dict = {}
+        for i in range(tag_count):
+            tag_str_idx, *tag_tup = TAG_STRUCT.unpack_from(
+                self._mmap, tag_dir_pos + i * TAG_STRUCT.size
+            )
+            self._tag_dict[self.get_str(tag_str_idx)] = tag_tup
+
+    def _cast(self, buf, pos, typecode, count):
+        size = array.array(typecode).itemsize
+        view = buf[pos : pos + size * count]
+        if sys.byteorder != 'little':
+            a = array.array(typecode, view.tobytes())
+            a.byteswap()
+            view.release()
+            return a
+        self._view_list.append(view)
+        view = view.cast(typecode)
+        self._view_list.append(view)
+        return view
+
+    def get_str(self, str_idx):
+        start = self._str_offset[str_idx]
+        end = self._str_offset[str_idx + 1]
+        pos = self._str_blob_pos
+        return str(self._mmap[pos + start : pos + end], 'utf-8')
+
+    @property
+    def args(self):
+        return json.loads(self._mmap[self._args_pos :].rstrip(b'\0') or b'null')
+
+    def __getitem__(self, tag):
+        tag_count, start, count, unique_estimate, flags = self._tag_dict[tag]
+        tag_dict = {
+            'tag_count': tag_count,
+            'unique_count': _CompactValues(self, start, count, self._value_count),
+        }
+        if flags & TAG_HAS_ERROR:
+            tag_dict['count_error'] = _CompactValues(
+                self, start, count, self._value_error
+            )
+        if unique_estimate >= 0:
+            tag_dict['unique_estimate'] = unique_estimate
+        return tag_dict
+
+    def __iter__(self):
+        return iter(self._tag_dict)
+
+    def __len__(self):
+        return len(self._tag_dict)
+
+    def iter_values(self, start, count, count_arr):
+        for i in range(start, start + count):
+            yield self.get_str(self._value_str[i]), count_arr[i]
+
+    def find_value(self, start, count, text):
+        """Return the index of the value {text} in the slice of {count} values at
+        {start}, or None if it's not there. Binary search over value_order."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = start + self._value_order[start + mid]
+            value_str = self.get_str(self._value_str[i])
+            if value_str == text:
+                return i
+            if value_str < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def to_dict(self):
+        result_dict = {}
+        for tag, tag_dict in self.items():
+            result_dict[tag] = dict(tag_dict)
+            for key in 'unique_count', 'count_error':
+                if key in tag_dict:
+                    result_dict[tag][key] = dict(tag_dict[key].items())
+        return result_dict
+
+    def close(self):
+        self._str_offset = self._value_str = self._value_count = None
+        self._value_error = self._value_order = None
+        for view in reversed(self._view_list):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _CompactValues(collections.abc.Mapping):
+    """Mapping of value to count, or to count_error, for a single tag in a
+    CompactStats. Iterates in order of descending count."""
+
+    def __init__(self, stats, start, count, count_arr):
+        self._stats = stats
+        self._start = start
+        self._count = count
+        self._count_arr = count_arr
+
+    def items(self):
+        return _CompactItemsView(self)
+
+    def __getitem__(self, text):
+        i = self._stats.find_value(self._start, self._count, text)
+        if i is None:
+            raise KeyError(text)
+        return self._count_arr[i]
+
+    def __contains__(self, text):
+        return self._stats.find_value(self._start, self._count, text) is not None
+
+    def __iter__(self):
+        return (text for text, _ in self._iter_items())
+
+    def __len__(self):
+        return self._count
+
+    def _iter_items(self):
+        return self._stats.iter_values(self._start, self._count, self._count_arr)
+
+
+class _CompactItemsView(collections.abc.ItemsView):
+    """ItemsView that iterates the values of a _CompactValues in a single pass, instead
+    of looking up each value by key"""
+
+    def __iter__(self):
+        return self._mapping._iter_items()
@@ -0,0 +1,186 @@
+"""Per-doc timings and progress reporting for scans over collections of EML docs.
+
+When enabled, each processed EML doc adds a record holding its size and the time spent
+parsing it, applying the XPaths and adding the matches to the aggregates. The records
+are written to a JSON lines file, together with periodic progress records holding the
+throughput and, when the number of EML docs is known, an estimated time to completion.
+A summary record with totals for each stage and the slowest EML docs is written at the
+end.
+
+Each line in the file is a JSON object with a 'type' of 'doc', 'progress' or 'summary'.
+
+The timings are taken with time.perf_counter() around each stage of each doc, so the
+overhead is a few calls per doc, and the file is written through a buffer.
+"""
+
+import contextlib
+import cProfile
+import heapq
+import json
+import logging
+import pathlib
+import time
+
+# Number of slowest EML docs to include in the summary.
+DEFAULT_TOP_N = 10
+
+# Min number of seconds between progress records.
+DEFAULT_INTERVAL_S = 10
+
+STAGE_TUP = ('parse', 'xpath', 'aggregate')
+
+log = logging.getLogger(__name__)
+
+
+class Telemetry:
+    """Collect doc records as created by get_doc_record() and write them to
+    {jsonl_path}.
+
+    The sizes of the EML docs are taken from the entries passed through path_gen(), so
+    the EML docs are not stat'ed again.
+    """
+
+    def __init__(
+        self,
+        jsonl_path,
+        total_count=None,
+        top_n=DEFAULT_TOP_N,
+        interval_s=DEFAULT_INTERVAL_S,
+    ):
+        self.total_count = total_count
+        self.top_n = top_n
+        self.interval_s = interval_s
+        self.doc_count = 0
+        self.byte_count = 0
+        self.stage_dict = {stage_str: 0.0 for stage_str in STAGE_TUP}
+        self._slow_heap = []
+        self._size_dict = {}
+        self._file = pathlib.Path(jsonl_path).open('w', encoding='utf-8')
+        self._start_ts = time.perf_counter()
+        self._progress_ts = self._start_ts
+
+    def path_gen(self, entry_iter):
+        """Yield the paths in {entry_iter}, which yields (path, file_dict) as
+        lib.eml_entry_gen(), and keep the sizes for the records of the EML docs."""
+        for eml_path, file_dict in entry_iter:
+            self._size_dict[eml_path.as_posix()] = file_dict['size']
+            yield eml_path
+
+    def add(self, doc_dict):
+        size = self._size_dict.pop(doc_dict['path'], 0)
+        doc_dict = {'path': doc_dict['path'], 'size': size, **doc_dict}
+        self.doc_count += 1
+        self.byte_count += doc_dict['size']
+        for stage_str in STAGE_TUP:
+            self.stage_dict[stage_str] += doc_dict[stage_str]
+        total_s = sum(doc_dict[stage_str] for stage_str in STAGE_TUP)
+        slow_tup = total_s, doc_dict['path']
+        if len(self._slow_heap) < self.top_n:
+            heapq.heappush(self._slow_heap, slow_tup)
+        elif self.top_n:
+            heapq.heappushpop(self._slow_heap, slow_tup)
+        self._write({'type': 'doc', **doc_dict})
+        if time.perf_counter() - self._progress_ts >= self.interval_s:
+            self.progress()
+
+    def progress(self):
+        """Write and log a progress record"""
+        self._progress_ts = time.perf_counter()
+        progress_dict = self._get_rate_dict()
+        self._write({'type': 'progress', **progress_dict})
+        eta_str = ''
+        if progress_dict['eta_s'] is not None:
+            m, s = divmod(progress_dict['eta_s'], 60)
+            eta_str = f' ETA: {int(m)}m {int(s)}s'
+        total_str = f'/{self.total_count}' if self.total_count else ''
+        log.info(
+            f'Progress: {self.doc_count}{total_str} EML docs '
+            f'{progress_dict["docs_per_s"]:.1f} docs/s '
+            f'{progress_dict["mb_per_s"]:.2f} MB/s{eta_str}'
+        )
+
+    def close(self):
+        """Write the summary record, log the summary and close the file"""
+        summary_dict = {
+            'type': 'summary',
+            **self._get_rate_dict(),
+            'stage_s': self.stage_dict,
+            'slowest': [
+                {'path': path_str, 'seconds': total_s}
+                for total_s, path_str in sorted(self._slow_heap, reverse=True)
+            ],
+        }
+        self._write(summary_dict)
+        self._file.close()
+
+        log.info(
+            f'EML docs: {self.doc_count} '
+            f'{summary_dict["docs_per_s"]:.1f} docs/s '
+            f'{summary_dict["mb_per_s"]:.2f} MB/s'
+        )
+        for stage_str, stage_s in self.stage_dict.items():
+            log.info(f'    {stage_str:<10} {stage_s:10.3f}s')
+        if summary_dict['slowest']:
+            log.info('Slowest EML docs:')
+            for slow_dict in summary_dict['slowest']:
+                log.info(f'    {slow_dict["seconds"]:10.4f}s {slow_dict["path"]}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_rate_dict(self):
+        elapsed_s = max(time.perf_counter() - self._start_ts, 1e-9)
+        docs_per_s = self.doc_count / elapsed_s
+        eta_s = None
+        if self.total_count and docs_per_s:
+            eta_s = max(self.total_count - self.doc_count, 0) / docs_per_s
+        return {
+            'docs': self.doc_count,
+            'bytes': self.byte_count,
+            'elapsed_s': elapsed_s,
+            'docs_per_s': docs_per_s,
+            'mb_per_s': self.byte_count / 1024**2 / elapsed_s,
+            'eta_s': eta_s,
+        }
+
+    def _write(self, record_dict):
+        self._file.write(json.dumps(record_dict) + '\n')
+
+
+def get_doc_record(eml_path, time_tup):
+    """Return the record for an EML doc that was processed with the stage times in
+    {time_tup}, as returned by mk_stats.proc_eml(). The size is added by
+    Telemetry.add()."""
+    return {
+        'path': eml_path.as_posix(),
+        **dict(zip(STAGE_TUP, time_tup)),
+    }
+
+
+def get_index_count(index_path):
+    """Return the number of EML docs in the corpus index at {index_path}, or None if
+    there is no index."""
+    if index_path is None or not pathlib.Path(index_path).exists():
+        return None
+    with open(index_path, 'rb') as f:
+        return sum(1 for line in f if not line.startswith(b'#'))
+
+
+@contextlib.contextmanager
+def profile(profile_path):
+    """Profile the enclosed code with cProfile, and dump the stats to {profile_path}.
+    Does nothing if {profile_path} is None."""
+    if profile_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        log.info(f'Wrote profile to {pathlib.Path(profile_path).as_posix()}')
@@ -0,0 +1,70 @@
+import pathlib
+import sys
+
+import pytest
+
+ROOT_PATH = pathlib.Path(__file__).parent.parent.resolve()
+
+# The tools are plain scripts in the root of the repository.
+sys.path.insert(0, ROOT_PATH.as_posix())
+
+EML_TMPL = """<?xml version="1.0"?>
+<eml:eml xmlns:eml="https://eml.ecoinformatics.org/eml-2.2.0" packageId="{package_id}">
+  <dataset>
+    <title>{title}</title>
+    <dataTable>
+      <entityName>{entity_name}</entityName>
+      <attributeList>
+{attribute_xml}
+      </attributeList>
+    </dataTable>
+  </dataset>
+</eml:eml>
+"""
+
+ATTRIBUTE_TMPL = """        <attribute>
+          <attributeName>{name}</attributeName>
+          <storageType>{storage_type}</storageType>
+        </attribute>"""
+
+
+def get_eml_bytes(package_id, title, entity_name, attribute_list):
+    """Return an EML doc with a single dataTable, with an attribute for each
+    (name, storage_type) in {attribute_list}."""
+    attribute_xml = '\n'.join(
+        ATTRIBUTE_TMPL.format(name=name, storage_type=storage_type)
+        for name, storage_type in attribute_list
+    )
+    return EML_TMPL.format(
+        package_id=package_id,
+        title=title,
+        entity_name=entity_name,
+        attribute_xml=attribute_xml,
+    ).encode('utf-8')
+
+
+def write_eml(root_path, scope, identifier, revision, eml_bytes):
+    eml_path = root_path / scope / str(identifier) / str(revision) / 'Level-1-EML.xml'
+    eml_path.parent.mkdir(parents=True, exist_ok=True)
+    eml_path.write_bytes(eml_bytes)
+    return eml_path
+
+
+@pytest.fixture
+def eml_root(tmp_path):
+    """Directory tree of EML docs, in the scope/identifier/revision layout, with some
+    repeated values, and with revisions that are copies of each other."""
+    root_path = tmp_path / 'eml'
+    storage_list = ['float', 'integer', 'string', 'dateTime']
+    for i in range(12):
+        attribute_list = [
+            (f'col_{j}', storage_list[(i + j) % len(storage_list)])
+            for j in range(i % 4 + 1)
+        ]
+        eml_bytes = get_eml_bytes(
+            f'knb-lter-x.{i}.1', f'Title {i % 3}', f'table_{i % 5}', attribute_list
+        )
+        write_eml(root_path, f'knb-lter-{"ab"[i % 2]}', i, 1, eml_bytes)
+        if i % 3 == 0:
+            write_eml(root_path, f'knb-lter-{"ab"[i % 2]}', i, 2, eml_bytes)
+    return root_path
@@ -0,0 +1,110 @@
+import argparse
+import shutil
+
+import pytest
+
+import checkpoint
+import lib
+import mk_stats
+from conftest import write_eml
+
+XPATH_LIST = ['.//dataTable//*']
+
+KEY_DICT = {'xpath': XPATH_LIST[0]}
+
+
+def get_checkpoint(tmp_path, skip_failed=False):
+    return checkpoint.Checkpoint(
+        tmp_path / 'stats.checkpoint.pickle', KEY_DICT, 3600, skip_failed
+    )
+
+
+def proc_tree(eml_root, **kwargs):
+    return mk_stats.proc_all(lib.eml_path_gen(eml_root), XPATH_LIST, **kwargs)
+
+
+@pytest.fixture
+def bad_root(eml_root, tmp_path):
+    """Copy of eml_root with a doc that cannot be parsed, in the middle of the walk"""
+    bad_root = tmp_path / 'bad'
+    shutil.copytree(eml_root, bad_root)
+    write_eml(bad_root, 'knb-lter-a', 6, 3, b'<eml><dataset></eml>')
+    return bad_root
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+@pytest.mark.parametrize('stream', [False, True])
+def test_resume_skips_failed_doc(eml_root, bad_root, tmp_path, jobs, stream):
+    checkpoint_obj = get_checkpoint(tmp_path)
+    with pytest.raises(lib.EMLDocError) as exc_info:
+        proc_tree(bad_root, jobs=jobs, stream=stream, checkpoint_obj=checkpoint_obj)
+    failed_path_str = exc_info.value.eml_path_str
+    assert failed_path_str.endswith('knb-lter-a/6/3/Level-1-EML.xml')
+    assert checkpoint_obj.exists()
+
+    # Without skip_failed, the doc fails again.
+    checkpoint_obj = get_checkpoint(tmp_path)
+    checkpoint_obj.load()
+    with pytest.raises(lib.EMLDocError):
+        proc_tree(bad_root, jobs=jobs, stream=stream, checkpoint_obj=checkpoint_obj)
+
+    checkpoint_obj = get_checkpoint(tmp_path, skip_failed=True)
+    checkpoint_obj.load()
+    assert checkpoint_obj.failed_list == [failed_path_str]
+    result_list = proc_tree(
+        bad_root, jobs=jobs, stream=stream, checkpoint_obj=checkpoint_obj
+    )
+    assert result_list == proc_tree(eml_root)
+
+
+def test_resume_from_periodic_checkpoint(eml_root, tmp_path):
+    checkpoint_obj = get_checkpoint(tmp_path)
+    path_list = list(lib.eml_path_gen(eml_root))
+    dst_list = mk_stats.proc_path_list(path_list[:5], XPATH_LIST)
+    checkpoint_obj.update(path_list[4], dst_list, 5)
+    checkpoint_obj.save(dst_list)
+
+    checkpoint_obj = get_checkpoint(tmp_path)
+    checkpoint_obj.load()
+    assert checkpoint_obj.doc_count == 5
+    assert proc_tree(eml_root, checkpoint_obj=checkpoint_obj) == proc_tree(eml_root)
+
+
+def test_resume_detects_changed_docs(eml_root, tmp_path):
+    checkpoint_obj = get_checkpoint(tmp_path)
+    path_list = list(lib.eml_path_gen(eml_root))
+    checkpoint_obj.update(path_list[2], [{}], 3)
+    checkpoint_obj.save([{}])
+    shutil.rmtree(path_list[1].parent)
+
+    checkpoint_obj = get_checkpoint(tmp_path)
+    checkpoint_obj.load()
+    with pytest.raises(lib.EMLError):
+        proc_tree(eml_root, checkpoint_obj=checkpoint_obj)
+
+
+def test_checkpoint_for_other_scan_is_rejected(tmp_path):
+    get_checkpoint(tmp_path).save([{}])
+    checkpoint_obj = checkpoint.Checkpoint(
+        tmp_path / 'stats.checkpoint.pickle', {'xpath': './/other'}
+    )
+    with pytest.raises(lib.EMLError):
+        checkpoint_obj.load()
+
+
+def test_disabled_checkpoint_is_not_created(tmp_path):
+    args = argparse.Namespace(
+        pickle=tmp_path / 'stats.pickle',
+        format='pickle',
+        eml_root=tmp_path,
+        index=None,
+        xpath=XPATH_LIST[0],
+        top_k=0,
+        shard=None,
+        checkpoint=0,
+        resume=False,
+        skip_failed=False,
+    )
+    assert mk_stats.get_checkpoint(args) is None
+    args.checkpoint = 1
+    assert mk_stats.get_checkpoint(args) is not None
@@ -0,0 +1,90 @@
+import lxml.etree
+
+import lib
+
+
+def get_tree_hash(xml_bytes):
+    return lib.get_tree_hash(lxml.etree.fromstring(xml_bytes))
+
+
+def test_tree_hash_ignores_indentation():
+    assert get_tree_hash(
+        b'<a x="1"><b>text</b><c/></a>'
+    ) == get_tree_hash(b'<a x="1">\n  <b>text</b>\n  <c>  </c>\n</a>')
+
+
+def test_tree_hash_keeps_other_whitespace():
+    xml_hash = get_tree_hash(
+        b'<a x="1 2"><b> text  more </b><c><![CDATA[ x  y ]]></c></a>'
+    )
+    for other_bytes in (
+        b'<a x="1  2"><b> text  more </b><c><![CDATA[ x  y ]]></c></a>',
+        b'<a x="1 2"><b>text more</b><c><![CDATA[ x  y ]]></c></a>',
+        b'<a x="1 2"><b> text  more </b><c><![CDATA[ x y ]]></c></a>',
+    ):
+        assert get_tree_hash(other_bytes) != xml_hash
+
+
+def test_tree_hash_includes_comments_and_structure():
+    assert get_tree_hash(b'<a><!-- x --><b/></a>') != get_tree_hash(
+        b'<a><!-- y --><b/></a>'
+    )
+    assert get_tree_hash(b'<a><b/><c/></a>') != get_tree_hash(b'<a><b><c/></b></a>')
+    assert get_tree_hash(b'<a y="2" x="1"/>') == get_tree_hash(b'<a x="1" y="2"/>')
+
+
+def test_content_hash_gen(tmp_path):
+    path_list = []
+    for i, xml_bytes in enumerate(
+        (b'<a><b>1</b></a>', b'<a>\n  <b>1</b>\n</a>', b'<a><b>2</b></a>', b'<a><b>')
+    ):
+        eml_path = tmp_path / f'{i}.xml'
+        eml_path.write_bytes(xml_bytes)
+        path_list.append(eml_path)
+
+    raw_list = [h for _, h in lib.content_hash_gen(path_list)]
+    assert len(set(raw_list)) == 4
+
+    doc_list = list(lib.content_hash_gen(path_list, normalize=True))
+    hash_list = [h for _, h in doc_list]
+    assert hash_list[0] == hash_list[1]
+    assert len(set(hash_list)) == 3
+    # Docs that cannot be parsed are hashed by contents.
+    assert hash_list[3] == raw_list[3]
+    eml_doc = doc_list[1][0]
+    assert eml_doc.eml_path == path_list[1]
+    assert lib.get_eml_tree(eml_doc) is eml_doc.tree
+
+
+def test_first_copy_list(tmp_path):
+    path_list = []
+    for i, tag in enumerate('abacba'):
+        xml_bytes = f'<{tag}/>'.encode('utf-8')
+        eml_path = tmp_path / f'{i}.xml'
+        eml_path.write_bytes(xml_bytes)
+        path_list.append(eml_path)
+
+    dup_counter = lib.DuplicateCounter()
+    first_list = lib.get_first_copy_list(path_list, dup_counter, jobs=2, chunk_size=2)
+    assert [eml_path for eml_path, _ in first_list] == [
+        path_list[0],
+        path_list[1],
+        path_list[3],
+    ]
+    assert [dup_counter.copy_dict[h] for _, h in first_list] == [3, 2, 1]
+    assert dup_counter.proc_count == 3
+
+
+def test_eml_parser_does_not_load_external_entities(tmp_path):
+    secret_path = tmp_path / 'secret.txt'
+    secret_path.write_text('secret')
+    eml_path = tmp_path / 'Level-1-EML.xml'
+    eml_path.write_bytes(
+        f'<!DOCTYPE eml [<!ENTITY x SYSTEM "{secret_path.as_uri()}">]>'
+        f'<eml><title>a &x; b</title></eml>'.encode('utf-8')
+    )
+    title_el = lib.get_eml_tree(eml_path).find('title')
+    assert 'secret' not in lxml.etree.tostring(title_el, encoding='unicode')
+    assert 'secret' not in ''.join(
+        text or '' for _, text in lib.iter_tag_path(eml_path)
+    )
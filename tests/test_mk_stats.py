@@ -0,0 +1,180 @@
+import os
+import shutil
+
+import pytest
+
+import lib
+import mk_stats
+import result_cache
+from conftest import get_eml_bytes, write_eml
+
+XPATH_LIST = ['.//dataTable//*', './/title', './/dataTable']
+
+
+def proc_tree(eml_root, xpath_list=XPATH_LIST, **kwargs):
+    return mk_stats.proc_all(lib.eml_path_gen(eml_root), xpath_list, **kwargs)
+
+
+def test_xpaths_match_separate_scans(eml_root):
+    result_list = proc_tree(eml_root)
+    assert result_list == [
+        proc_tree(eml_root, [xpath_str])[0] for xpath_str in XPATH_LIST
+    ]
+    assert result_list[0]['attributeName']['tag_count'] == 40
+    assert result_list[1]['title']['unique_count'] == {
+        'Title 0': 8,
+        'Title 1': 4,
+        'Title 2': 4,
+    }
+
+
+def test_jobs_match_single_process(eml_root):
+    assert proc_tree(eml_root, jobs=2) == proc_tree(eml_root)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_stream_matches_dom(eml_root, jobs):
+    # Comments are removed by the parser, so they do not split the text of elements.
+    write_eml(
+        eml_root,
+        'knb-lter-c',
+        1,
+        1,
+        b'<?xml version="1.0"?>\n'
+        b'<eml><dataset><title>Split<!-- c --> title</title>'
+        b'<dataTable><entityName> &amp;padded </entityName><empty/></dataTable>'
+        b'</dataset></eml>',
+    )
+    dom_list = proc_tree(eml_root, XPATH_LIST[:2], jobs=jobs)
+    stream_list = proc_tree(eml_root, XPATH_LIST[:2], jobs=jobs, stream=True)
+    assert stream_list == dom_list
+    assert dom_list[1]['title']['unique_count']['Split title'] == 1
+    assert dom_list[0]['entityName']['unique_count']['&padded'] == 1
+
+
+def test_top_k_is_exact_below_k(eml_root):
+    exact_list = proc_tree(eml_root)
+    for exact_el_dict, top_k_el_dict in zip(exact_list, proc_tree(eml_root, top_k=50)):
+        assert top_k_el_dict.keys() == exact_el_dict.keys()
+        for tag, tag_dict in top_k_el_dict.items():
+            assert tag_dict['unique_count'] == exact_el_dict[tag]['unique_count']
+            assert tag_dict['tag_count'] == exact_el_dict[tag]['tag_count']
+
+
+def run_incremental(eml_root, stats_path, use_hash=False):
+    result_list, manifest_dict = mk_stats.proc_incremental(
+        lib.eml_entry_gen(eml_root), XPATH_LIST, stats_path, use_hash
+    )
+    mk_stats.write_stats(stats_path, result_list[0], {})
+    mk_stats.write_manifest(stats_path, manifest_dict)
+    return result_list
+
+
+def set_mtime(eml_path, delta_ns):
+    stat_result = eml_path.stat()
+    os.utime(
+        eml_path,
+        ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + delta_ns),
+    )
+
+
+def test_incremental_detects_changes(eml_root, tmp_path, caplog):
+    stats_path = tmp_path / 'stats.pickle'
+    assert run_incremental(eml_root, stats_path) == proc_tree(eml_root)
+
+    path_list = sorted(eml_root.glob('*/*/*/Level-1-EML.xml'))
+    changed_path = path_list[0]
+    changed_path.write_bytes(
+        get_eml_bytes('changed.1.1', 'Changed', 'changed', [('new_col', 'string')])
+    )
+    set_mtime(changed_path, 10**9)
+    shutil.rmtree(path_list[1].parent)
+    write_eml(eml_root, 'knb-lter-new', 1, 1, path_list[2].read_bytes())
+
+    caplog.set_level('INFO')
+    result_list = run_incremental(eml_root, stats_path)
+    assert 'added_or_changed=2 deleted=1' in caplog.text
+    assert result_list == proc_tree(eml_root)
+
+
+def test_incremental_hash_skips_touched_docs(eml_root, tmp_path, caplog):
+    stats_path = tmp_path / 'stats.pickle'
+    run_incremental(eml_root, stats_path, use_hash=True)
+    for eml_path in eml_root.glob('*/*/*/Level-1-EML.xml'):
+        set_mtime(eml_path, 10**9)
+
+    caplog.set_level('INFO')
+    result_list = run_incremental(eml_root, stats_path, use_hash=True)
+    assert 'added_or_changed=0 deleted=0' in caplog.text
+    assert result_list == proc_tree(eml_root)
+
+
+def test_cached_result_matches_scan(eml_root, tmp_path, monkeypatch):
+    cache = result_cache.ResultCache(tmp_path / 'cache', 1)
+    result_list = mk_stats.proc_all_cached(cache, eml_root, None, XPATH_LIST[:2])
+    assert result_list == proc_tree(eml_root, XPATH_LIST[:2])
+
+    proc_all = mk_stats.proc_all
+
+    def proc_missing(path_iter, xpath_list, *args):
+        # Only the XPath that is not cached yet is scanned.
+        assert xpath_list == XPATH_LIST[2:]
+        return proc_all(path_iter, xpath_list, *args)
+
+    monkeypatch.setattr(mk_stats, 'proc_all', proc_missing)
+    result_list = mk_stats.proc_all_cached(cache, eml_root, None, XPATH_LIST)
+    monkeypatch.undo()
+    assert result_list == proc_tree(eml_root)
+
+    write_eml(
+        eml_root,
+        'knb-lter-new',
+        1,
+        1,
+        get_eml_bytes('new.1.1', 'New', 'new', [('new_col', 'string')]),
+    )
+    result_list = mk_stats.proc_all_cached(cache, eml_root, None, XPATH_LIST[:2])
+    assert result_list == proc_tree(eml_root, XPATH_LIST[:2])
+
+
+@pytest.mark.parametrize('dedupe', ['raw', 'normalized'])
+@pytest.mark.parametrize('stream', [False, True])
+def test_dedupe_matches_full_scan(eml_root, dedupe, stream):
+    assert proc_tree(eml_root, dedupe=dedupe, stream=stream) == proc_tree(
+        eml_root, stream=stream
+    )
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_dedupe_skips_copies_in_other_chunks(eml_root, monkeypatch, caplog, jobs):
+    monkeypatch.setattr(mk_stats, 'PATH_CHUNK_SIZE', 1)
+    caplog.set_level('INFO')
+    result_list = proc_tree(eml_root, jobs=jobs, dedupe='raw')
+    assert 'distinct: 12 duplicates: 4 (25.0%) max copies: 2 processed: 12' in (
+        caplog.text
+    )
+    assert result_list == proc_tree(eml_root)
+
+
+def test_dedupe_normalized_finds_reindented_copies(eml_root, tmp_path):
+    unique_root = tmp_path / 'unique'
+    shutil.copytree(eml_root, unique_root)
+    # Revision 2 of each package is a copy of revision 1.
+    for eml_path in unique_root.glob('*/*/2/Level-1-EML.xml'):
+        shutil.rmtree(eml_path.parent)
+    for eml_path in eml_root.glob('*/*/2/Level-1-EML.xml'):
+        eml_path.write_bytes(eml_path.read_bytes().replace(b'\n  ', b'\n\t\t'))
+
+    unique_list = proc_tree(unique_root)
+    assert proc_tree(eml_root, dedupe='raw', unique_only=True) != unique_list
+    for jobs in 1, 2:
+        assert (
+            proc_tree(eml_root, jobs=jobs, dedupe='normalized', unique_only=True)
+            == unique_list
+        )
+
+
+def test_dedupe_rejects_checkpoint(eml_root, tmp_path):
+    checkpoint_obj = mk_stats.checkpoint.Checkpoint(tmp_path / 'c.pickle', {}, 0)
+    with pytest.raises(lib.EMLError):
+        proc_tree(eml_root, dedupe='raw', checkpoint_obj=checkpoint_obj)
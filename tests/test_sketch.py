@@ -0,0 +1,135 @@
+import collections
+import random
+
+import lib
+import sketch
+
+
+def get_value_list(seed, count=5000):
+    """Return a list of values with a skewed distribution"""
+    rnd = random.Random(seed)
+    return [f'v{int(rnd.paretovariate(1.2))}' for _ in range(count)]
+
+
+def check_bounds(top_k, true_counter):
+    for value, count, error in top_k.items():
+        assert count - error <= true_counter[value] <= count
+    for value, true_count in true_counter.items():
+        if value not in top_k.counter_dict:
+            assert true_count <= top_k.min_count()
+
+
+def test_space_saving_is_exact_below_k():
+    top_k = sketch.SpaceSaving(10)
+    for value in 'abcabca':
+        top_k.add(value)
+    assert top_k.items() == [('a', 3, 0), ('b', 2, 0), ('c', 2, 0)]
+    assert top_k.min_count() == 0
+
+
+def test_space_saving_bounds():
+    value_list = get_value_list(1)
+    top_k = sketch.SpaceSaving(20)
+    for value in value_list:
+        top_k.add(value)
+    assert len(top_k.items()) == 20
+    check_bounds(top_k, collections.Counter(value_list))
+
+
+def test_space_saving_merge_bounds():
+    value_list_a = get_value_list(1)
+    value_list_b = get_value_list(2)
+    top_k_a = sketch.SpaceSaving(20)
+    top_k_b = sketch.SpaceSaving(20)
+    for value in value_list_a:
+        top_k_a.add(value)
+    for value in value_list_b:
+        top_k_b.add(value)
+    top_k_a.merge(top_k_b)
+    assert len(top_k_a.items()) == 20
+    check_bounds(top_k_a, collections.Counter(value_list_a + value_list_b))
+
+
+def test_hyper_log_log_estimate():
+    hll = sketch.HyperLogLog()
+    for i in range(20000):
+        hll.add(f'value {i}')
+        hll.add(f'value {i // 2}')
+    assert abs(hll.estimate() - 20000) < 20000 * 0.05
+
+
+def test_hyper_log_log_merge():
+    hll_a = sketch.HyperLogLog()
+    hll_b = sketch.HyperLogLog()
+    hll_all = sketch.HyperLogLog()
+    for i in range(3000):
+        (hll_a if i % 2 else hll_b).add(str(i))
+        hll_all.add(str(i))
+    assert hll_a.merge(hll_b).register_arr == hll_all.register_arr
+
+
+def get_exact_stats(value_list, tag='tag'):
+    el_dict = {}
+    for value in value_list:
+        tag_dict = el_dict.setdefault(tag, {'tag_count': 0, 'unique_count': {}})
+        tag_dict['tag_count'] += 1
+        tag_dict['unique_count'][value] = tag_dict['unique_count'].get(value, 0) + 1
+    return el_dict
+
+
+def test_add_and_finalize_stats_match_exact_stats_below_k():
+    value_list = list('aabbbcd')
+    sketch_el_dict = {}
+    for value in value_list:
+        sketch.add_stats(sketch_el_dict, get_exact_stats([value]), 10)
+    el_dict = sketch.finalize_stats(sketch_el_dict)
+    tag_dict = el_dict['tag']
+    assert tag_dict['tag_count'] == 7
+    assert tag_dict['unique_count'] == {'a': 2, 'b': 3, 'c': 1, 'd': 1}
+    assert tag_dict['count_error'] == {'a': 0, 'b': 0, 'c': 0, 'd': 0}
+    assert tag_dict['unique_estimate'] == 4
+
+
+def test_sketch_merge_stats():
+    value_list_a = get_value_list(1, 1000)
+    value_list_b = get_value_list(2, 1000)
+    sketch_a = sketch.add_stats({}, get_exact_stats(value_list_a), 20)
+    sketch_b = sketch.add_stats({}, get_exact_stats(value_list_b), 20)
+    tag_dict = sketch.finalize_stats(sketch.merge_stats(sketch_a, sketch_b))['tag']
+    true_counter = collections.Counter(value_list_a + value_list_b)
+    assert tag_dict['tag_count'] == 2000
+    for value, count in tag_dict['unique_count'].items():
+        error = tag_dict['count_error'][value]
+        assert count - error <= true_counter[value] <= count
+
+
+def test_merge_finalized_stats_matches_exact_merge_below_k():
+    value_list_a = list('aabbc')
+    value_list_b = list('bcdd')
+    part_list = [
+        sketch.finalize_stats(sketch.add_stats({}, get_exact_stats(value_list), 10))
+        for value_list in (value_list_a, value_list_b)
+    ]
+    dst_el_dict = sketch.merge_finalized_stats(part_list[0], part_list[1], 10)
+    exact_el_dict = lib.merge_stats(
+        get_exact_stats(value_list_a), get_exact_stats(value_list_b)
+    )
+    assert dst_el_dict['tag']['tag_count'] == exact_el_dict['tag']['tag_count']
+    assert dst_el_dict['tag']['unique_count'] == exact_el_dict['tag']['unique_count']
+    assert set(dst_el_dict['tag']['count_error'].values()) == {0}
+    assert dst_el_dict['tag']['unique_estimate'] == 3
+
+
+def test_merge_finalized_stats_bounds():
+    value_list_a = get_value_list(1, 1000)
+    value_list_b = get_value_list(2, 1000)
+    part_list = [
+        sketch.finalize_stats(sketch.add_stats({}, get_exact_stats(value_list), 10))
+        for value_list in (value_list_a, value_list_b)
+    ]
+    tag_dict = sketch.merge_finalized_stats(part_list[0], part_list[1], 10)['tag']
+    true_counter = collections.Counter(value_list_a + value_list_b)
+    assert len(tag_dict['unique_count']) == 10
+    for value, count in tag_dict['unique_count'].items():
+        error = tag_dict['count_error'][value]
+        assert count - error <= true_counter[value] <= count
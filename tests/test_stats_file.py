@@ -0,0 +1,77 @@
+import pickle
+
+import pytest
+
+import lib
+import sketch
+import stats_file
+
+EL_DICT = {
+    'attributeName': {
+        'tag_count': 6,
+        'unique_count': {'col_0': 3, 'col_1': 2, 'Größe': 1},
+    },
+    'storageType': {'tag_count': 2, 'unique_count': {'float': 1, '': 1}},
+    'empty': {'tag_count': 0, 'unique_count': {}},
+}
+
+ARGS_DICT = {'xpath': './/dataTable//*', 'top_k': 0, 'shard': None}
+
+
+def get_top_k_el_dict():
+    sketch_el_dict = {}
+    for i in range(50):
+        sketch.add_stats(
+            sketch_el_dict,
+            {'tag': {'tag_count': 1, 'unique_count': {f'v{i % 7}{i % 3}': 1}}},
+            5,
+        )
+    return sketch.finalize_stats(sketch_el_dict)
+
+
+def test_compact_round_trip(tmp_path):
+    stats_path = tmp_path / 'stats.stats'
+    stats_file.write_compact(stats_path, EL_DICT, ARGS_DICT)
+    assert stats_file.is_compact(stats_path)
+    stats, args_dict = stats_file.read_stats(stats_path)
+    with stats:
+        assert args_dict == ARGS_DICT
+        assert stats.to_dict() == EL_DICT
+        unique_dict = stats['attributeName']['unique_count']
+        # Values are ordered by descending count.
+        assert list(unique_dict) == ['col_0', 'col_1', 'Größe']
+        assert unique_dict['Größe'] == 1
+        assert 'col_2' not in unique_dict
+        with pytest.raises(KeyError):
+            unique_dict['col_2']
+        assert 'count_error' not in stats['attributeName']
+
+
+def test_compact_round_trip_top_k(tmp_path):
+    el_dict = get_top_k_el_dict()
+    stats_path = tmp_path / 'stats.stats'
+    stats_file.write_compact(stats_path, el_dict, dict(ARGS_DICT, top_k=5))
+    assert stats_file.load_stats_dict(stats_path) == el_dict
+    stats, _ = stats_file.read_stats(stats_path)
+    with stats:
+        tag_dict = stats['tag']
+        assert tag_dict['unique_estimate'] == el_dict['tag']['unique_estimate']
+        for text, error in el_dict['tag']['count_error'].items():
+            assert tag_dict['count_error'][text] == error
+
+
+def test_pickle_is_read_as_dict(tmp_path):
+    stats_path = tmp_path / 'stats.pickle'
+    stats_path.write_bytes(pickle.dumps(dict(EL_DICT, __args=ARGS_DICT)))
+    assert not stats_file.is_compact(stats_path)
+    assert stats_file.read_stats(stats_path) == (EL_DICT, ARGS_DICT)
+
+
+def test_older_compact_format_is_rejected(tmp_path):
+    stats_path = tmp_path / 'stats.stats'
+    stats_file.write_compact(stats_path, EL_DICT, ARGS_DICT)
+    data_bytes = bytearray(stats_path.read_bytes())
+    data_bytes[len(stats_file.MAGIC_PREFIX)] = 1
+    stats_path.write_bytes(data_bytes)
+    with pytest.raises(lib.EMLError):
+        stats_file.read_stats(stats_path)
@@ -9,15 +9,32 @@ many versions of the spec, and each implementation has its own idiosyncrazies. U
 this (or another lxml based tool) should guarantee that the results match those obtained
 by the aggregation tool, and so is a good way to create and check the queries before
 using them in lengthy aggregations.
+
+Any number of EML docs can be checked in a single run. Each of the paths may be an EML
+doc, a directory tree or archive holding EML docs, or '-', for reading a list of paths
+to EML docs from stdin, one per line. If no paths are given, the list is read from
+stdin. Additional XPaths can be added with --xpath. The XPaths are compiled once, and
+are all applied to each EML doc after it's parsed. The results are grouped by EML doc,
+and then by XPath.
+
+With --server, the EML docs are not parsed here, but by query_server.py, which keeps
+them in memory between runs.
 """
 
+import functools
+import itertools
 import logging
+import multiprocessing
 import pathlib
 import sys
 
 import lxml.etree
 
 import lib
+import query_client
+
+# Number of EML docs in each batch of work sent to a worker process.
+PATH_CHUNK_SIZE = 20
 
 log = logging.getLogger(__name__)
 
@@ -33,19 +50,45 @@ def main():
     parser.add_argument(
         'eml_path',
         metavar='path',
-        help='Path to EML doc to which the xpath will be apply',
+        nargs='*',
+        help="""Path to EML doc to which the xpath will be apply, or to a directory
+        tree or archive holding EML docs. '-' reads a list of paths from stdin""",
+    )
+    parser.add_argument(
+        '--xpath',
+        dest='xpath_list',
+        metavar='xpath',
+        action='append',
+        default=[],
+        help='Additional XPath to apply to each EML doc. Can be repeated',
     )
     parser.add_argument(
         '--only-text',
         action='store_true',
         help='Only print elements which have text content',
     )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of worker processes to use. 0 uses one per available core',
+    )
+    parser.add_argument(
+        '--server',
+        metavar='path',
+        type=pathlib.Path,
+        nargs='?',
+        const=query_client.DEFAULT_SOCKET_PATH,
+        help="""Send the query to the server started with query_server.py, listening
+        on this Unix socket, instead of parsing the EML docs""",
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
         help='Debug level logging',
     )
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
 
     logging.basicConfig(
         format='%(levelname)8s %(message)s',
@@ -53,10 +96,26 @@ def main():
         stream=sys.stdout,
     )
 
-    args = parser.parse_args()
+    xpath_list = [args.xpath] + args.xpath_list
 
     try:
-        proc(args.xpath, pathlib.Path(args.eml_path), args.only_text)
+        if args.server:
+            print_all(
+                query_client.query_xpath(
+                    args.server,
+                    eml_path_gen(args.eml_path or ['-']),
+                    xpath_list,
+                    args.only_text,
+                ),
+                xpath_list,
+            )
+        else:
+            proc_all(
+                eml_path_gen(args.eml_path or ['-']),
+                xpath_list,
+                args.only_text,
+                args.jobs,
+            )
     except lib.EMLError as e:
         log.error(str(e))
         lib.plog(e.xml_frag, 'EML fragment', log.error)
@@ -66,22 +125,113 @@ def main():
     return 0
 
 
-def proc(xpath_str, eml_path, only_text):
-    log.debug('-' * 100)
-    log.debug(eml_path)
+def eml_path_gen(path_list):
+    """Yield paths to the EML docs in {path_list}. See the module docstring."""
+    for path_str in path_list:
+        if path_str == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield pathlib.Path(line.strip())
+            continue
+        eml_path = pathlib.Path(path_str)
+        if eml_path.is_dir() or lib.is_archive(eml_path):
+            yield from lib.eml_path_gen(eml_path)
+        else:
+            yield eml_path
+
+
+def proc_all(path_iter, xpath_list, only_text, jobs=1):
+    """Apply the XPaths in {xpath_list} to the EML docs in {path_iter}, and print the
+    results for each EML doc, in the order of {path_iter}."""
+    job_count = lib.get_job_count(jobs)
+    proc_func = functools.partial(
+        proc_path_list, xpath_list=xpath_list, only_text=only_text
+    )
+    chunk_gen = lib.chunk_gen(path_iter, PATH_CHUNK_SIZE)
+
+    if job_count == 1:
+        print_all(itertools.chain.from_iterable(map(proc_func, chunk_gen)), xpath_list)
+        return
+
+    with multiprocessing.Pool(job_count) as pool:
+        print_all(
+            itertools.chain.from_iterable(pool.imap(proc_func, chunk_gen)), xpath_list
+        )
 
-    root_el = lib.get_eml_tree(eml_path)
-    el_list = root_el.xpath(xpath_str)
 
-    for el in el_list:
-        if lxml.etree.iselement(el):
-            if (not only_text) or el.is_text:
+def print_all(doc_iter, xpath_list):
+    """Print the (path, result_list) tuples in {doc_iter}, as returned by
+    proc_path_list(), followed by a summary."""
+    doc_count = 0
+    match_list = [[0, 0] for _ in xpath_list]
+    for path_str, result_list in doc_iter:
+        doc_count += 1
+        print_doc(path_str, result_list, match_list)
+
+    log.info(f'EML docs: {doc_count}')
+    for xpath_str, (match_count, match_doc_count) in zip(xpath_list, match_list):
+        log.info(
+            f'{xpath_str}: matches={match_count} docs_with_matches={match_doc_count}'
+        )
+
+
+def print_doc(path_str, result_list, match_list):
+    log.debug('-' * 100)
+    log.debug(path_str)
+    if isinstance(result_list, str):
+        log.error(f'{result_list}. path="{path_str}"')
+        return
+    for (xpath_str, line_list), match_count_list in zip(result_list, match_list):
+        log.debug(f'  {xpath_str}: {len(line_list)}')
+        for line_str in line_list:
+            log.debug(f'    {line_str}')
+        match_count_list[0] += len(line_list)
+        match_count_list[1] += bool(line_list)
+
+
+def proc_path_list(path_list, xpath_list, only_text):
+    """Return a list of (path, result_list) for the EML docs in {path_list}. See
+    proc(). If an EML doc cannot be processed, result_list is the error message."""
+    xpath_obj_list = [lib.get_xpath(xpath_str) for xpath_str in xpath_list]
+    doc_list = []
+    for eml_path in path_list:
+        try:
+            result_list = proc(xpath_obj_list, eml_path, only_text)
+        except (OSError, lxml.etree.LxmlError) as e:
+            result_list = repr(e)
+        doc_list.append((eml_path.as_posix(), result_list))
+    return doc_list
+
+
+def proc(xpath_list, eml_path, only_text):
+    """Return a list of (xpath, line_list) with the matches of each XPath in
+    {xpath_list}, formatted for printing."""
+    return proc_tree(xpath_list, lib.get_eml_tree(eml_path), only_text)
+
+
+def proc_tree(xpath_list, root_el, only_text):
+    """Like proc(), for an already parsed EML doc"""
+    resolver = lib.ElementPathResolver(root_el.getroot())
+    result_list = []
+
+    for xpath_obj in xpath_list:
+        el_list = xpath_obj(root_el)
+        if not isinstance(el_list, list):
+            el_list = [el_list]
+        line_list = []
+        for el in el_list:
+            if lxml.etree.iselement(el):
+                # Comments and processing instructions have no path.
+                if not isinstance(el.tag, str):
+                    continue
                 text_str = (getattr(el, 'text', '') or '').strip()
                 if (not only_text) or text_str:
-                    tree = lxml.etree.ElementTree(root_el.getroot())
-                    log.debug(f'{tree.getelementpath(el)}: {text_str}')
-        else:
-            log.debug(el)
+                    line_list.append(f'{resolver.get_path(el)}: {text_str}')
+            else:
+                line_list.append(str(el))
+        result_list.append((xpath_obj.path, line_list))
+
+    return result_list
 
 
 if __name__ == '__main__':